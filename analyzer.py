@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# 構文解析を一度だけ行う評価器
+#
+# 読み込んだ式を評価の前に一度だけ解析し, 特殊形式と手続き適用を
+# 種類の決まった節(Node)の木に変換しておく. 変数参照(名前と字句アドレス)と
+# 自己評価式はそのまま残す. コントローラはevaluator.scmを共有し,
+# 式の分類と選択子の演算だけを節に対するものに差し替える(analyzed_ops).
+# 手続き本体はlambdaを評価するときには解析済みなので, 繰り返し呼んでも
+# タグを調べ直したり被演算子を切り出したりしない.
+
+from evaluator import *
+
+class Node(object):
+    __slots__ = ()
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join(repr(getattr(self, name)) for name in self.__slots__))
+
+class Quoted(Node):
+    __slots__ = ('text',)
+    type = quoted_type
+
+    def __init__(self, text):
+        self.text = text
+
+class Assignment(Node):
+    __slots__ = ('variable', 'value')
+    type = assignment_type
+
+    def __init__(self, variable, value):
+        self.variable = variable
+        self.value = value
+
+class Definition(Node):
+    __slots__ = ('variable', 'value')
+    type = definition_type
+
+    def __init__(self, variable, value):
+        self.variable = variable
+        self.value = value
+
+class If(Node):
+    __slots__ = ('predicate', 'consequent', 'alternative')
+    type = if_type
+
+    def __init__(self, predicate, consequent, alternative):
+        self.predicate = predicate
+        self.consequent = consequent
+        self.alternative = alternative
+
+class Lambda(Node):
+    __slots__ = ('parameters', 'body')
+    type = lambda_type
+
+    def __init__(self, parameters, body):
+        self.parameters = parameters
+        self.body = body
+
+class Begin(Node):
+    __slots__ = ('actions',)
+    type = begin_type
+
+    def __init__(self, actions):
+        self.actions = actions
+
+class Application(Node):
+    __slots__ = ('operator', 'operands')
+    type = application_type
+
+    def __init__(self, operator, operands):
+        self.operator = operator
+        self.operands = operands
+
+def analyze(exp):
+    if not isinstance(exp, list) or exp == []:
+        return exp
+
+    type = expression_type(exp)
+    if type == 'quoted':
+        return Quoted(text_of_quotation(exp))
+    elif type == 'assignment':
+        return Assignment(assignment_variable(exp), analyze(assignment_value(exp)))
+    elif type == 'definition':
+        return Definition(definition_variable(exp), analyze(definition_value(exp)))
+    elif type == 'if':
+        return If(analyze(if_predicate(exp)), analyze(if_consequent(exp)),
+                  analyze(if_alternative(exp)))
+    elif type == 'lambda':
+        return Lambda(lambda_parameters(exp), analyze_sequence(exp[2:]))
+    elif type == 'begin':
+        return Begin(analyze_sequence(exp[1:]))
+    else:
+        return Application(analyze(operator(exp)), analyze_sequence(exp[1:]))
+
+def analyze_sequence(exps):
+    return [analyze(exp) for exp in exps]
+
+# REPLが読んだ式はそのたびに新しいオブジェクトなので, 解析結果は覚えておかない.
+# 手続き本体の解析結果は, lambdaを評価して作る手続きが節として持つ.
+def analyze_expression(exp):
+    return analyze(annotate_lexical_addresses(exp))
+
+def node_type(exp):
+    if isinstance(exp, Node):
+        return exp.type
+    return expression_type(exp)
+
+analyzed_ops = dict(ops)
+analyzed_ops.update({
+    'analyze-expression' : analyze_expression,
+    'expression-type' : node_type,
+    'text-of-quotation' : lambda node: node.text,
+    'assignment-variable' : lambda node: node.variable,
+    'assignment-value' : lambda node: node.value,
+    'definition-variable' : lambda node: node.variable,
+    'definition-value' : lambda node: node.value,
+    'if-predicate' : lambda node: node.predicate,
+    'if-consequent' : lambda node: node.consequent,
+    'if-alternative' : lambda node: node.alternative,
+    'lambda-parameters' : lambda node: node.parameters,
+    'lambda-body' : lambda node: Cursor(node.body, 0),
+    'begin-actions' : lambda node: Cursor(node.actions, 0),
+    'operator' : lambda node: node.operator,
+    'operands' : lambda node: Cursor(node.operands, 0),
+    })
+
+def make_analyzing_eceval(batch=None, backend='interpret'):
+    return make_eceval(batch, backend, analyzed_ops)
+
+def eval_analyzed_program(source, backend='interpret'):
+    return eval_program(source, backend, analyzed_ops)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+from analyzer import *
+import unittest
+
+programs = """
+  (define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+  (fib 10)
+  (define (make-counter n)
+    (lambda () (set! n (+ n 1)) n))
+  (define c (make-counter 10))
+  (c)
+  (c)
+  (define (outer x)
+    (define y (* x 2))
+    (define (inner z) (+ x y z))
+    (inner 1))
+  (outer 5)
+  (begin 1 '(a b))
+  (if false 1)
+  """
+
+class TestAnalyzer(unittest.TestCase):
+
+    def test_analyze(self):
+        node = analyze_expression(read("(lambda (x) (if x (f x 1) '(no)))")[0])
+        self.assertTrue(isinstance(node, Lambda))
+        body = node.body[0]
+        self.assertTrue(isinstance(body, If))
+        self.assertTrue(is_lexical_address(body.predicate))
+        self.assertTrue(isinstance(body.consequent, Application))
+        self.assertTrue(is_variable(body.consequent.operator))
+        self.assertEqual(body.consequent.operands[1], 1)
+        self.assertEqual(body.alternative.text, [Ident(u'no')])
+
+    def test_define_sugar(self):
+        node = analyze_expression(read("(define (f a b) (+ a b))")[0])
+        self.assertTrue(isinstance(node, Definition))
+        self.assertEqual(node.variable, Ident(u'f'))
+        self.assertTrue(isinstance(node.value, Lambda))
+        self.assertEqual(node.value.parameters, [Ident(u'a'), Ident(u'b')])
+
+    def test_eval(self):
+        for backend in ('interpret', 'closure', 'block'):
+            self.assertEqual(repr(eval_analyzed_program(programs, backend)),
+                             repr(eval_program(programs, backend)))
+
+    def test_procedure_body_analyzed(self):
+        batch = BatchInput("(define (f x) (+ x 1)) f")
+        make_analyzing_eceval(batch).start()
+        proc = batch.results[1]
+        body = procedure_body(proc)
+        self.assertTrue(isinstance(first_exp(body), Application))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,514 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# 使い方: python benchmark.py [ベンチマーク名 ...]
+# 引数を省略するとすべてのベンチマークを実行する.
+
+import os, sys, time, resource, subprocess
+from machine import *
+
+def timed(proc):
+    start = time.time()
+    result = proc()
+    return time.time() - start, result
+
+def report(name, seconds, note=''):
+    print '%-40s %10.4f sec %s' % (name, seconds, note)
+
+# ラベル10個ごとに分岐を含む, n命令の擬似コントローラを作る
+def generate_controller(n):
+    text = []
+    for i in xrange(n):
+        if i % 10 == 0:
+            text.append(Ident(u'label-%d' % (i / 10)))
+        kind = i % 5
+        if kind == 0:
+            text.append([Ident(u'assign'), Ident(u'a'),
+                         [Ident(u'op'), Ident(u'+')], [Ident(u'reg'), Ident(u'a')], [Ident(u'const'), 1]])
+        elif kind == 1:
+            text.append([Ident(u'test'), [Ident(u'op'), Ident(u'<')],
+                         [Ident(u'reg'), Ident(u'a')], [Ident(u'const'), 0]])
+        elif kind == 2:
+            text.append([Ident(u'branch'), [Ident(u'label'), Ident(u'label-%d' % (i / 10))]])
+        elif kind == 3:
+            text.append([Ident(u'save'), Ident(u'a')])
+        else:
+            text.append([Ident(u'restore'), Ident(u'a')])
+    text.append(Ident(u'done'))
+    return text
+
+def bench_assemble(sizes=(10000, 100000, 1000000)):
+    ops = {'+': lambda a, b: a + b, '<': lambda a, b: a < b}
+    for n in sizes:
+        text = generate_controller(n)
+        mac = Machine()
+        mac.allocate_register('a')
+        mac.install_operations(ops)
+        seconds, insts = timed(lambda: assemble_program(text, mac))
+        report('assemble %d instructions' % n, seconds,
+               '(%.2f usec/inst)' % (seconds / n * 1e6))
+
+# 評価器のコントローラを並べたコードと, 数と文字列のリストを並べたデータを読む
+def bench_read(copies=300, rows=80000):
+    from evaluator import eceval_controller_text
+    code = u'(%s)' % (eceval_controller_text().decode('utf-8') * copies)
+    data = u'(quote (%s))' % ' '.join('(%d "s%d" %d.5 x%d)' % (i, i, i, i % 100)
+                                      for i in xrange(rows))
+    for name, source in (('code', code), ('data', data)):
+        seconds, _ = timed(lambda: read(source))
+        mbytes = len(source) / 1e6
+        report('read %s %.1f MB' % (name, mbytes), seconds,
+               '(%.2f MB/sec)' % (mbytes / seconds))
+
+def bench_fib(n=20, backends=('interpret', 'closure', 'block')):
+    from machine_test import fib_machine
+    base = None
+    for backend in backends:
+        mac = fib_machine(backend)
+        set_register_contents(mac, 'n', n)
+        seconds, _ = timed(mac.start)
+        if base is None:
+            base = seconds
+        report('fib(%d) %s' % (n, backend), seconds,
+               '(x%.2f)' % (base / seconds))
+
+# save/restoreの多いfibを, スタックの種類ごとに
+def bench_stack(n=20, backends=('interpret', 'closure', 'block')):
+    from machine_test import fib_machine
+    stacks = [('stack', Stack), ('instrumented', InstrumentedStack),
+              ('array', lambda: ArrayStack('l'))]
+    for backend in backends:
+        base = None
+        for name, make_stack in stacks:
+            mac = fib_machine(backend, make_stack())
+            set_register_contents(mac, 'n', n)
+            seconds, _ = timed(mac.start)
+            if base is None:
+                base = seconds
+            report('fib(%d) %s %s' % (n, backend, name), seconds,
+                   '(x%.2f)' % (base / seconds))
+
+def bench_eceval(n=16, backends=('interpret', 'closure', 'block')):
+    from evaluator import make_eceval, BatchInput
+    source = """
+      (define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+      (fib %d)
+      """ % n
+    base = None
+    for backend in backends:
+        mac = make_eceval(BatchInput(source), backend)
+        seconds, _ = timed(mac.start)
+        if base is None:
+            base = seconds
+        report('ec-eval (fib %d) %s' % (n, backend), seconds,
+               '(x%.2f)' % (base / seconds))
+
+# プロファイルを取らない場合と取る場合. 取った場合は時間の長いラベルを表示する
+def bench_profile(n=16, backends=('interpret', 'closure', 'block')):
+    from evaluator import make_eceval, BatchInput
+    source = """
+      (define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+      (fib %d)
+      """ % n
+    for backend in backends:
+        mac = make_eceval(BatchInput(source), backend)
+        base, _ = timed(mac.start)
+        report('ec-eval (fib %d) %s' % (n, backend), base)
+        mac = make_eceval(BatchInput(source), backend)
+        profiler = mac.enable_profiling()
+        seconds, _ = timed(mac.start)
+        report('ec-eval (fib %d) %s profiled' % (n, backend), seconds,
+               '(x%.2f)' % (seconds / base))
+    profiler.print_statistics(8)
+
+# 演算を包まない場合と, OperationProfilerで包んだ場合(sample回に1回計測)
+def bench_opprofile(n=16, samples=(1, 16), backend='closure'):
+    from evaluator import make_eceval, BatchInput, ops
+    source = """
+      (define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+      (fib %d)
+      """ % n
+    mac = make_eceval(BatchInput(source), backend)
+    base, _ = timed(mac.start)
+    report('ec-eval (fib %d) %s' % (n, backend), base)
+    for sample in samples:
+        profiler = OperationProfiler(sample)
+        mac = make_eceval(BatchInput(source), backend, profiler.wrap(ops))
+        seconds, _ = timed(mac.start)
+        report('ec-eval (fib %d) %s sample=%d' % (n, backend, sample), seconds,
+               '(x%.2f)' % (seconds / base))
+    profiler.print_statistics(8)
+
+# トレースを取る場合の実行時間と, 環状バッファの書き出し
+def bench_trace(n=16, size=65536, backends=('interpret', 'closure', 'block')):
+    import tempfile
+    from evaluator import make_eceval, BatchInput
+    source = """
+      (define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+      (fib %d)
+      """ % n
+    for backend in backends:
+        mac = make_eceval(BatchInput(source), backend)
+        base, _ = timed(mac.start)
+        report('ec-eval (fib %d) %s' % (n, backend), base)
+        mac = make_eceval(BatchInput(source), backend)
+        tracer = mac.enable_tracing(size)
+        seconds, _ = timed(mac.start)
+        report('ec-eval (fib %d) %s traced' % (n, backend), seconds,
+               '(x%.2f, %d steps)' % (seconds / base, tracer.count))
+    f = tempfile.TemporaryFile()
+    seconds, _ = timed(lambda: dump_trace(tracer, f))
+    report('dump trace (%d events)' % size, seconds, '(%d KB)' % (f.tell() / 1024))
+
+# 大域変数の多い環境. n個の定義を評価する時間と, 続けて(fib 14)を評価した場合の時間
+def bench_globals(sizes=(0, 10000, 20000), backend='closure'):
+    from evaluator import eval_program
+    fib = """
+      (define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+      (fib 14)"""
+    for n in sizes:
+        library = '\n'.join('(define g%d %d)' % (i, i) for i in xrange(n))
+        seconds, _ = timed(lambda: eval_program(library, backend))
+        report('define %d globals %s' % (n, backend), seconds)
+        seconds, _ = timed(lambda: eval_program(library + fib, backend))
+        report('define %d globals + (fib 14) %s' % (n, backend), seconds)
+
+# n個の定義からなるライブラリを評価した機械を保存し, 評価し直す場合と復元する場合を比べる
+def bench_snapshot(n=2000, backend='closure'):
+    import tempfile
+    from evaluator import make_eceval, BatchInput, write_eceval_snapshot, read_eceval_snapshot
+    library = '\n'.join('(define (f%d x) (if (< x 1) %d (f%d (- x 1))))' % (i, i, i)
+                         for i in xrange(n)) + '\n(define v (f%d 300))' % (n - 1)
+    seconds, mac = timed(lambda: make_eceval(BatchInput(library), backend))
+    report('make-eceval %s' % backend, seconds)
+    seconds, _ = timed(mac.start)
+    report('evaluate library (%d definitions)' % n, seconds)
+    f, path = tempfile.mkstemp()
+    os.close(f)
+    try:
+        seconds, _ = timed(lambda: write_eceval_snapshot(mac, path))
+        report('write snapshot', seconds, '(%d KB)' % (os.path.getsize(path) / 1024))
+        clone = make_eceval(BatchInput(''), backend)
+        seconds, _ = timed(lambda: read_eceval_snapshot(path, clone))
+        report('read snapshot', seconds)
+    finally:
+        os.remove(path)
+
+# 被演算子n個の手続き適用を評価する. 1被演算子あたりの時間がnによらなければ線形.
+def bench_operands(sizes=(10, 100, 1000), total=20000):
+    from evaluator import eval_program
+    for n in sizes:
+        exp = '(+ %s)' % ' '.join(str(i) for i in xrange(n))
+        repeat = max(1, total / n)
+        seconds, _ = timed(lambda: eval_program(exp * repeat, 'closure'))
+        report('ec-eval %d operands x %d' % (n, repeat), seconds,
+               '(%.2f usec/operand)' % (seconds / (n * repeat) * 1e6))
+
+# 同じ手続き本体を何度も評価するループ. 解析済みの節を評価する場合と比べる.
+def bench_analyze(n=20000, backends=('closure', 'block')):
+    from analyzer import eval_analyzed_program
+    from evaluator import eval_program
+    source = """
+      (define (loop i acc)
+        (if (= i 0)
+            acc
+            (begin (set! acc (+ acc i))
+                   (loop (- i 1) acc))))
+      (loop %d 0)""" % n
+    for backend in backends:
+        plain, _ = timed(lambda: eval_program(source, backend))
+        analyzed, _ = timed(lambda: eval_analyzed_program(source, backend))
+        report('ec-eval loop %d %s' % (n, backend), plain)
+        report('ec-eval loop %d %s analyzed' % (n, backend), analyzed,
+               '(x%.2f)' % (plain / analyzed))
+
+# fibを評価器で定義した場合と, 翻訳して定義した場合とで(fib n)を評価する時間を比べる
+def bench_compile(n=18, backends=('interpret', 'closure', 'block')):
+    from eccompiler import eval_with_compiled_library
+    from evaluator import eval_program
+    library = "(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))"
+    source = "(fib %d)" % n
+    for backend in backends:
+        interpreted, _ = timed(lambda: eval_program(library + source, backend))
+        compiled, _ = timed(lambda: eval_with_compiled_library(library, source, backend))
+        report('ec-eval (fib %d) %s' % (n, backend), interpreted)
+        report('ec-eval (fib %d) %s compiled' % (n, backend), compiled,
+               '(x%.2f)' % (interpreted / compiled))
+
+# eval-dispatchだけを繰り返す機械. 以前のtest/branchの連鎖とdispatch命令とで,
+# 手続き適用の式を分類して飛ぶまでの時間を比べる.
+dispatch_chain = """
+ (test (op self-evaluating?) (reg exp))
+ (branch (label ev-self-eval))
+ (test (op lexical-address?) (reg exp))
+ (branch (label ev-lexical-address))
+ (test (op variable?) (reg exp))
+ (branch (label ev-variable))
+ (test (op quoted?) (reg exp))
+ (branch (label ev-quoted))
+ (test (op assignment?) (reg exp))
+ (branch (label ev-assignment))
+ (test (op definition?) (reg exp))
+ (branch (label ev-definition))
+ (test (op if?) (reg exp))
+ (branch (label ev-if))
+ (test (op lambda?) (reg exp))
+ (branch (label ev-lambda))
+ (test (op begin?) (reg exp))
+ (branch (label ev-begin))
+ (test (op application?) (reg exp))
+ (branch (label ev-application))
+ (goto (label unknown-expression-type))
+"""
+
+dispatch_table = """
+ (dispatch (op expression-type) (reg exp)
+           ((self-evaluating ev-self-eval) (lexical-address ev-lexical-address)
+            (variable ev-variable) (quoted ev-quoted) (assignment ev-assignment)
+            (definition ev-definition) (if ev-if) (lambda ev-lambda)
+            (begin ev-begin) (application ev-application))
+           (label unknown-expression-type))
+"""
+
+def dispatch_machine(dispatch, backend):
+    from evaluator import ops
+    targets = ['ev-self-eval', 'ev-lexical-address', 'ev-variable', 'ev-quoted',
+               'ev-assignment', 'ev-definition', 'ev-if', 'ev-lambda', 'ev-begin',
+               'ev-application', 'unknown-expression-type']
+    controller = """(
+     loop
+      (test (op =) (reg n) (const 0))
+      (branch (label done))
+      (assign n (op -) (reg n) (const 1))
+      (assign continue (label loop))
+      %s
+      (goto (label loop))
+      %s
+     done)""" % (dispatch, ' '.join('%s (goto (reg continue))' % t for t in targets))
+    eval_ops = dict(ops)
+    eval_ops.update({'=': lambda a, b: a == b, '-': lambda a, b: a - b})
+    return make_machine(['exp', 'n', 'continue'], eval_ops, controller, backend)
+
+def bench_dispatch(n=100000, backends=('interpret', 'closure')):
+    exp = read('(f x (g y) 1)')[0]
+    for backend in backends:
+        costs = {}
+        for name, dispatch in (('none', ''), ('chain', dispatch_chain),
+                               ('dispatch', dispatch_table)):
+            mac = dispatch_machine(dispatch, backend)
+            set_register_contents(mac, 'exp', exp)
+            set_register_contents(mac, 'n', n)
+            seconds, _ = timed(mac.start)
+            costs[name] = seconds
+        for name in ('chain', 'dispatch'):
+            cost = costs[name] - costs['none']
+            report('dispatch application %s %s' % (backend, name), cost,
+                   '(%.2f usec/dispatch)' % (cost / n * 1e6))
+
+# 再帰の深さdepthぶんの手続き適用を重ね, すべての環境を生かしたままにする.
+# 'copied'は以前の表現([dict] + base_envで親の環境を複製する)の再現.
+def build_environments(model, depth):
+    from evaluator import extend_environment, the_empty_environment
+    vars = [Ident(u'n')]
+    envs = []
+    if model == 'copied':
+        env = []
+        for i in xrange(depth):
+            env = [dict(zip(vars, [i]))] + env
+            envs.append(env)
+    else:
+        env = the_empty_environment
+        for i in xrange(depth):
+            env = extend_environment(vars, [i], env)
+            envs.append(env)
+    return envs
+
+def deep_recursion(depth):
+    from evaluator import eval_program
+    return eval_program("""
+      (define (count n) (if (= n 0) 0 (+ 1 (count (- n 1)))))
+      (count %d)""" % depth)
+
+def measure_memory(workload, *args):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    seconds, _ = timed(lambda: workload(*args))
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print seconds, after - before
+
+# メモリの最大使用量を正しく測るため, 計測ごとに別のプロセスで実行する
+def run_measurement(*args):
+    out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--measure']
+                                  + map(str, args))
+    seconds, kbytes = out.split()
+    return float(seconds), int(kbytes)
+
+def bench_environment(depths=(1000, 2000, 4000)):
+    for depth in depths:
+        for model in ('copied', 'linked'):
+            seconds, kbytes = run_measurement('environments', model, depth)
+            report('environments %s depth %d' % (model, depth), seconds,
+                   '(+%d KB maxrss)' % kbytes)
+        seconds, kbytes = run_measurement('recursion', depth)
+        report('ec-eval (count %d)' % depth, seconds, '(+%d KB maxrss)' % kbytes)
+
+# 数のリストと, 同じ記号が繰り返し現れるリストからなるデータファイル
+def write_dataset(path, rows):
+    f = open(path, 'w')
+    try:
+        f.write("(quote (\n")
+        for i in xrange(rows):
+            f.write("((%d %d %d %d) (%d.5 %d.25) (sym-%d label-%d))\n"
+                    % (i, i + 1, i + 2, i + 3, i, i, i % 50, i % 7))
+        f.write("))\n")
+    finally:
+        f.close()
+
+def load_dataset(mode, path):
+    if mode == 'read':
+        f = open(path)
+        try:
+            return read(f.read().decode('utf-8'))
+        finally:
+            f.close()
+    return Reader(compact=(mode == 'compact')).read_file(path)
+
+def bench_load(rows=100000):
+    import tempfile
+    fd, path = tempfile.mkstemp(suffix='.scm')
+    os.close(fd)
+    try:
+        write_dataset(path, rows)
+        size = os.path.getsize(path) / 1024
+        for mode in ('read', 'mmap', 'compact'):
+            seconds, kbytes = run_measurement('load', mode, path)
+            report('load %d KB %s' % (size, mode), seconds, '(+%d KB maxrss)' % kbytes)
+    finally:
+        os.remove(path)
+
+def dump_dataset(rows):
+    return [[i, u's%d' % i, i + .5, Ident(u'x%d' % (i % 100)), [i, [i + 1, Symbol(u'y')]]]
+            for i in xrange(rows)]
+
+# 文字列に書き出す(dump)か, ファイルへ少しずつ書き出す(write)
+def dump_to(mode, rows):
+    data = dump_dataset(int(rows))
+    if mode == 'dump':
+        return len(dump(data))
+    f = open(os.devnull, 'w')
+    try:
+        Dumper().write(data, f, 'utf-8')
+    finally:
+        f.close()
+
+# evaluator.scmを読んでアセンブルする場合と, アセンブル済みのイメージを読む場合.
+# データはテキストとバイナリ形式それぞれからの読み込み
+def bench_image(n=200, rows=100000):
+    import tempfile
+    from evaluator import eceval_controller, eceval_registers, ops
+    fd, path = tempfile.mkstemp(suffix='.sxb')
+    os.close(fd)
+    try:
+        write_program_image(assemble_controller(eceval_controller()), path)
+        for name, load in (('text', eceval_controller), ('image', lambda: read_program_image(path))):
+            seconds, _ = timed(lambda: [make_machine(eceval_registers, ops, load())
+                                        for i in xrange(n)])
+            report('ec-eval from %s x%d' % (name, n), seconds,
+                   '(%.2f msec/machine)' % (seconds / n * 1000))
+    finally:
+        os.remove(path)
+
+    data = dump_dataset(rows)
+    for name, text, load in (('text', dump(data), read), ('binary', dump_binary(data), load_binary)):
+        seconds, _ = timed(lambda: load(text))
+        report('load %s %.1f MB' % (name, len(text) / 1e6), seconds)
+
+# モジュールだけをimportするプロセスの起動時間. 'pass'はインタプリタ自体の起動時間
+def bench_import(processes=20):
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for module in ('pass', 'import simplesexp', 'import machine', 'import evaluator'):
+        def run():
+            for i in xrange(processes):
+                subprocess.check_call([sys.executable, '-c', module], cwd=directory)
+        seconds, _ = timed(run)
+        report('%s x%d' % (module, processes), seconds,
+               '(%.1f msec/process)' % (seconds / processes * 1000))
+
+# アセンブル済みのプログラムのキャッシュ. 同じプロセスで機械を作り直す場合と,
+# 短い評価器のプロセスを何度も起動する場合
+def bench_cache(n=200, processes=20):
+    import tempfile, shutil
+    from evaluator import make_eceval
+    directory = tempfile.mkdtemp()
+    try:
+        cache = ProgramCache(directory)
+        for name, cache in (('no cache', None), ('cache', cache)):
+            seconds, _ = timed(lambda: [make_eceval(cache=cache) for i in xrange(n)])
+            report('make-eceval %s x%d' % (name, n), seconds,
+                   '(%.2f msec/machine)' % (seconds / n * 1000))
+
+        source = os.path.join(directory, 'program.scm')
+        f = open(source, 'w')
+        f.write('(define (f x) (* x 2)) (f 21)\n')
+        f.close()
+        evaluator = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'evaluator.py')
+        for name, env in (('no cache', {}), ('cache', {'MACHINE_PROGRAM_CACHE': directory})):
+            env = dict(os.environ, **env)
+            def run():
+                for i in xrange(processes):
+                    subprocess.check_output([sys.executable, evaluator, source], env=env)
+            seconds, _ = timed(run)
+            report('evaluator process %s x%d' % (name, processes), seconds,
+                   '(%.1f msec/process)' % (seconds / processes * 1000))
+    finally:
+        shutil.rmtree(directory)
+
+# maxrssは子プロセスに引き継がれるので, データを作る前にメモリを測る
+def bench_dump(rows=100000):
+    for mode in ('dump', 'write'):
+        seconds, kbytes = run_measurement('dump', mode, rows)
+        report('%s %d rows' % (mode, rows), seconds, '(+%d KB maxrss)' % kbytes)
+    data = dump_dataset(rows)
+    seconds, text = timed(lambda: dump(data))
+    mbytes = len(text) / 1e6
+    report('dump %.1f MB' % mbytes, seconds, '(%.2f MB/sec)' % (mbytes / seconds))
+    seconds, _ = timed(lambda: read(dump(data)))
+    report('read(dump) %.1f MB' % mbytes, seconds)
+
+measurements = {
+    'dump': dump_to,
+    'load': load_dataset,
+    'environments': lambda model, depth: build_environments(model, int(depth)),
+    'recursion': lambda depth: deep_recursion(int(depth)),
+    }
+
+benchmarks = {
+    'analyze': bench_analyze,
+    'cache': bench_cache,
+    'compile': bench_compile,
+    'dispatch': bench_dispatch,
+    'dump': bench_dump,
+    'environment': bench_environment,
+    'globals': bench_globals,
+    'operands': bench_operands,
+    'opprofile': bench_opprofile,
+    'eceval': bench_eceval,
+    'assemble': bench_assemble,
+    'fib': bench_fib,
+    'image': bench_image,
+    'import': bench_import,
+    'load': bench_load,
+    'profile': bench_profile,
+    'read': bench_read,
+    'snapshot': bench_snapshot,
+    'stack': bench_stack,
+    'trace': bench_trace,
+    }
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--measure']:
+        measure_memory(measurements[sys.argv[2]], *sys.argv[3:])
+        sys.exit()
+
+    names = sys.argv[1:] or sorted(benchmarks.keys())
+    for name in names:
+        benchmarks[name]()
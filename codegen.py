@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# 基本ブロックコンパイラ
+#
+# コントローラをラベルと分岐先で基本ブロックに分け, ブロックごとにPythonの関数を
+# ソースコードとして生成してcompile()/execする. ブロックの中ではレジスタを
+# レジスタファイルからローカル変数に載せておき, ブロックを抜けるときに書き換えたレジスタだけを戻す.
+# 生成した関数は, クロージャコンパイルのステップと同じく次に実行する命令の
+# オフセットを返す. branchはブロックの途中からの脱出として扱い, ブロックを切らない.
+#
+# ブロックの先頭以外のオフセットにはクロージャコンパイルのステップを置いておくので,
+# pcがブロックの途中を指していても実行を続けられる.
+# 演算が例外を投げた場合も, それまでにローカル変数へ書いた値はレジスタへ戻すが,
+# pcレジスタはブロックの先頭を指したままになる.
+
+from machine import *
+
+def compile_blocks(insts, labels, machine):
+    steps = compile_steps(insts, labels, machine)
+    texts = map(instruction_text, insts)
+    leaders = find_leaders(texts, labels)
+
+    gen = BlockGenerator(machine, labels)
+    for start, end in block_ranges(leaders, len(texts)):
+        gen.add_block(start, texts[start:end], end)
+
+    for offset, block in gen.build().items():
+        steps[offset] = block
+
+    return steps
+
+# ブロックの先頭: 命令列の先頭, ラベルの位置, gotoとdispatchの直後
+def find_leaders(texts, labels):
+    leaders = set([0])
+    leaders.update(labels.values())
+    for i, text in enumerate(texts):
+        if text[0] in ('goto', 'dispatch'):
+            leaders.add(i + 1)
+
+    return sorted(offset for offset in leaders if offset < len(texts))
+
+def block_ranges(leaders, end):
+    return zip(leaders, leaders[1:] + [end])
+
+class BlockGenerator(object):
+
+    def __init__(self, machine, labels):
+        self.machine = machine
+        self.labels = labels
+        self.operations = []    # O0, O1, ...
+        self.constants = []     # K0, K1, ... (dispatchの表もここに置く)
+        self.names = {}
+        self.lines = []
+        self.blocks = []
+
+    # 生成コード中では r<番号> (番号はレジスタファイルの添字)
+    def register_var(self, name):
+        return self.machine.register_number(name)
+
+    def operation_var(self, name):
+        key = ('op', name)
+        if not self.names.has_key(key):
+            self.names[key] = 'O%d' % len(self.operations)
+            self.operations.append(lookup_prim(name, self.machine.operations()))
+        return self.names[key]
+
+    def constant_var(self, value):
+        self.constants.append(value)
+        return 'K%d' % (len(self.constants) - 1)
+
+    def label_offset(self, exp):
+        return lookup_label(self.labels, label_exp_label(exp))
+
+    # 値を表すPythonの式
+    def value_exp(self, exp, used):
+        if is_register_exp(exp):
+            index = self.register_var(register_exp_reg(exp))
+            used.add(index)
+            return 'r%d' % index
+        elif is_constant_exp(exp):
+            return self.constant_var(constant_exp_value(exp))
+        elif is_label_exp(exp):
+            return repr(self.label_offset(exp))
+        raise UnknownExpressionError()
+
+    def operation_call(self, exp, used):
+        op = self.operation_var(operation_exp_op(exp))
+        args = [self.value_exp(e, used) for e in operation_exp_operands(exp)]
+        return '%s(%s)' % (op, ', '.join(args))
+
+    def add_block(self, start, texts, end):
+        used = set()
+        written = set()
+        body = []
+        exits = []          # (行番号, 字下げ, 戻り値) 書き戻しの行はあとで差し込む
+        flag = self.register_var('flag')
+
+        def exit(indent, value):
+            exits.append((len(body), indent, value))
+
+        for text in texts:
+            ins = text[0]
+            if ins == 'assign':
+                target = self.register_var(text[1])
+                value_exp = text[2:]
+                if is_operation_exp(value_exp):
+                    value = self.operation_call(value_exp, used)
+                else:
+                    value = self.value_exp(value_exp[0], used)
+                used.add(target)
+                written.add(target)
+                body.append('        r%d = %s' % (target, value))
+
+            elif ins == 'test':
+                condition = test_condition(text)
+                if not is_operation_exp(condition):
+                    raise BadInstructionError()
+                used.add(flag)
+                written.add(flag)
+                body.append('        r%d = %s' % (flag, self.operation_call(condition, used)))
+
+            elif ins == 'branch':
+                if not is_label_exp(text[1]):
+                    raise BadInstructionError()
+                used.add(flag)
+                body.append('        if r%d:' % flag)
+                exit('            ', repr(self.label_offset(text[1])))
+
+            elif ins == 'goto':
+                if is_label_exp(text[1]):
+                    exit('        ', repr(self.label_offset(text[1])))
+                elif is_register_exp(text[1]):
+                    exit('        ', self.value_exp(text[1], used))
+                else:
+                    raise BadInstructionError()
+
+            elif ins == 'save':
+                reg = self.register_var(stack_inst_reg_name(text))
+                used.add(reg)
+                body.append('        push(r%d)' % reg)
+
+            elif ins == 'restore':
+                reg = self.register_var(stack_inst_reg_name(text))
+                used.add(reg)
+                written.add(reg)
+                body.append('        r%d = pop()' % reg)
+
+            elif ins == 'perform':
+                action = text[1:]
+                if not is_operation_exp(action):
+                    raise BadInstructionError()
+                body.append('        %s' % self.operation_call(action, used))
+
+            elif ins == 'dispatch':
+                key_exp = dispatch_key_exp(text)
+                if not is_operation_exp(key_exp) or not is_label_exp(dispatch_default(text)):
+                    raise BadInstructionError()
+                table = self.constant_var(make_dispatch_table(text, self.labels))
+                body.append('        key = %s' % self.operation_call(key_exp, used))
+                exit('        ', '%s.get(key, %r)' % (table, self.label_offset(dispatch_default(text))))
+
+            else:
+                print "InvalidInst: ",  text
+                raise InvalidInstError
+
+        if texts[-1][0] not in ('goto', 'dispatch'):
+            exit('        ', repr(end))
+
+        self.blocks.append(start)
+        self.lines.append('    def block_%d():' % start)
+        for index in sorted(used):
+            self.lines.append('        r%d = regs[%d]' % (index, index))
+        self.lines.append('        try:')
+        pos = 0
+        for line_no, indent, value in exits:
+            self.lines.extend(['    ' + line for line in body[pos:line_no]])
+            pos = line_no
+            for index in sorted(written):
+                self.lines.append('    %sregs[%d] = r%d' % (indent, index, index))
+            self.lines.append('    %sreturn %s' % (indent, value))
+        self.lines.append('        except:')
+        for index in sorted(written):
+            self.lines.append('            regs[%d] = r%d' % (index, index))
+        if not written:
+            self.lines.append('            pass')
+        self.lines.append('            raise')
+
+    def source(self):
+        lines = ['def make_blocks(regs, operations, constants, push, pop):']
+        for prefix, name, objs in (('O', 'operations', self.operations),
+                                   ('K', 'constants', self.constants)):
+            for i in xrange(len(objs)):
+                lines.append('    %s%d = %s[%d]' % (prefix, i, name, i))
+        lines.extend(self.lines)
+        lines.append('    return {%s}' % ', '.join('%d: block_%d' % (start, start)
+                                                  for start in self.blocks))
+        return '\n'.join(lines) + '\n'
+
+    def build(self):
+        namespace = {}
+        code = compile(self.source(), '<controller blocks>', 'exec')
+        exec code in namespace
+        stack = self.machine.get_stack()
+        return namespace['make_blocks'](self.machine.register_file(), self.operations, self.constants,
+                                        stack.push, stack.pop)
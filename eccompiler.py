@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# SICP 5.5 の翻訳系
+#
+# Schemeの式をこのレジスタ計算機の命令列に翻訳する. 命令列はevaluator.scmの
+# コントローラの後ろにつないでアセンブルするので, 翻訳したコードと積極制御評価器は
+# 同じ機械の上で動く. 翻訳した手続きは評価器のapply-dispatchから呼ばれ,
+# 翻訳したコードから評価器の手続き(compound-procedure)を呼ぶときは
+# continueを積んで評価器のcompound-applyへ飛ぶ.
+#
+# lambdaで束縛される変数は評価器と同じく字句アドレスで参照する.
+
+import itertools
+from evaluator import *
+
+class CompileError(Error): pass
+
+all_regs = ['env', 'proc', 'val', 'argl', 'continue']
+
+def compile_exp(exp, target, linkage):
+    type = expression_type(exp)
+    if type == 'self-evaluating':
+        return compile_self_evaluating(exp, target, linkage)
+    elif type == 'quoted':
+        return compile_quoted(exp, target, linkage)
+    elif type in ('variable', 'lexical-address'):
+        return compile_variable(exp, target, linkage)
+    elif type == 'assignment':
+        return compile_assignment(exp, target, linkage)
+    elif type == 'definition':
+        return compile_definition(exp, target, linkage)
+    elif type == 'if':
+        return compile_if(exp, target, linkage)
+    elif type == 'lambda':
+        return compile_lambda(exp, target, linkage)
+    elif type == 'begin':
+        return compile_sequence(exp[1:], target, linkage)
+    elif type == 'application':
+        return compile_application(exp, target, linkage)
+    raise CompileError('unknown expression type', exp)
+
+# 命令文を組み立てる
+
+def reg(name):
+    return [Ident(u'reg'), Ident(name)]
+
+def const(value):
+    return [Ident(u'const'), value]
+
+def label(name):
+    return [Ident(u'label'), name]
+
+def op(name):
+    return [Ident(u'op'), Ident(name)]
+
+def assign(target, *value_exp):
+    return [Ident(u'assign'), Ident(target)] + list(value_exp)
+
+def test(*condition):
+    return [Ident(u'test')] + list(condition)
+
+def branch(dest):
+    return [Ident(u'branch'), dest]
+
+def goto(dest):
+    return [Ident(u'goto'), dest]
+
+def save(name):
+    return [Ident(u'save'), Ident(name)]
+
+def restore(name):
+    return [Ident(u'restore'), Ident(name)]
+
+def perform(*action):
+    return [Ident(u'perform')] + list(action)
+
+# ラベルの番号. compile_and_goは翻訳のたびに1から振り直すので, 同じソースからは
+# どのプロセスでも同じラベルのコントローラになる(スナップショットの照合に使う).
+label_counter = itertools.count(1)
+
+def make_label(name):
+    return Ident(u'%s%d' % (name, next(label_counter)))
+
+# 命令列 (必要なレジスタ, 変更するレジスタ, 命令文のリスト).
+# ラベルはそれだけで命令文がひとつの命令列として扱う.
+
+def make_instruction_sequence(needs, modifies, statements):
+    return [needs, modifies, statements]
+
+def empty_instruction_sequence():
+    return make_instruction_sequence([], [], [])
+
+def registers_needed(s):
+    if isinstance(s, Ident):
+        return []
+    return s[0]
+
+def registers_modified(s):
+    if isinstance(s, Ident):
+        return []
+    return s[1]
+
+def statements(s):
+    if isinstance(s, Ident):
+        return [s]
+    return s[2]
+
+def needs_register(seq, reg):
+    return reg in registers_needed(seq)
+
+def modifies_register(seq, reg):
+    return reg in registers_modified(seq)
+
+def list_union(s1, s2):
+    return s1 + [r for r in s2 if r not in s1]
+
+def list_difference(s1, s2):
+    return [r for r in s1 if r not in s2]
+
+def append_instruction_sequences(*seqs):
+    needs = []
+    modifies = []
+    stmts = []
+    for seq in seqs:
+        needs = list_union(needs, list_difference(registers_needed(seq), modifies))
+        modifies = list_union(modifies, registers_modified(seq))
+        stmts = stmts + statements(seq)
+    return make_instruction_sequence(needs, modifies, stmts)
+
+def preserving(regs, seq1, seq2):
+    for reg_name in regs:
+        if needs_register(seq2, reg_name) and modifies_register(seq1, reg_name):
+            seq1 = make_instruction_sequence(
+                list_union([reg_name], registers_needed(seq1)),
+                list_difference(registers_modified(seq1), [reg_name]),
+                [save(reg_name)] + statements(seq1) + [restore(reg_name)])
+    return append_instruction_sequences(seq1, seq2)
+
+def tack_on_instruction_sequence(seq, body_seq):
+    return make_instruction_sequence(registers_needed(seq), registers_modified(seq),
+                                     statements(seq) + statements(body_seq))
+
+def parallel_instruction_sequences(seq1, seq2):
+    return make_instruction_sequence(
+        list_union(registers_needed(seq1), registers_needed(seq2)),
+        list_union(registers_modified(seq1), registers_modified(seq2)),
+        statements(seq1) + statements(seq2))
+
+# 接続
+
+def compile_linkage(linkage):
+    if linkage == 'return':
+        return make_instruction_sequence(['continue'], [], [goto(reg('continue'))])
+    elif linkage == 'next':
+        return empty_instruction_sequence()
+    return make_instruction_sequence([], [], [goto(label(linkage))])
+
+def end_with_linkage(linkage, seq):
+    return preserving(['continue'], seq, compile_linkage(linkage))
+
+# 単純な式
+
+def compile_self_evaluating(exp, target, linkage):
+    return end_with_linkage(linkage,
+        make_instruction_sequence([], [target], [assign(target, const(exp))]))
+
+def compile_quoted(exp, target, linkage):
+    return end_with_linkage(linkage,
+        make_instruction_sequence([], [target],
+                                  [assign(target, const(text_of_quotation(exp)))]))
+
+def compile_variable(exp, target, linkage):
+    if is_lexical_address(exp):
+        lookup = op('lexical-address-lookup')
+    else:
+        lookup = op('lookup-variable-value')
+    return end_with_linkage(linkage,
+        make_instruction_sequence(['env'], [target],
+                                  [assign(target, lookup, const(exp), reg('env'))]))
+
+def compile_assignment(exp, target, linkage):
+    var = assignment_variable(exp)
+    if is_lexical_address(var):
+        setter = op('lexical-address-set!')
+    else:
+        setter = op('set-variable-value!')
+    get_value_code = compile_exp(assignment_value(exp), 'val', 'next')
+    return end_with_linkage(linkage,
+        preserving(['env'], get_value_code,
+            make_instruction_sequence(['env', 'val'], [target],
+                                      [perform(setter, const(var), reg('val'), reg('env')),
+                                       assign(target, const(Ident(u'ok')))])))
+
+def compile_definition(exp, target, linkage):
+    var = definition_variable(exp)
+    get_value_code = compile_exp(definition_value(exp), 'val', 'next')
+    return end_with_linkage(linkage,
+        preserving(['env'], get_value_code,
+            make_instruction_sequence(['env', 'val'], [target],
+                                      [perform(op('define-variable!'), const(var),
+                                               reg('val'), reg('env')),
+                                       assign(target, const(Ident(u'ok')))])))
+
+# 条件式
+
+def compile_if(exp, target, linkage):
+    t_branch = make_label('true-branch')
+    f_branch = make_label('false-branch')
+    after_if = make_label('after-if')
+    if linkage == 'next':
+        consequent_linkage = after_if
+    else:
+        consequent_linkage = linkage
+
+    p_code = compile_exp(if_predicate(exp), 'val', 'next')
+    c_code = compile_exp(if_consequent(exp), target, consequent_linkage)
+    a_code = compile_exp(if_alternative(exp), target, linkage)
+    return preserving(['env', 'continue'], p_code,
+        append_instruction_sequences(
+            make_instruction_sequence(['val'], [],
+                                      [test(op('false?'), reg('val')),
+                                       branch(label(f_branch))]),
+            parallel_instruction_sequences(
+                append_instruction_sequences(t_branch, c_code),
+                append_instruction_sequences(f_branch, a_code)),
+            after_if))
+
+# 列
+
+def compile_sequence(seq, target, linkage):
+    if len(seq) == 1:
+        return compile_exp(seq[0], target, linkage)
+    return preserving(['env', 'continue'],
+                      compile_exp(seq[0], target, 'next'),
+                      compile_sequence(seq[1:], target, linkage))
+
+# lambda式
+
+def compile_lambda(exp, target, linkage):
+    proc_entry = make_label('entry')
+    after_lambda = make_label('after-lambda')
+    if linkage == 'next':
+        lambda_linkage = after_lambda
+    else:
+        lambda_linkage = linkage
+
+    return append_instruction_sequences(
+        tack_on_instruction_sequence(
+            end_with_linkage(lambda_linkage,
+                make_instruction_sequence(['env'], [target],
+                                          [assign(target, op('make-compiled-procedure'),
+                                                  label(proc_entry), reg('env'))])),
+            compile_lambda_body(exp, proc_entry)),
+        after_lambda)
+
+def compile_lambda_body(exp, proc_entry):
+    formals = lambda_parameters(exp)
+    return append_instruction_sequences(
+        make_instruction_sequence(['env', 'proc', 'argl'], ['env'],
+            [proc_entry,
+             assign('env', op('compiled-procedure-env'), reg('proc')),
+             assign('env', op('extend-environment'), const(formals), reg('argl'), reg('env'))]),
+        compile_sequence(exp[2:], 'val', 'return'))
+
+# 組合せ
+
+def compile_application(exp, target, linkage):
+    proc_code = compile_exp(operator(exp), 'proc', 'next')
+    operand_codes = [compile_exp(operand, 'val', 'next') for operand in exp[1:]]
+    return preserving(['env', 'continue'], proc_code,
+        preserving(['proc', 'continue'], construct_arglist(operand_codes),
+                   compile_procedure_call(target, linkage)))
+
+# 引数リストは評価器と同じくadjoin-argで作る(左から順に評価して積む).
+def construct_arglist(operand_codes):
+    code = make_instruction_sequence([], ['argl'], [assign('argl', op('empty-arglist'))])
+    for operand_code in operand_codes:
+        code = preserving(['env'], code,
+            preserving(['argl'], operand_code,
+                make_instruction_sequence(['val', 'argl'], ['argl'],
+                                          [assign('argl', op('adjoin-arg'),
+                                                  reg('val'), reg('argl'))])))
+    return code
+
+def compile_procedure_call(target, linkage):
+    primitive_branch = make_label('primitive-branch')
+    compiled_branch = make_label('compiled-branch')
+    compound_branch = make_label('compound-branch')
+    after_call = make_label('after-call')
+    if linkage == 'next':
+        compiled_linkage = after_call
+    else:
+        compiled_linkage = linkage
+
+    return append_instruction_sequences(
+        make_instruction_sequence(['proc'], [],
+                                  [test(op('primitive-procedure?'), reg('proc')),
+                                   branch(label(primitive_branch)),
+                                   test(op('compound-procedure?'), reg('proc')),
+                                   branch(label(compound_branch))]),
+        parallel_instruction_sequences(
+            append_instruction_sequences(compiled_branch,
+                                         compile_proc_appl(target, compiled_linkage)),
+            parallel_instruction_sequences(
+                append_instruction_sequences(compound_branch,
+                                             compound_proc_appl(target, compiled_linkage)),
+                append_instruction_sequences(
+                    primitive_branch,
+                    end_with_linkage(linkage,
+                        make_instruction_sequence(['proc', 'argl'], [target],
+                                                  [assign(target, op('apply-primitive-procedure'),
+                                                          reg('proc'), reg('argl'))]))))),
+        after_call)
+
+def compile_proc_appl(target, linkage):
+    entry = [assign('val', op('compiled-procedure-entry'), reg('proc')),
+             goto(reg('val'))]
+    return procedure_call_linkage(target, linkage, ['proc'], [], entry)
+
+# 評価器の手続きはcompound-applyへ飛んで評価させる.
+# 評価器は手続き本体の最後でcontinueをスタックから戻すので, 先に積んでおく.
+def compound_proc_appl(target, linkage):
+    entry = [save('continue'), goto(label(Ident(u'compound-apply')))]
+    return procedure_call_linkage(target, linkage, ['proc'], [], entry)
+
+def procedure_call_linkage(target, linkage, needs, modifies, entry):
+    if target == 'val' and linkage != 'return':
+        return make_instruction_sequence(needs, all_regs,
+                                         [assign('continue', label(linkage))] + entry)
+    elif target != 'val' and linkage != 'return':
+        proc_return = make_label('proc-return')
+        return make_instruction_sequence(needs, all_regs,
+                                         [assign('continue', label(proc_return))] + entry +
+                                         [proc_return,
+                                          assign(target, reg('val')),
+                                          goto(label(linkage))])
+    elif target == 'val' and linkage == 'return':
+        return make_instruction_sequence(needs + ['continue'], all_regs, entry)
+    raise CompileError('return linkage, target not val', target)
+
+# トップレベルの式の列を翻訳する. 値はvalに入れ, continueへ戻る.
+def compile_program(source):
+    exps = [annotate_lexical_addresses(exp) for exp in read(source)]
+    return compile_sequence(exps, 'val', 'return')
+
+# sourceを翻訳して評価器のコントローラの後ろにつないだ機械を作る.
+# コントローラの先頭には翻訳したコードの入口へ飛ぶ命令を置くので, 機械を動かすと
+# (start()のたびに)まず翻訳したコードを実行し(external-entry), そのあとは評価器のREPLに入る.
+# 評価器はコントローラの末尾のラベル(ec-eval-done)に飛んで止まるので,
+# 翻訳したコードはそのラベルの前に入れる.
+def compile_and_go(source, batch=None, backend='interpret', operations=None):
+    global label_counter
+    outer, label_counter = label_counter, itertools.count(1)
+    try:
+        entry = make_label('compiled-program')
+        code = statements(compile_program(source))
+    finally:
+        label_counter = outer
+    eceval = eceval_controller()
+    controller = ([assign('val', label(entry)), goto(label(Ident(u'external-entry')))] +
+                  eceval[:-1] + [entry] + code + eceval[-1:])
+    return make_eceval(batch, backend, operations, controller)
+
+# libraryを翻訳して定義してから, sourceの式を評価器で評価する.
+# 戻り値はeval_programと同じく, sourceのトップレベルの式それぞれの値.
+def eval_with_compiled_library(library, source, backend='interpret'):
+    batch = BatchInput(source)
+    compile_and_go(library, batch, backend).start()
+    return batch.results[1:]
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+from eccompiler import *
+import unittest, tempfile, os, shutil
+
+library = """
+  (define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+  (define (make-counter n)
+    (lambda () (set! n (+ n 1)) n))
+  (define (outer x)
+    (define y (* x 2))
+    (define (inner z) (+ x y z))
+    (inner 1))
+  (define (apply-twice f x) (f (f x)))
+  (define (compiled-quote) '(a b))
+  """
+
+class TestCompiler(unittest.TestCase):
+
+    def test_instruction_sequence(self):
+        seq = compile_exp(read("(f x)")[0], 'val', 'next')
+        self.assertEqual(registers_needed(seq), ['env'])
+        self.assertTrue('continue' in registers_modified(seq))
+        seq = compile_exp(read("1")[0], 'val', 'return')
+        self.assertEqual(statements(seq),
+                         [assign('val', const(1)), goto(reg('continue'))])
+
+    def test_preserving(self):
+        seq1 = make_instruction_sequence([], ['env'], [])
+        seq2 = make_instruction_sequence(['env'], [], [])
+        self.assertEqual(statements(preserving(['env'], seq1, seq2)),
+                         [save('env'), restore('env')])
+        self.assertEqual(statements(preserving(['val'], seq1, seq2)), [])
+
+    def test_compiled_code(self):
+        source = """
+          (fib 10)
+          (define c (make-counter 10))
+          (c)
+          (c)
+          (outer 5)
+          (compiled-quote)
+          """
+        expected = eval_program(library + source)[5:]
+        for backend in ('interpret', 'closure', 'block'):
+            self.assertEqual(eval_with_compiled_library(library, source, backend), expected)
+
+    # 評価器の手続きを翻訳した手続きに渡す, 翻訳した手続きが返した手続きを評価器で呼ぶ
+    def test_interop(self):
+        source = """
+          (define (add1 x) (+ x 1))
+          (apply-twice add1 5)
+          (apply-twice (lambda (x) (* x x)) 3)
+          (apply-twice (lambda (f) (lambda (x) (f (f x)))) add1)
+          ((apply-twice (lambda (f) (lambda (x) (f (f x)))) add1) 0)
+          """
+        results = eval_with_compiled_library(library, source)
+        self.assertEqual(results[1:3], [7, 81])
+        self.assertEqual(results[4], 4)
+
+    def test_compiled_calls_interpreted(self):
+        results = eval_with_compiled_library(
+            "(define (call-g x) (g x))",
+            "(define (g x) (* x 3)) (call-g 4)")
+        self.assertEqual(results, [Ident(u'ok'), 12])
+
+    # start()のたびに翻訳したコードを実行してからREPLに入る. レジスタの残りには左右されない
+    def test_restart(self):
+        for backend in ('interpret', 'closure', 'block'):
+            batch = BatchInput("(fib 10)")
+            mac = compile_and_go("(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))",
+                                 batch, backend)
+            self.assertEqual(mac.start(), 'done')
+            self.assertEqual(mac.start(), 'done')
+            self.assertEqual(batch.results, [Ident(u'ok'), 55, Ident(u'ok')])
+
+    # 翻訳したコードの途中で保存した機械(命令文に字句アドレスの定数を含む)を,
+    # 同じソースを翻訳し直した機械に復元する
+    def test_compiled_snapshot(self):
+        program = library + "(define v (fib 12))"
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'compiled.snapshot')
+            for backend in ('interpret', 'closure', 'block'):
+                mac = compile_and_go(program, BatchInput(""), backend)
+                self.assertEqual(mac.start(limit=5000).reason, 'limit')
+                write_eceval_snapshot(mac, path)
+                batch = BatchInput("v (outer 5)")
+                compile_program("(lambda (x) (if x 1 2))")
+                restored = compile_and_go(program, batch, backend)
+                self.assertEqual(controller_digest(restored), controller_digest(mac))
+                read_eceval_snapshot(path, restored)
+                self.assertEqual(restored.proceed(), 'done')
+                self.assertEqual(batch.results, [Ident(u'ok'), 144, 16])
+                self.assertRaises(BadSnapshotError, read_eceval_snapshot,
+                                  path, make_eceval(batch, backend))
+        finally:
+            shutil.rmtree(directory)
+
+    # 翻訳したコードのトレースを書き出して再生する. 字句アドレスの定数はreprで残る
+    def test_compiled_trace(self):
+        from replay import read_trace
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'compiled.trace')
+            for backend in ('interpret', 'closure', 'block'):
+                mac = compile_and_go(library + "(fib 8)", BatchInput(""), backend)
+                tracer = mac.enable_tracing(1000)
+                mac.start()
+                write_trace(tracer, path)
+                trace = read_trace(path)
+                self.assertEqual(len(trace), 1000)
+                last = trace.first + len(trace) - 1
+                self.assertEqual(trace.state_at(last)['pc'], None)
+                self.assertEqual(trace.state_at(last)['val'], get_register_contents(mac, 'val'))
+                self.assertTrue([Ident(u'const'), Symbol(u'#<LexicalAddress(0, 0, n)>')] in
+                                [operand for text in trace.texts if isinstance(text, list)
+                                 for operand in text])
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os, sys
 from machine import *
 
 class VariableUnassignedError(Error): pass
 class UnboundVariableSetError(Error): pass
+class ArgumentCountError(Error): pass
 
 def is_self_evaluating(exp):
     if isinstance(exp, int): return True
@@ -14,43 +16,99 @@ def is_self_evaluating(exp):
 
     return False
 
+# 特殊形式と手続きのタグ. 識別子と記号は綴りごとに1つのオブジェクトなので
+# タグはisで比べる. 文字列や, 同じ綴りでも種類の違う記号とは一致しない.
+quote_tag = Ident(u'quote')
+assignment_tag = Ident(u'set!')
+definition_tag = Ident(u'define')
+if_tag = Ident(u'if')
+lambda_tag = Ident(u'lambda')
+begin_tag = Ident(u'begin')
+procedure_tag = Symbol(u'procedure')
+primitive_tag = Symbol(u'primitive')
+compiled_procedure_tag = Symbol(u'compiled-procedure')
+
+def is_tagged(exp, tag):
+    return isinstance(exp, list) and len(exp) > 0 and exp[0] is tag
+
 def is_variable(exp):
     if isinstance(exp, Ident): return True
 
     return False
 
 def is_quoted(exp):
-    return is_tagged_list(exp, 'quote')
+    return is_tagged(exp, quote_tag)
 
 def is_assignment(exp):
-    return is_tagged_list(exp, 'set!')
+    return is_tagged(exp, assignment_tag)
 
 def is_definition(exp):
-    return is_tagged_list(exp, 'define')
+    return is_tagged(exp, definition_tag)
 
 def is_if(exp):
-    return is_tagged_list(exp, 'if')
+    return is_tagged(exp, if_tag)
 
 def is_lambda(exp):
-    return is_tagged_list(exp, 'lambda')
+    return is_tagged(exp, lambda_tag)
 
 def is_begin(exp):
-    return is_tagged_list(exp, 'begin')
+    return is_tagged(exp, begin_tag)
 
 def begin_actions(exp):
-    return exp[1:]
+    return Cursor(exp, 1)
 
 def is_application(exp):
     return isinstance(exp, list)
 
-def lookup_variable_value(exp, env):
-    env_rev = env[:]
-    env_rev.reverse()
-    for frame in env_rev:
-        if frame.has_key(exp):
-            return frame[exp]
+# eval-dispatchのdispatch命令が使う式の分類. 特殊形式はタグから表を一度引くだけで決まる.
+# 分類の名前も識別子にしておき, dispatch命令の表(キーは読み込んだ識別子)をisで引く.
+self_evaluating_type = Ident(u'self-evaluating')
+lexical_address_type = Ident(u'lexical-address')
+variable_type = Ident(u'variable')
+quoted_type = Ident(u'quoted')
+assignment_type = Ident(u'assignment')
+definition_type = Ident(u'definition')
+if_type = Ident(u'if')
+lambda_type = Ident(u'lambda')
+begin_type = Ident(u'begin')
+application_type = Ident(u'application')
+unknown_type = Ident(u'unknown')
+
+special_form_types = {
+    quote_tag : quoted_type,
+    assignment_tag : assignment_type,
+    definition_tag : definition_type,
+    if_tag : if_type,
+    lambda_tag : lambda_type,
+    begin_tag : begin_type,
+    }
 
-    raise VariableUnassignedError()
+def expression_type(exp):
+    if isinstance(exp, list):
+        if exp and isinstance(exp[0], Ident):
+            return special_form_types.get(exp[0], application_type)
+        return application_type
+    elif is_lexical_address(exp):
+        return lexical_address_type
+    elif is_variable(exp):
+        return variable_type
+    elif is_self_evaluating(exp):
+        return self_evaluating_type
+    return unknown_type
+
+def lookup_variable_value(exp, env):
+    while env:
+        index = env.index
+        if index is not None:
+            if exp in index:
+                return env.values[index[exp]]
+        else:
+            vars = env.variables
+            if exp in vars:
+                return env.values[vars.index(exp)]
+        env = env.parent
+
+    raise VariableUnassignedError(exp)
 
 def text_of_quotation(exp):
     return exp[1]
@@ -59,47 +117,89 @@ def lambda_parameters(exp):
     return exp[1]
 
 def lambda_body(exp):
-    return exp[2:]
+    return Cursor(exp, 2)
 
 def make_procedure(parameters, body, env): # parameter, body, env
-    return [Symbol(u'procedure')] + [parameters, body, env]
+    return [procedure_tag, parameters, body, env]
+
+# 式のリストの中の位置を指すカーソル. 被演算子の列や手続き本体の式の列は
+# リストを切り出さずにカーソルで表すので, 列をたどる操作はどれも定数時間になる.
+class Cursor(object):
+    __slots__ = ('items', 'index')
+
+    def __init__(self, items, index):
+        self.items = items
+        self.index = index
+
+    def __repr__(self):
+        return 'Cursor(%r)' % (self.items[self.index:],)
 
 def operands(exp):
-    return exp[1:]
+    return Cursor(exp, 1)
 
 def operator(exp):
     return exp[0]
 
+# 引数リストは(最後の引数, それより前の引数リスト)というタプルの対を連ねたもので,
+# 引数を評価した順とは逆に並ぶ. adjoin-argは対をひとつ作るだけで済む.
 def empty_arglist():
-    return []
+    return ()
 
-def is_no_operands(exp):
-    return 0 == len(exp)
+def is_no_operands(ops):
+    return ops.index == len(ops.items)
 
-def first_operand(exp):
-    return exp[0]
+def first_operand(ops):
+    return ops.items[ops.index]
 
-def is_last_operand(exp):
-    return 1 == len(exp)
+def is_last_operand(ops):
+    return ops.index + 1 == len(ops.items)
 
 def adjoin_arg(arg, arglist):
-    return arglist + [arg]
+    return (arg, arglist)
 
-def rest_operands(exp):
-    return exp[1:]
+def rest_operands(ops):
+    return Cursor(ops.items, ops.index + 1)
+
+def arglist_to_list(arglist):
+    args = []
+    while arglist:
+        arg, arglist = arglist
+        args.append(arg)
+    args.reverse()
+    return args
 
 def is_primitive_procedure(exp):
-    return is_tagged_list(exp, 'primitive')
+    return is_tagged(exp, primitive_tag)
 
 def is_compound_procedure(exp):
-    return is_tagged_list(exp, 'procedure')
+    return is_tagged(exp, procedure_tag)
+
+# コンパイルされた手続き(eccompiler.py). entryは手続き本体の入口のラベル(オフセット).
+def make_compiled_procedure(entry, env):
+    return [compiled_procedure_tag, entry, env]
+
+def is_compiled_procedure(exp):
+    return is_tagged(exp, compiled_procedure_tag)
+
+def compiled_procedure_entry(proc):
+    return proc[1]
+
+def compiled_procedure_env(proc):
+    return proc[2]
 
 the_primitive_procs = {
     '+' : lambda *args: reduce(lambda x,y: x+y, args),
+    '-' : lambda x, y: x - y,
+    '*' : lambda *args: reduce(lambda x,y: x*y, args),
+    '=' : lambda x, y: x == y,
+    '<' : lambda x, y: x < y,
+    '>' : lambda x, y: x > y,
     }
     
-# 引数argsはリストになっている.
+# 引数argsは引数リスト(adjoin-argで作ったもの)か, 値のリスト.
 def apply_primitive_procedure(proc, args):
+    if isinstance(args, tuple):
+        args = arglist_to_list(args)
     return proc[1](*args)
 
 def procedure_parameters(proc):
@@ -112,16 +212,79 @@ def procedure_environment(proc):
     return proc[3]
 
 def extend_environment(vars, vals, base_env):
-    return [dict(zip(vars, vals))] + base_env
+    if isinstance(vals, tuple):
+        vals = arglist_to_list(vals)
+    else:
+        vals = list(vals)
+    if len(vars) != len(vals):
+        raise ArgumentCountError(vars, vals)
+    return make_frame(vars, vals, base_env)
+
+# 環境は最も内側のフレームで表し, 各フレームは外側のフレームをparentで指す.
+# 空の環境は()(空リスト)かNoneで, 外側の環境は手続きどうしで共有される.
+#
+# フレームの変数のリストは手続きの仮引数のリストをそのまま共有する.
+# 定義で変数が増えるフレーム(大域環境や内部定義のある手続きのフレーム)には
+# 変数 -> オフセットの索引indexを作り, そのときに一度だけ変数のリストを複製する.
+# 以後の定義はリストに追加するだけで, 変数の探索は索引を引く.
+class Frame(object):
+    __slots__ = ('variables', 'values', 'parent', 'index')
+
+    def __init__(self, variables, values, parent, index=None):
+        self.variables = variables
+        self.values = values
+        self.parent = parent
+        self.index = index
+
+    def __repr__(self):
+        return 'Frame(%r, %r)' % (self.variables, self.values)
+
+the_empty_environment = []
+
+def make_frame(variables, values, parent=the_empty_environment):
+    return Frame(variables, values, parent)
+
+def first_frame(env):
+    return env
+
+def enclosing_environment(env):
+    return env.parent
+
+def frame_variables(frame):
+    return frame.variables
+
+def frame_values(frame):
+    return frame.values
+
+def index_frame(frame):
+    if frame.index is None:
+        frame.variables = list(frame.variables)
+        index = {}
+        for offset in xrange(len(frame.variables) - 1, -1, -1):
+            index[frame.variables[offset]] = offset
+        frame.index = index
+    return frame.index
+
+def frame_offset(var, frame):
+    if frame.index is not None:
+        return frame.index.get(var)
+    if var in frame.variables:
+        return frame.variables.index(var)
+    return None
+
+def add_binding_to_frame(var, val, frame):
+    index_frame(frame)[var] = len(frame.variables)
+    frame.variables.append(var)
+    frame.values.append(val)
 
 def first_exp(seq):
-    return seq[0]
+    return seq.items[seq.index]
 
 def rest_exps(seq):
-    return seq[1:]
+    return Cursor(seq.items, seq.index + 1)
 
 def is_last_exp(seq):
-    return 1 == len(seq)
+    return seq.index + 1 == len(seq.items)
 
 def if_predicate(exp):
     return exp[1]
@@ -142,55 +305,199 @@ def assignment_value(exp):
     return exp[2]
 
 def set_variable_value(var, val, env):
-    for frame in env:
-        if frame.has_key(var):
-            frame[var] = val
-            break
-    else:
-        raise UnboundVariableSetError()
+    while env:
+        offset = frame_offset(var, env)
+        if offset is not None:
+            env.values[offset] = val
+            return
+        env = env.parent
+
+    raise UnboundVariableSetError(var)
 
 def definition_variable(exp):
-    if isinstance(exp[1], Symbol):
+    if not isinstance(exp[1], list):
         return exp[1]
     else:
         return exp[1][0]
 
 def definition_value(exp):
-    if isinstance(exp[1], Symbol):
+    if not isinstance(exp[1], list):
         return exp[2]
     else:
         return make_lambda(exp[1][1:], exp[2:])
 
 def make_lambda(parameters, body):
-    return [Symbol("lambda"), parameters, body]
+    return [lambda_tag, parameters] + body
 
 def define_variable(var, val, env):
-    env[0][var] = val
+    frame = first_frame(env)
+    offset = frame_offset(var, frame)
+    if offset is not None:
+        frame.values[offset] = val
+    else:
+        add_binding_to_frame(var, val, frame)
 
 def setup_environment():
-    env = dict(the_primitive_procs)
-    for key in env.keys():
-        env[key] = [Symbol('primitive'), env[key]]
-    env.update({Symbol('true'): True})
-    env.update({Symbol('false'): False})
-
-    initial_env = [env]
+    vars = [Ident(name) for name in the_primitive_procs.keys()]
+    vals = [[primitive_tag, proc] for proc in the_primitive_procs.values()]
+    initial_env = extend_environment(vars + [Ident(u'true'), Ident(u'false')],
+                                     vals + [True, False],
+                                     the_empty_environment)
+    index_frame(initial_env)
     return initial_env
 
-the_global_environment = setup_environment()
+# 字句アドレス
+#
+# lambdaの仮引数で束縛される変数への参照を, 実行前に(フレーム番号, オフセット)の組へ
+# 置き換えておく. フレーム番号は内側から数える. 内部定義される変数と大域変数は
+# 名前のまま残し, これまでどおり名前で探す.
+
+class LexicalAddress(object):
+    __slots__ = ('frame', 'offset', 'name')
+
+    def __init__(self, frame, offset, name):
+        self.frame = frame
+        self.offset = offset
+        self.name = name
+
+    def __repr__(self):
+        return 'LexicalAddress(%d, %d, %s)' % (self.frame, self.offset, self.name)
+
+def is_lexical_address(exp):
+    return isinstance(exp, LexicalAddress)
+
+def lexical_address_lookup(address, env):
+    depth = address.frame
+    while depth:
+        env = env.parent
+        depth -= 1
+    return env.values[address.offset]
+
+def lexical_address_set(address, val, env):
+    depth = address.frame
+    while depth:
+        env = env.parent
+        depth -= 1
+    env.values[address.offset] = val
+
+# scopesは内側から順に並べた(仮引数のリスト, 内部定義される変数のリスト)
+def find_variable(var, scopes):
+    for depth, (parameters, defined) in enumerate(scopes):
+        if var in parameters:
+            return LexicalAddress(depth, parameters.index(var), var)
+        if var in defined:
+            return var
+
+    return var
+
+def scan_out_defines(body):
+    defined = []
+    pending = list(body)
+    while pending:
+        exp = pending.pop()
+        if not isinstance(exp, list) or is_quoted(exp) or is_lambda(exp):
+            continue
+        if is_definition(exp):
+            defined.append(definition_variable(exp))
+            if not isinstance(exp[1], list):
+                pending.append(exp[2])
+        else:
+            pending.extend(exp)
+
+    return defined
+
+def annotate_lexical_addresses(exp, scopes=()):
+    if is_variable(exp):
+        return find_variable(exp, scopes)
+    elif not isinstance(exp, list) or exp == [] or is_quoted(exp):
+        return exp
+    elif is_lambda(exp):
+        return annotate_procedure(exp[:2], lambda_parameters(exp), exp[2:], scopes)
+    elif is_definition(exp):
+        if isinstance(exp[1], list):
+            return annotate_procedure(exp[:2], exp[1][1:], exp[2:], scopes)
+        return exp[:2] + [annotate_lexical_addresses(e, scopes) for e in exp[2:]]
+    elif is_assignment(exp):
+        return [exp[0], find_variable(assignment_variable(exp), scopes)] + \
+            [annotate_lexical_addresses(e, scopes) for e in exp[2:]]
+    elif is_if(exp) or is_begin(exp):
+        return exp[:1] + [annotate_lexical_addresses(e, scopes) for e in exp[1:]]
+    else:
+        return [annotate_lexical_addresses(e, scopes) for e in exp]
+
+def annotate_procedure(head, parameters, body, scopes):
+    scopes = ((parameters, scan_out_defines(body)),) + tuple(scopes)
+    return head + [annotate_lexical_addresses(e, scopes) for e in body]
+
+# 大域環境はimportのときには作らず, 最初に使うときに作る
+the_global_environment = None
 
 def get_global_environment():
+    global the_global_environment
+    if the_global_environment is None:
+        the_global_environment = setup_environment()
     return the_global_environment
 
+# 機械ごとの大域環境. 既定ではプロセスの大域環境を使い,
+# スナップショットを復元した機械だけが復元した環境を持つ(read_eceval_snapshot).
+class MachineEnvironment(object):
+    __slots__ = ('environment',)
+
+    def __init__(self):
+        self.environment = None
+
+    def get(self):
+        if self.environment is None:
+            return get_global_environment()
+        return self.environment
+
+# 入力の終わり. 読み込んだ記号'eofと区別するため, 記号ではないオブジェクトにする.
+class EofObject(object):
+    def __repr__(self):
+        return '#<eof>'
+
+the_eof_object = EofObject()
+
+def is_eof_object(exp):
+    return exp is the_eof_object
+
+# 式をstream(省略すると標準入力)から1つずつ読み込む入力.
+# 複数行にわたる式も読め, 式が読めたところですぐに評価を始める.
 class Input(object):
-    input_line = ""
+
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.data = None
 
     def prompt_for_input(self,prompt):
-        self.input_line = raw_input(prompt + "\n")
-        print self.input_line
+        print prompt
 
     def read_input_line(self):
-        return read(self.input_line)[0]
+        if self.data is None:
+            self.data = Reader().iter_read(self.stream or sys.stdin, 'utf-8')
+        return next(self.data, the_eof_object)
+
+# 文字列かstreamから式を順に読み込んで評価させる入力. 印字される値はresultsにためる.
+class BatchInput(Input):
+
+    def __init__(self, source):
+        if isinstance(source, basestring):
+            self.pending = iter(read(source))
+        else:
+            self.pending = Reader().iter_read(source, 'utf-8')
+        self.results = []
+
+    def prompt_for_input(self, prompt):
+        pass
+
+    def read_input_line(self):
+        return next(self.pending, the_eof_object)
+
+    def announce_output(self, string):
+        pass
+
+    def user_print(self, object):
+        self.results.append(object)
 
 cinput = Input()
 
@@ -217,7 +524,13 @@ ops = {
     'begin?' : is_begin,
     'begin-actions' : begin_actions,
     'application?' : is_application,
+    'expression-type' : expression_type,
     'lookup-variable-value' : lookup_variable_value,
+    'lexical-address?' : is_lexical_address,
+    'lexical-address-lookup' : lexical_address_lookup,
+    'lexical-address-set!' : lexical_address_set,
+    'annotate-lexical-addresses' : annotate_lexical_addresses,
+    'analyze-expression' : annotate_lexical_addresses,
     'text-of-quotation' : text_of_quotation,
     'lambda-parameters' : lambda_parameters,
     'lambda-body' : lambda_body,
@@ -232,6 +545,10 @@ ops = {
     'rest-operands' : rest_operands,
     'primitive-procedure?' : is_primitive_procedure,
     'compound-procedure?' : is_compound_procedure,
+    'compiled-procedure?' : is_compiled_procedure,
+    'make-compiled-procedure' : make_compiled_procedure,
+    'compiled-procedure-entry' : compiled_procedure_entry,
+    'compiled-procedure-env' : compiled_procedure_env,
     'apply-primitive-procedure' : apply_primitive_procedure,
     'procedure-environment' : procedure_environment,
     'procedure-parameters' : procedure_parameters,
@@ -253,17 +570,90 @@ ops = {
     'get-global-environment' : get_global_environment,
     'prompt-for-input' : cinput.prompt_for_input,
     'read' : cinput.read_input_line,
+    'eof-object?' : is_eof_object,
     'announce-output' : announce_output,
     'user-print' : user_print,
     'true?': is_true,
     'false?' : is_false,
 }
 
+eceval_registers = ['exp', 'env', 'val', 'proc', 'argl', 'continue', 'unev']
+
+eceval_controller_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'evaluator.scm')
+
+def eceval_controller_text():
+    f = open(eceval_controller_path)
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+# evaluator.scmを読み込んだコントローラ(命令とラベルのリスト)
+def eceval_controller():
+    f = open(eceval_controller_path)
+    try:
+        return next(Reader().iter_read(f, 'utf-8'))
+    finally:
+        f.close()
+
+# batchにBatchInputを与えると, その式を順に評価して入力が尽きたところで停止する.
+# operationsには演算の表を差し替えるときに渡す(analyzer.analyzed_opsなど).
+# controllerにはコンパイルしたコードを後ろにつないだコントローラなどを渡す.
+# cache(またはMACHINE_PROGRAM_CACHE)があるときは, evaluator.scmを読み込まずに
+# 文字列のままキャッシュへ渡し, アセンブル済みのイメージを使う.
+# stackはmake_machineと同じ(スタックの統計を取るときはInstrumentedStack()).
+# get-global-environmentは機械ごとの大域環境(MachineEnvironment)を返すものに差し替える.
+def make_eceval(batch=None, backend='interpret', operations=None, controller=None, cache=None,
+                stack=None):
+    environment = MachineEnvironment()
+    eceval_ops = dict(operations or ops)
+    eceval_ops['get-global-environment'] = environment.get
+    if batch is not None:
+        eceval_ops.update({
+                'prompt-for-input' : batch.prompt_for_input,
+                'read' : batch.read_input_line,
+                'announce-output' : batch.announce_output,
+                'user-print' : batch.user_print,
+                })
+    cache = cache or default_program_cache()
+    if controller is None:
+        controller = eceval_controller_text() if cache else eceval_controller()
+    machine = make_machine(eceval_registers, eceval_ops, controller, backend, cache, stack)
+    machine.eceval_environment = environment
+    return machine
+
+# sourceの式をすべて評価し, トップレベルの式それぞれの値をリストで返す
+def eval_program(source, backend='interpret', operations=None):
+    batch = BatchInput(source)
+    make_eceval(batch, backend, operations).start()
+    return batch.results
+
+# 評価器の機械のスナップショット. 機械の大域環境も一緒に保存し, 復元した機械は
+# 復元した大域環境を使う. 他の機械やプロセスの大域環境は変わらないので,
+# ひとつのスナップショットから互いに独立した機械をいくつでも作れる.
+# 基本手続きは名前で保存し, 復元する側の基本手続きにつなぐ.
+# ライブラリを評価し終えた機械を保存しておけば, 復元してstart()で新しい入力を評価させられる.
+def eceval_externals():
+    externals = dict(('primitive:' + name, proc) for name, proc in the_primitive_procs.items())
+    externals['eof-object'] = the_eof_object
+    return externals
+
+def eceval_global_environment(machine):
+    return machine.eceval_environment.get()
+
+def write_eceval_snapshot(machine, path):
+    write_snapshot(machine, path, {'global-environment': eceval_global_environment(machine)},
+                   eceval_externals())
+
+def read_eceval_snapshot(path, machine):
+    roots = read_snapshot(path, machine, eceval_externals())
+    machine.eceval_environment.environment = roots['global-environment']
+
+# 使い方: python evaluator.py [ファイル]
+# ファイルを与えるとその式を順に評価する. 省略すると標準入力から読む.
 if __name__ == '__main__':
-    f = open("./evaluator.scm")
-    input = reduce(lambda x,y: x+y, f.readlines())
-    mac = make_machine(['exp', 'env', 'val', 'proc', 'argl', 'continue', 'unev'],
-                       ops,
-                       input)
+    if sys.argv[1:]:
+        cinput.stream = open(sys.argv[1])
+    mac = make_eceval()
     mac.start()
 
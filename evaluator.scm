@@ -5,39 +5,38 @@
  (perform
   (op prompt-for-input) (const ";;; EC-Eval input:"))
  (assign exp (op read))
+ (test (op eof-object?) (reg exp))
+ (branch (label ec-eval-done))
+ (assign exp (op analyze-expression) (reg exp))
  (assign env (op get-global-environment))
  (assign continue (label print-result))
  (goto (label eval-dispatch))
 
  eval-dispatch
- (test (op self-evaluating?) (reg exp))
- (branch (label ev-self-eval))
- (test (op variable?) (reg exp))
- (branch (label ev-variable))
- (test (op quoted?) (reg exp))
- (branch (label ev-quoted))
- (test (op assignment?) (reg exp))
- (branch (label ev-assignment))
- (test (op definition?) (reg exp))
- (branch (label ev-definition))
- (test (op if?) (reg exp))
- (branch (label ev-if))
- (test (op lambda?) (reg exp))
- (branch (label ev-application))
- (test (op begin?) (reg exp))
- (branch (label ev-begin))
- (test (op application?) (reg exp))
- (branch (label ev-application))
- (goto (label unknown-expression-type))
+ (dispatch (op expression-type) (reg exp)
+	   ((self-evaluating ev-self-eval)
+	    (lexical-address ev-lexical-address)
+	    (variable ev-variable)
+	    (quoted ev-quoted)
+	    (assignment ev-assignment)
+	    (definition ev-definition)
+	    (if ev-if)
+	    (lambda ev-lambda)
+	    (begin ev-begin)
+	    (application ev-application))
+	   (label unknown-expression-type))
 
  ev-self-eval
- (perform (op announce-output) (const "ev-self-eval"))
  (assign val (reg exp))
  (goto (reg continue))
  
  ev-variable
  (assign val (op lookup-variable-value) (reg exp) (reg env))
  (goto (reg continue))
+
+ ev-lexical-address
+ (assign val (op lexical-address-lookup) (reg exp) (reg env))
+ (goto (reg continue))
  
  ev-quoted
  (assign val (op text-of-quotation) (reg exp))
@@ -51,7 +50,6 @@
  (goto (reg continue))
 
  ev-application
- (perform (op announce-output) (const "ev-application"))
  (save continue)
  (save env)
  (assign unev (op operands) (reg exp))
@@ -61,7 +59,6 @@
  (goto (label eval-dispatch))
 
  ev-appl-did-operator
- (perform (op announce-output) (const "ev-appl-did-operator"))
  (restore unev)
  (restore env)
  (assign argl (op empty-arglist))
@@ -99,14 +96,19 @@
  (goto (label apply-dispatch))
 
  apply-dispatch
- (perform (op announce-output) (const "apply-dispatch"))
- (perform (op user-print) (reg proc))
  (test (op primitive-procedure?) (reg proc))
  (branch (label primitive-apply))
  (test (op compound-procedure?) (reg proc))
  (branch (label compound-apply))
+ (test (op compiled-procedure?) (reg proc))
+ (branch (label compiled-apply))
  (goto (label unknown-procedure-type))
 
+ compiled-apply
+ (restore continue)
+ (assign val (op compiled-procedure-entry) (reg proc))
+ (goto (reg val))
+
  primitive-apply
  (assign val (op apply-primitive-procedure)
 	 (reg proc)
@@ -139,6 +141,7 @@
  (restore env)
  (restore unev)
  (assign unev (op rest-exps) (reg unev))
+ (goto (label ev-sequence))
  ev-sequence-last-exp
  (restore continue)
  (goto (label eval-dispatch))
@@ -175,10 +178,17 @@
  (restore continue)
  (restore env)
  (restore unev)
+ (test (op lexical-address?) (reg unev))
+ (branch (label ev-assignment-lexical))
  (perform
   (op set-variable-value!) (reg unev) (reg val) (reg env))
  (assign val (const ok))
  (goto (reg continue))
+ ev-assignment-lexical
+ (perform
+  (op lexical-address-set!) (reg unev) (reg val) (reg env))
+ (assign val (const ok))
+ (goto (reg continue))
 
  ev-definition
  (assign unev (op definition-variable) (reg exp))
@@ -197,6 +207,13 @@
  (assign val (const ok))
  (goto (reg continue))
 
+ ;; コンパイルしたコードの入口. valに入口のラベルを入れて飛んでくる(compile_and_go)
+ external-entry
+ (perform (op initialize-stack))
+ (assign env (op get-global-environment))
+ (assign continue (label print-result))
+ (goto (reg val))
+
  print-result
  (perform
   (op announce-output) (const ";;; EC-Eval value:"))
@@ -218,4 +235,6 @@
  (perform (op user-print) (reg val))
  (goto (label read-eval-print-loop))
 
+ ec-eval-done
+
 )
@@ -3,7 +3,30 @@
 
 from evaluator import *
 from simplesexp import *
-import unittest
+import unittest, StringIO, tempfile, os, shutil, subprocess, sys
+
+def frames_as_dicts(env):
+    frames = []
+    while env:
+        frame = first_frame(env)
+        frames.append(dict(zip(frame_variables(frame), frame_values(frame))))
+        env = enclosing_environment(env)
+    return frames
+
+def make_env(*frames):
+    env = the_empty_environment
+    for vars, vals in reversed(frames):
+        env = extend_environment(vars, vals, env)
+    return env
+
+snapshot_check = """
+from evaluator import *
+batch = BatchInput("(c) (fib 10) (c)")
+mac = make_eceval(batch)
+read_eceval_snapshot(%r, mac)
+mac.start()
+print ' '.join(map(str, batch.results))
+"""
 
 class TestEvaluator(unittest.TestCase):
     
@@ -51,21 +74,41 @@ class TestEvaluator(unittest.TestCase):
         self.assertFalse(is_application(read("'a")[0]))
         self.assertTrue(is_application(read("(+ a b)")[0]))
 
+    def test_expression_type(self):
+        for source, type in [('1', 'self-evaluating'),
+                             ('x', 'variable'),
+                             ("'(1 2)", 'quoted'),
+                             ('(set! x 1)', 'assignment'),
+                             ('(define x 1)', 'definition'),
+                             ('(if x 1 2)', 'if'),
+                             ('(lambda (x) x)', 'lambda'),
+                             ('(begin 1 2)', 'begin'),
+                             ('(f 1 2)', 'application'),
+                             ('((lambda (x) x) 1)', 'application')]:
+            self.assertEqual(expression_type(read(source)[0]), type)
+        self.assertEqual(expression_type(LexicalAddress(0, 0, 'x')), 'lexical-address')
+        self.assertEqual(expression_type(None), 'unknown')
+
     def test_lookup_variable_value(self):
-        self.assertEqual(1 , lookup_variable_value('a', [{'a': 2}, {'a': 1}]))
-        self.assertEqual(2 , lookup_variable_value('a', [{'a': 2}, {'b': 1}]))
-        self.assertRaises(VariableUnassignedError, lookup_variable_value, 'c', [{'a': 2}, {'b': 1}])
+        # 内側のフレームから順に探す
+        self.assertEqual(2 , lookup_variable_value('a', make_env((['a'], [2]), (['a'], [1]))))
+        self.assertEqual(2 , lookup_variable_value('a', make_env((['a'], [2]), (['b'], [1]))))
+        self.assertEqual(1 , lookup_variable_value('b', make_env((['a'], [2]), (['b'], [1]))))
+        self.assertRaises(VariableUnassignedError, lookup_variable_value, 'c',
+                          make_env((['a'], [2]), (['b'], [1])))
 
     def test_text_of_quotation(self):
         self.assertEqual([1, 2, 3], text_of_quotation([Ident(u'quote'), [1, 2, 3]]))
         
     def test_first_operand(self):
         self.assertEqual(Ident(u'a'),
-                         first_operand(read("(a b c)")[0]))
+                         first_operand(operands(read("(f a b c)")[0])))
 
     def test_is_last_operand(self):
-        self.assertFalse(is_last_operand(read("(a b c)")))
-        self.assertTrue(is_last_operand([]))
+        self.assertFalse(is_last_operand(operands(read("(f a b c)")[0])))
+        self.assertTrue(is_last_operand(operands(read("(f c)")[0])))
+        self.assertTrue(is_last_operand(rest_operands(rest_operands(operands(read("(f a b c)")[0])))))
+        self.assertTrue(is_no_operands(operands(read("(f)")[0])))
 
     def test_empty_arglist(self):
         mac = make_machine(['argl'],
@@ -75,7 +118,7 @@ class TestEvaluator(unittest.TestCase):
                            )""")
         mac.start()
 
-        self.assertEqual(get_register_contents(mac, 'argl'), [])
+        self.assertEqual(arglist_to_list(get_register_contents(mac, 'argl')), [])
         
     def test_arglist(self):
         mac = make_machine(['argl'],
@@ -87,28 +130,26 @@ class TestEvaluator(unittest.TestCase):
                            )""")
         mac.start()
 
-        self.assertEqual(get_register_contents(mac, 'argl'), [1,2])
+        self.assertEqual(arglist_to_list(get_register_contents(mac, 'argl')), [1,2])
 
     def test_rest_operands(self):
-        mac = make_machine(['argl','a'],
+        mac = make_machine(['unev','a'],
                            ops,
                            """(
-                             (assign argl (op empty-arglist))
-                             (assign argl (op adjoin-arg) (const 1) (reg argl))
-                             (assign argl (op adjoin-arg) (const 2) (reg argl))
-                             (assign a (op rest-operands) (reg argl))
+                             (assign unev (op operands) (const (f 1 2)))
+                             (assign unev (op rest-operands) (reg unev))
+                             (assign a (op first-operand) (reg unev))
                            )""")
         mac.start()
 
-        self.assertEqual(get_register_contents(mac, 'a'), [2])
+        self.assertEqual(get_register_contents(mac, 'a'), 2)
+        self.assertTrue(is_last_operand(get_register_contents(mac, 'unev')))
 
     def test_is_primitive_procedure(self):
         mac = make_machine(['exp'],
                            ops,
                            """(
-                             (assign exp (op empty-arglist))
-                             (assign exp (op adjoin-arg) (const 'primitive) (reg exp))
-                             (assign exp (op adjoin-arg) (const 'test-func) (reg exp))
+                             (assign exp (const ('primitive test-func)))
                              (test (op primitive-procedure?) (reg exp))
                            )""")
         mac.start()
@@ -119,9 +160,7 @@ class TestEvaluator(unittest.TestCase):
         mac = make_machine(['exp'],
                            ops,
                            """(
-                             (assign exp (op empty-arglist))
-                             (assign exp (op adjoin-arg) (const 'procedure) (reg exp))
-                             (assign exp (op adjoin-arg) (const 'test-func) (reg exp))
+                             (assign exp (const ('procedure test-func)))
                              (test (op compound-procedure?) (reg exp))
                            )""")
         mac.start()
@@ -129,12 +168,19 @@ class TestEvaluator(unittest.TestCase):
         self.assertEqual(get_register_contents(mac, 'flag'), 1)
 
     def test_apply_primitive_procedure(self):
-        mac = make_machine(['val'],
+        mac = make_machine(['val', 'argl', 'env', 'proc'],
                            ops,
                            """(
+                             (assign env (op get-global-environment))
+                             (assign proc (op lookup-variable-value) (const +) (reg env))
+                             (assign argl (op empty-arglist))
+                             (assign argl (op adjoin-arg) (const 1) (reg argl))
+                             (assign argl (op adjoin-arg) (const 2) (reg argl))
+                             (assign argl (op adjoin-arg) (const 3) (reg argl))
+                             (assign argl (op adjoin-arg) (const 4) (reg argl))
                              (assign val (op apply-primitive-procedure)
-                                         (const ('primitive +))
-                                         (const 1) (const 2) (const 3) (const 4))
+                                         (reg proc)
+                                         (reg argl))
                            )""")
         mac.start()
         self.assertEqual(get_register_contents(mac, 'val'), 10)
@@ -152,7 +198,8 @@ class TestEvaluator(unittest.TestCase):
                                         (reg unev) (reg argl) (reg env))
                            )""")
         mac.start()
-        self.assertEqual(get_register_contents(mac, 'env'), [{Ident(u'x'):1, Ident(u'y'):2, Ident(u'z'):3}])
+        self.assertEqual(frames_as_dicts(get_register_contents(mac, 'env')),
+                         [{Ident(u'x'):1, Ident(u'y'):2, Ident(u'z'):3}])
 
     def test_set_variable_value(self):
         mac = make_machine(['proc', 'unev', 'env', 'argl'],
@@ -172,20 +219,212 @@ class TestEvaluator(unittest.TestCase):
                             (perform (op set-variable-value!) (const 'a) (const -1) (reg env))
                            )""")
         mac.start()
-        self.assertEqual(get_register_contents(mac, 'env'), [{Ident(u'a'):-1, Ident(u'b'):2, Ident(u'c'):3}, \
-                                                                 {Ident(u'x'):1, Ident(u'y'):2, Ident(u'z'):3}])
+        self.assertEqual(frames_as_dicts(get_register_contents(mac, 'env')),
+                         [{Ident(u'a'):-1, Ident(u'b'):2, Ident(u'c'):3}, \
+                              {Ident(u'x'):1, Ident(u'y'):2, Ident(u'z'):3}])
 
     def test_definition(self):
         mac = make_machine(['val', 'unev', 'env'],
                            ops,
                            """(
-                             (assign env (const ((dict ((a . 2))))))
+                             (assign env (op extend-environment) (const (a)) (const (2)) (const ()))
                              (assign unev (const a))
                              (assign val (const 1))
                              (perform (op define-variable!) (reg unev) (reg val) (reg env))
+                             (assign unev (const b))
+                             (perform (op define-variable!) (reg unev) (reg val) (reg env))
                            )""")
         mac.start()
-        self.assertEqual(get_register_contents(mac, 'env'), [{Ident(u'a'):1}])
+        self.assertEqual(frames_as_dicts(get_register_contents(mac, 'env')),
+                         [{Ident(u'a'):1, Ident(u'b'):1}])
+
+    def test_annotate_lexical_addresses(self):
+        exp = annotate_lexical_addresses(read("""
+          (lambda (x y)
+            (define (inner z) (+ x z))
+            (set! y 1)
+            (inner '(x y)))""")[0])
+        inner_body = exp[2][2]
+        self.assertEqual(repr(inner_body), repr([Ident(u'+'),
+                                                 LexicalAddress(1, 0, Ident(u'x')),
+                                                 LexicalAddress(0, 0, Ident(u'z'))]))
+        self.assertEqual(repr(exp[3][1]), repr(LexicalAddress(0, 1, Ident(u'y'))))
+        self.assertTrue(is_variable(exp[4][0]))
+        self.assertEqual(exp[4][1], read("'(x y)")[0])
+
+    def test_lexical_address_ops(self):
+        env = make_env((['a', 'b'], [1, 2]), (['c'], [3]))
+        self.assertEqual(lexical_address_lookup(LexicalAddress(0, 1, 'b'), env), 2)
+        self.assertEqual(lexical_address_lookup(LexicalAddress(1, 0, 'c'), env), 3)
+        lexical_address_set(LexicalAddress(1, 0, 'c'), 4, env)
+        self.assertEqual(lookup_variable_value('c', env), 4)
+
+    def test_shared_environment(self):
+        base = make_env((['x'], [1]))
+        env1 = extend_environment(['a'], [2], base)
+        env2 = extend_environment(['b'], [3], base)
+        self.assertTrue(enclosing_environment(env1) is enclosing_environment(env2))
+        set_variable_value('x', 4, env1)
+        self.assertEqual(lookup_variable_value('x', env2), 4)
+
+    # 定義で増えたフレームは索引を引く. 仮引数のリストは手続きと共有したまま書き換えない
+    def test_many_definitions(self):
+        params = ['a']
+        env = make_env((params, [1]))
+        for i in xrange(1000):
+            define_variable('g%d' % i, i, env)
+        define_variable('a', -1, env)
+        set_variable_value('g10', -10, env)
+        self.assertEqual(params, ['a'])
+        self.assertEqual(lookup_variable_value('a', env), -1)
+        self.assertEqual(lookup_variable_value('g10', env), -10)
+        self.assertEqual(lookup_variable_value('g999', env), 999)
+        self.assertEqual(len(frames_as_dicts(env)[0]), 1001)
+        library = ''.join('(define g%d %d)' % (i, i) for i in xrange(5000))
+        self.assertEqual(eval_program(library + '(set! g1 -1) (+ g1 g4999)')[-1], 4998)
+
+    def test_eval_closures(self):
+        self.assertEqual(eval_program("""
+                           (define (make-counter n)
+                             (lambda () (set! n (+ n 1)) n))
+                           (define c (make-counter 10))
+                           (c)
+                           (c)
+                           (define (outer x)
+                             (define y (* x 2))
+                             (define (inner z) (+ x y z))
+                             (inner 1))
+                           (outer 5)
+                           """)[2:],
+                         [11, 12, Ident(u'ok'), 16])
+
+    def test_eval_program(self):
+        self.assertEqual(eval_program("""
+                           (define (fact n) (if (< n 2) 1 (* n (fact (- n 1)))))
+                           (fact 10)
+                           ((lambda (x y) (+ x y)) 1 2)
+                           (begin 1 2 3)
+                           '(a b)
+                           """)[1:],
+                         [3628800, 3, 3, [Ident(u'a'), Ident(u'b')]])
+
+    def test_eval_stream(self):
+        stream = StringIO.StringIO("(define (f x)\n  (* x 2))\n(f\n 21)\n")
+        self.assertEqual(eval_program(stream), [Ident(u'ok'), 42])
+
+    # 読み込んだ記号'eofは入力の終わりではない. 文字列を先頭に持つリストは特殊形式ではない
+    def test_tags_by_identity(self):
+        self.assertEqual(eval_program("'eof 1")[1:], [1])
+        self.assertEqual(expression_type(["quote", 1]), application_type)
+        self.assertEqual(expression_type([Ident(u'quote'), 1]), quoted_type)
+        self.assertFalse(is_compound_procedure([Ident(u'procedure'), [], [], []]))
+
+    def test_eceval_backends(self):
+        source = """
+          (define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+          (fib 12)
+          """
+        machines = [make_eceval(BatchInput(source), backend)
+                    for backend in ('interpret', 'closure', 'block')]
+        for mac in machines:
+            mac.start()
+        for mac in machines[1:]:
+            for name in eceval_registers + ['flag', 'pc']:
+                self.assertEqual(repr(get_register_contents(mac, name)),
+                                 repr(get_register_contents(machines[0], name)))
+            self.assertEqual(mac.get_stack().stack, machines[0].get_stack().stack)
+        self.assertEqual(get_register_contents(machines[0], 'val'), 144)
+
+    # 終わらないプログラムも, 命令の数か時間の上限で止まる
+    def test_eceval_budget(self):
+        for backend in ('interpret', 'closure', 'block'):
+            batch = BatchInput("(define (loop n) (loop (+ n 1))) 1 (loop 0)")
+            mac = make_eceval(batch, backend)
+            self.assertEqual(mac.start(limit=100000).reason, 'limit')
+            self.assertEqual(batch.results, [Ident(u'ok'), 1])
+            self.assertEqual(mac.proceed(timeout=0.05).reason, 'deadline')
+
+    # 止まった機械をもう一度start()すると, REPLの先頭から残りの入力を読む
+    def test_eceval_restart(self):
+        for backend in ('interpret', 'closure', 'block'):
+            batch = BatchInput("(define x 100) (+ x 2)")
+            mac = make_eceval(batch, backend)
+            self.assertEqual(mac.start(), 'done')
+            self.assertEqual(mac.start(), 'done')
+            self.assertEqual(batch.results, [Ident(u'ok'), 102])
+
+            batch = BatchInput("""
+              (define (loop n) (if (= n 0) 'ok (loop (- n 1))))
+              (loop 100)
+              (+ 40 2)""")
+            mac = make_eceval(batch, backend)
+            self.assertEqual(mac.start(limit=990).reason, 'limit')
+            self.assertEqual(mac.start(), 'done')
+            self.assertEqual(batch.results, [Ident(u'ok'), 42])
+
+    # ライブラリを評価した機械を保存し, 別のプロセスで復元して続きを評価する
+    def test_eceval_snapshot(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'library.snapshot')
+            mac = make_eceval(BatchInput("""
+              (define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+              (define (make-counter n) (lambda () (set! n (+ n 1)) n))
+              (define c (make-counter 10))
+              (c)"""))
+            mac.start()
+            write_eceval_snapshot(mac, path)
+            out = subprocess.check_output(
+                [sys.executable, '-c', snapshot_check % path],
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+            self.assertEqual(out.split(), ['12', '55', '13'])
+        finally:
+            shutil.rmtree(directory)
+
+    # ひとつのスナップショットから復元した機械どうし, およびプロセスの大域環境は独立している
+    def test_eceval_snapshot_clones(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'clone.snapshot')
+            mac = make_eceval(BatchInput("(define clone-x 1)"))
+            mac.start()
+            write_eceval_snapshot(mac, path)
+            first = BatchInput("(set! clone-x 100) clone-x (define clone-y 2)")
+            clone = make_eceval(first)
+            read_eceval_snapshot(path, clone)
+            clone.start()
+            second = BatchInput("clone-x")
+            clone = make_eceval(second, 'closure')
+            read_eceval_snapshot(path, clone)
+            clone.start()
+            self.assertEqual(first.results, [Ident(u'ok'), 100, Ident(u'ok')])
+            self.assertEqual(second.results, [1])
+            self.assertEqual(eval_program("(set! clone-x 3) clone-x"), [Ident(u'ok'), 3])
+            self.assertRaises(VariableUnassignedError, eval_program, "clone-y")
+            write_eceval_snapshot(clone, path)
+            third = BatchInput("clone-x")
+            clone = make_eceval(third)
+            read_eceval_snapshot(path, clone)
+            clone.start()
+            self.assertEqual(third.results, [1])
+        finally:
+            shutil.rmtree(directory)
+
+    # 評価の途中で保存した機械は, 復元した先の入力で続きを読む
+    def test_eceval_snapshot_suspended(self):
+        for backend in ('interpret', 'closure', 'block'):
+            stream = StringIO.StringIO()
+            mac = make_eceval(BatchInput("""
+              (define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+              (fib 12)"""), backend)
+            self.assertEqual(mac.start(limit=5000).reason, 'limit')
+            dump_snapshot(mac, stream, {'global-environment': eceval_global_environment(mac)},
+                          eceval_externals())
+            batch = BatchInput("(fib 5)")
+            restored = make_eceval(batch, backend)
+            load_snapshot(StringIO.StringIO(stream.getvalue()), restored, eceval_externals())
+            self.assertEqual(restored.proceed(), 'done')
+            self.assertEqual(batch.results, [144, 5])
 
     def _test_prompt_for(self):
         mac = make_machine(['exp'],
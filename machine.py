@@ -3,6 +3,8 @@
 
 #http://inforno.net/articles/2008/09/19/sexp-library-for-python
 from simplesexp import *
+import os, errno, time
+from array import array
 
 class Error(Exception): pass
 class InvalidInstError(Error): pass
@@ -11,29 +13,81 @@ class UnknownOperationError(Error): pass
 class AllocateRegisterError(Error): pass
 class BadInstructionError(Error): pass
 class UnknownExpressionError(Error): pass
+class DuplicateLabelError(Error): pass
+class UnknownLabelError(Error): pass
+class UnknownBackendError(Error): pass
+class BadProgramImageError(Error): pass
+class BadTraceError(Error): pass
+class BadSnapshotError(Error): pass
+
+# レジスタファイル
+#
+# 機械のレジスタはすべて1つのリスト(レジスタファイル)に入れ, 番号で指す.
+# pcとflagは0番と1番で, ほかのレジスタは割り当てた順に続く. 命令の実行手続きは
+# アセンブルのときにレジスタの番号を取り出して持ち, 実行中はリストを添字で引くだけで,
+# 名前の表やレジスタごとのオブジェクトを経由しない.
+# Registerはレジスタファイルの1つのスロットを指すもので, get_registerが返す.
+PC = 0
+FLAG = 1
 
 class Register(object):
+    __slots__ = ('registers', 'index')
 
-    def __init__(self):
-        self.value=None
+    def __init__(self, registers, index):
+        self.registers = registers
+        self.index = index
 
     def get(self):
-        return self.value
+        return self.registers[self.index]
 
     def set(self, value):
-        self.value = value
+        self.registers[self.index] = value
+
+    value = property(get, set)
 
 
+# スタックは3種類あり, 機械ごとに選べる(make_machineのstack).
+#   Stack            統計を取らない. pushとpopはリストのappendとpopそのもの
+#   InstrumentedStack pushの回数と最大の深さを数える
+#   ArrayStack       型の決まった値(数など)をarrayに積む. pushとpopはarrayのappendとpopそのもの.
+#                    値ごとのオブジェクトを持たないので, 深いスタックでもメモリが少ない
+# クロージャやブロックのコンパイルはpushとpopを取り出して持つので,
+# initializeはスタックを作り直さず, 同じ入れ物を空にする.
 class Stack(object):
 
     def __init__(self):
+        self.stack = []
+        self.push = self.stack.append
+        self.pop = self.stack.pop
+
+    def initialize(self):
+        del self.stack[:]
+
+    def depth(self):
+        return len(self.stack)
+
+    # 積んである値を底から順に. install_contentsはそれで置き換える(スナップショットの復元)
+    def contents(self):
+        return list(self.stack)
+
+    def install_contents(self, items):
+        self.stack[:] = items
+
+    def print_statistics(self):
+        print 'current_depth =', self.depth()
+
+class InstrumentedStack(object):
+
+    def __init__(self):
+        self.stack = []
         self.initialize()
 
     def push(self, value):
         self.stack.append(value)
         self.number_pushes += 1
         self.current_depth += 1
-        self.max_depth = max(self.max_depth, self.current_depth)
+        if self.current_depth > self.max_depth:
+            self.max_depth = self.current_depth
 
     def pop(self):
         ret = self.stack.pop()
@@ -41,15 +95,380 @@ class Stack(object):
         return ret
 
     def initialize(self):
-        self.stack = []
+        del self.stack[:]
         self.number_pushes = 0
         self.max_depth = 0
         self.current_depth = 0
 
+    def depth(self):
+        return self.current_depth
+
+    def contents(self):
+        return list(self.stack)
+
+    def install_contents(self, items):
+        self.stack[:] = items
+        self.current_depth = len(self.stack)
+        self.max_depth = max(self.max_depth, self.current_depth)
+
+    def statistics(self):
+        return {'total-pushes': self.number_pushes, 'maximum-depth': self.max_depth}
+
     def print_statistics(self):
         print 'total_pushes =', self.number_pushes
         print 'maximum_depth =', self.max_depth
 
+class ArrayStack(object):
+
+    def __init__(self, typecode='l'):
+        self.stack = array(typecode)
+        self.push = self.stack.append
+        self.pop = self.stack.pop
+
+    def initialize(self):
+        del self.stack[:]
+
+    def depth(self):
+        return len(self.stack)
+
+    def contents(self):
+        return self.stack.tolist()
+
+    def install_contents(self, items):
+        self.stack[:] = array(self.stack.typecode, items)
+
+    def print_statistics(self):
+        print 'current_depth =', self.depth()
+
+# プロファイラ
+#
+# machine.enable_profiling()で有効にすると, 命令(オフセット)ごとに実行回数と
+# 実行にかかった時間を数える. 無効のとき(既定)は計測しない実行ループを使うので,
+# 負担はexecuteの呼び出しごとの属性の確認1回だけである.
+# ラベルごとの集計は, ラベルから次のラベルまでの命令をまとめたもの(ラベルのブロック)で,
+# entriesはそのラベルに到達した回数. 先頭のラベルより前の命令はラベルNoneにまとめる.
+# 'block'のバックエンドでも命令ごとに数えるため, 計測中は命令ごとのステップで実行する.
+# testとbranchをまとめたステップ(fused)は, 時間をtestに付け, 回数は両方に数える.
+class Profiler(object):
+
+    def __init__(self, texts, labels, fused=()):
+        self.texts = texts
+        self.fused = fused
+        self.block_labels = label_blocks(texts, labels)
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * len(self.texts)
+        self.times = [0.0] * len(self.texts)
+        self.elapsed = 0.0
+
+    def instruction_counts(self):
+        counts = list(self.counts)
+        for offset in self.fused:
+            counts[offset + 1] += self.counts[offset]
+        return counts
+
+    def instructions(self):
+        return sum(self.instruction_counts())
+
+    def instruction_statistics(self):
+        return [{'offset': offset, 'label': self.block_labels[offset],
+                 'instruction': dump([self.texts[offset]]),
+                 'count': count, 'time': self.times[offset]}
+                for offset, count in enumerate(self.instruction_counts()) if count]
+
+    # 時間の長い順
+    def label_statistics(self):
+        counts = self.instruction_counts()
+        blocks = {}
+        for offset, label in enumerate(self.block_labels):
+            if label not in blocks:
+                blocks[label] = {'label': label, 'offset': offset, 'entries': counts[offset],
+                                 'instructions': 0, 'time': 0.0}
+            blocks[label]['instructions'] += counts[offset]
+            blocks[label]['time'] += self.times[offset]
+        return sorted((block for block in blocks.values() if block['instructions']),
+                      key=lambda block: (-block['time'], block['offset']))
+
+    def statistics(self):
+        return {'instructions': self.instructions(), 'time': self.elapsed,
+                'labels': self.label_statistics(),
+                'instruction-counts': self.instruction_statistics()}
+
+    def write_json(self, stream):
+        import json
+        json.dump(self.statistics(), stream, indent=1, sort_keys=True)
+
+    # pstatsで読める形式(profileモジュールのdump_statsと同じmarshalの辞書)で書く.
+    # ラベルのブロックを関数として扱い, ファイル名は'<controller>', 行番号はオフセット.
+    def dump_stats(self, path):
+        import marshal
+        stats = {}
+        for block in self.label_statistics():
+            key = ('<controller>', block['offset'], block_name(block['label']))
+            stats[key] = (block['entries'], block['entries'], block['time'], block['time'], {})
+        f = open(path, 'wb')
+        try:
+            marshal.dump(stats, f)
+        finally:
+            f.close()
+
+    def print_statistics(self, limit=20):
+        print 'total_instructions =', self.instructions()
+        print 'total_time = %.6f' % self.elapsed
+        for block in self.label_statistics()[:limit]:
+            print '%10.6f %10d %10d  %s' % (block['time'], block['instructions'],
+                                            block['entries'], block_name(block['label']))
+
+# 命令ごとに, その命令を含むラベルのブロックのラベル(先頭のラベルより前はNone).
+# 同じ位置に複数のラベルがあれば名前の小さいほうを使う.
+def label_blocks(texts, labels):
+    names = {}
+    for name, offset in labels.items():
+        if offset < len(texts) and (offset not in names or name < names[offset]):
+            names[offset] = name
+    blocks = []
+    label = None
+    for offset in xrange(len(texts)):
+        label = names.get(offset, label)
+        blocks.append(label)
+    return blocks
+
+# marshalはunicodeの派生クラス(Ident)をそのまま書けないので, バイト列にする
+def block_name(label):
+    if label is None:
+        return '(start)'
+    return unicode(label).encode('utf-8')
+
+# 演算のプロファイラ
+#
+# wrap(ops)は演算の表の各演算を, 呼び出しを数える手続きで包んだ表を返す.
+# machine.install_operations(profiler.wrap(ops))やmake_machine, make_eceval(operations=)に
+# 渡して使う. 演算はアセンブルのときに取り出されるので, アセンブルより前に入れること.
+# 呼び出し回数は毎回数えるが, 時間と引数の大きさ(argument_size)は
+# sample回に1回だけ測る(sample=1ならすべて). 測らない呼び出しの負担は回数の加算と剰余だけ.
+# 報告する時間(estimated-time)は, 測った時間を回数の比で全体に引き延ばしたもの.
+class OperationProfiler(object):
+
+    def __init__(self, sample=1):
+        if sample < 1:
+            raise ValueError('sample must be at least 1: %r' % (sample,))
+        self.sample = sample
+        self.records = {}       # 演算名 -> [回数, 測った回数, 時間, 大きさの和, 最大の大きさ]
+
+    def reset(self):
+        for record in self.records.values():
+            record[:] = [0, 0, 0.0, 0, 0]
+
+    def wrap(self, ops):
+        return dict((name, self.wrap_operation(name, op)) for name, op in ops.items())
+
+    def wrap_operation(self, name, op):
+        record = self.records.setdefault(name, [0, 0, 0.0, 0, 0])
+        sample = self.sample
+        clock = time.time
+
+        def profiled_operation(*args):
+            record[0] += 1
+            if record[0] % sample:
+                return op(*args)
+            start = clock()
+            try:
+                return op(*args)
+            finally:
+                record[2] += clock() - start
+                record[1] += 1
+                size = argument_size(args)
+                record[3] += size
+                if size > record[4]:
+                    record[4] = size
+
+        return profiled_operation
+
+    # 見積もった時間の長い順
+    def statistics(self):
+        stats = []
+        for name, (calls, sampled, seconds, size, max_size) in self.records.items():
+            if not calls:
+                continue
+            stats.append({'operation': name, 'calls': calls, 'sampled-calls': sampled,
+                          'time': seconds,
+                          'estimated-time': seconds * calls / sampled if sampled else 0.0,
+                          'mean-argument-size': float(size) / sampled if sampled else 0.0,
+                          'maximum-argument-size': max_size})
+        return sorted(stats, key=lambda stat: (-stat['estimated-time'], stat['operation']))
+
+    def write_json(self, stream):
+        import json
+        json.dump({'sample': self.sample, 'operations': self.statistics()}, stream,
+                  indent=1, sort_keys=True)
+
+    def print_statistics(self, limit=20):
+        for stat in self.statistics()[:limit]:
+            print '%10.6f %10d %8.1f  %s' % (stat['estimated-time'], stat['calls'],
+                                             stat['mean-argument-size'], stat['operation'])
+
+# 引数の大きさはリスト, タプル, 辞書の長さの和. 評価器の引数リスト(タプルの対の連なり)は
+# 対をたどって数え, カーソル(itemsとindexを持つもの)は残りの要素の数を数える.
+def argument_size(args):
+    size = 0
+    for arg in args:
+        if isinstance(arg, tuple):
+            size += arglist_length(arg)
+        elif isinstance(arg, (list, dict)):
+            size += len(arg)
+        elif hasattr(arg, 'items') and hasattr(arg, 'index'):
+            size += len(arg.items) - arg.index
+    return size
+
+def arglist_length(arglist):
+    length = 0
+    while len(arglist) == 2 and isinstance(arglist[1], tuple):
+        length += 1
+        arglist = arglist[1]
+    return length + len(arglist)
+
+# トレース
+#
+# machine.enable_tracing(size)で有効にすると, 命令を1つ実行するごとに
+# (実行前のpc, その命令が書いたレジスタの番号, 書いた値)を事象として記録する.
+# 事象はsize個分を確保済みの環状バッファ(pcと番号はarray, 値はリスト)に入れ,
+# あふれたら古いものから上書きするので, 何ステップ実行してもメモリは一定である.
+# 上書きする事象は基準の状態(base)に適用しておくので, baseに残っている事象を順に
+# 適用すれば, 残っている範囲のどのステップの後のレジスタの状態も復元できる(replay.py).
+# 命令が書くレジスタはassignの対象, restoreのレジスタ, testのflagのいずれか1つで,
+# 命令ごとに前もって求めておく(writes). 値は参照で持つので, あとで中身が書き換わる
+# リストなどは書き出したときの中身になる.
+# 実行と実行のあいだに機械の外から書き換えたレジスタ(set_register_contentsなど)は,
+# 次の実行のはじめにpcが-1の事象として記録する.
+# 'closure'と'block'のバックエンドでは, testとbranchをまとめない命令ごとのステップで実行する.
+# プロファイラとは同時に使えない.
+class Tracer(object):
+
+    def __init__(self, steps, texts, labels, registers, size=65536):
+        self.steps = steps
+        self.texts = texts
+        self.labels = labels
+        self.registers = registers      # レジスタ名 -> 番号
+        self.indices = sorted(index for index in registers.values() if index != PC)
+        self.writes = array('l', [written_register(text, registers) for text in texts])
+        self.size = size
+        self.pcs = array('l', [0]) * size
+        self.written = array('l', [-1]) * size
+        self.values = [None] * size
+        self.pos = 0
+        self.count = 0
+        self.base = None
+        self.last = None
+
+    def begin(self, registers):
+        if self.base is None:
+            self.base = list(registers)
+            return
+        for r in self.indices:
+            if registers[r] is not self.last[r]:
+                self.record(-1, r, registers[r])
+
+    def end(self, registers):
+        self.last = list(registers)
+
+    def record(self, pc, r, value):
+        pos = self.pos
+        if self.count >= self.size:
+            evicted = self.written[pos]
+            if evicted >= 0:
+                self.base[evicted] = self.values[pos]
+        self.pcs[pos] = pc
+        self.written[pos] = r
+        self.values[pos] = value
+        self.pos = (pos + 1) % self.size
+        self.count += 1
+
+    # 残っている事象を古い順に(pc, レジスタの番号, 値)で
+    def events(self):
+        if self.count < self.size:
+            order = range(self.pos)
+        else:
+            order = range(self.pos, self.size) + range(self.pos)
+        return [(self.pcs[i], self.written[i], self.values[i]) for i in order]
+
+    # 残っている最初の事象の通し番号(0から数える)
+    def first_step(self):
+        return max(0, self.count - self.size)
+
+def written_register(text, registers):
+    if text[0] in ('assign', 'restore'):
+        return registers[text[1]]
+    elif text[0] == 'test':
+        return FLAG
+    return -1
+
+# 解釈実行のバックエンドのトレース用に, 実行手続きを次のオフセットを返すステップにする
+def interpreted_steps(insts, registers):
+    def make_step(offset, proc):
+        def step():
+            registers[PC] = offset
+            proc()
+            return registers[PC]
+        return step
+    return [make_step(offset, instruction_execution_proc(inst))
+            for offset, inst in enumerate(insts)]
+
+trace_tag = Symbol(u'machine-trace')
+
+# トレースの書き出し. バイナリ形式で書けない値(環境など)は, reprを入れたSymbolにする.
+# 命令文の中の定数(翻訳したコードの字句アドレスなど)も同じく置き換える.
+# [trace_tag, レジスタ名 -> 番号, 命令文, ラベル, 最初の事象の通し番号,
+#  基準の状態(レジスタ名 -> 値), pc, レジスタの番号, 値, 最後の状態(レジスタ名 -> 値)]
+def write_trace(tracer, path):
+    f = open(path, 'wb')
+    try:
+        dump_trace(tracer, f)
+    finally:
+        f.close()
+
+def dump_trace(tracer, stream):
+    portable = PortableValues()
+    events = tracer.events()
+    base = tracer.base or []
+    last = tracer.last or base
+
+    def state(registers):
+        return dict((name, portable.value(registers[index]))
+                    for name, index in tracer.registers.items()
+                    if index != PC and index < len(registers))
+
+    BinaryDumper().write([trace_tag, tracer.registers, portable.text(tracer.texts), tracer.labels,
+                          tracer.first_step(), state(base),
+                          array('l', [pc for pc, r, value in events]),
+                          array('l', [r for pc, r, value in events]),
+                          [portable.value(value) for pc, r, value in events],
+                          state(last)], stream)
+
+class PortableValues(object):
+
+    def __init__(self):
+        self.dumper = BinaryDumper()
+        self.values = {}
+        self.kept = []
+
+    def value(self, value):
+        key = id(value)
+        if key not in self.values:
+            try:
+                self.dumper.dump(value)
+                self.values[key] = value
+            except TypeError:
+                self.values[key] = Symbol(u'#<%s>' % repr(value).decode('utf-8', 'replace'))
+            self.kept.append(value)
+        return self.values[key]
+
+    # 命令文はリストをたどり, 要素ごとに置き換える
+    def text(self, text):
+        if isinstance(text, list):
+            return [self.text(item) for item in text]
+        return self.value(text)
+
 def get_contents(register):
     return register.get()
 
@@ -57,44 +476,282 @@ def set_contents(register, value):
     register.set(value)
 
 
-def make_machine(register_names, ops, controller_text):
-    machine = Machine()
+# backendには'interpret'(命令ごとの実行手続きを解釈実行する),
+# 'closure'(命令ごとに特殊化したクロージャを作る),
+# 'block'(基本ブロックごとにPythonの関数を生成する. codegen.py)のいずれかを指定する.
+# cacheにProgramCacheを与えると, 文字列のコントローラはアセンブル済みのイメージを使い回す.
+# 省略すると環境変数MACHINE_PROGRAM_CACHEのディレクトリを使う(なければ使わない).
+# stackにはInstrumentedStack()などを渡す. 省略すると統計を取らないStackを使う.
+def make_machine(register_names, ops, controller_text, backend='interpret', cache=None,
+                 stack=None):
+    machine = Machine(stack)
     for rname in register_names:
         machine.allocate_register(rname)
 
     machine.install_operations(ops)
+    cache = cache or default_program_cache()
+    if cache and isinstance(controller_text, basestring):
+        controller_text = cache.program(controller_text, ops.keys())
     machine.install_instruction_sequence(assemble(controller_text,machine))
 
+    if backend == 'closure':
+        machine.install_steps(compile_steps(machine.instruction_sequence(),
+                                            machine.labels(), machine))
+    elif backend == 'block':
+        from codegen import compile_blocks
+        machine.install_steps(compile_blocks(machine.instruction_sequence(),
+                                             machine.labels(), machine), False)
+    elif backend != 'interpret':
+        raise UnknownBackendError(backend)
+
     return machine
 
 class Machine(object):
 
-    def __init__(self):
+    def __init__(self, stack=None):
 
-        self.register_table = {}
+        self.the_registers = [None, None]
+        self.register_numbers = {'pc': PC, 'flag': FLAG}
+        self.constant_slots = {}
 
-        self.pc = Register()
-        self.register_table['pc'] = self.pc
+        self.stack = stack or Stack()
+        self.the_instruction_sequence = []
+        self.the_labels = {}
+        self.the_steps = None
+        self.the_instruction_steps = None
+        self.the_single_steps = None
+        self.profiler = None
+        self.tracer = None
+        self.the_breakpoints = {}
+        self.the_suspension = None
+
+        self.the_ops={'initialize-stack': lambda : self.stack.initialize(),
+                      'print-stack-statistics': lambda : self.stack.print_statistics()}
+
+    # limit(実行する命令の数)かtimeout(秒)を与えるか, ブレークポイントがあれば,
+    # それらを確かめる別の実行ループ(execute_bounded)を使う.
+    def execute(self, limit=None, timeout=None):
+        if limit is not None or timeout is not None or self.the_breakpoints:
+            return self.execute_bounded(limit, timeout)
+        self.the_suspension = None
+        if self.tracer is not None:
+            return self.execute_traced()
+        if self.profiler is not None:
+            return self.execute_profiled()
+        if self.the_steps is not None:
+            return self.execute_steps()
+
+        insts = self.the_instruction_sequence
+        end = len(insts)
+        registers = self.the_registers
+        while True:
+            pc = registers[PC]
+            if pc >= end: break
+            proc = instruction_execution_proc(insts[pc])
+            proc()
 
-        self.flag = Register()
-        self.register_table['flag'] = self.flag
+        return 'done'
 
-        self.stack = Stack()
-        self.the_instruction_sequence = []
+    # コンパイル済みのステップは次に実行する命令のオフセットを返す.
+    # pcはローカル変数で持ち, 抜けるときにpcレジスタへ書き戻す.
+    def execute_steps(self):
+        steps = self.the_steps
+        end = len(steps)
+        registers = self.the_registers
+        pc = registers[PC]
+        try:
+            while pc < end:
+                pc = steps[pc]()
+        finally:
+            registers[PC] = pc
 
-        self.the_ops={'initialize-stack': lambda : self.stack.initialize()}
+        return 'done'
 
-    def execute(self):
-        while True:
-            insts = get_contents(self.pc)
-            if insts == []: break
-            proc = instruction_execution_proc(insts[0])
-            proc()
+    # execute, execute_stepsと同じことを, 命令ごとに回数と時間を数えながら行う
+    def execute_profiled(self):
+        profiler = self.profiler
+        counts = profiler.counts
+        times = profiler.times
+        clock = time.time
+        registers = self.the_registers
+        started = clock()
+        try:
+            if self.the_steps is None:
+                insts = self.the_instruction_sequence
+                end = len(insts)
+                while True:
+                    pc = registers[PC]
+                    if pc >= end: break
+                    proc = instruction_execution_proc(insts[pc])
+                    start = clock()
+                    proc()
+                    times[pc] += clock() - start
+                    counts[pc] += 1
+            else:
+                steps = self.instruction_steps()
+                end = len(steps)
+                pc = registers[PC]
+                try:
+                    while pc < end:
+                        start = clock()
+                        nxt = steps[pc]()
+                        times[pc] += clock() - start
+                        counts[pc] += 1
+                        pc = nxt
+                finally:
+                    registers[PC] = pc
+        finally:
+            profiler.elapsed += clock() - started
+
+        return 'done'
+
+    # 事象の記録はtracer.recordと同じことをループの中に展開したもの
+    def execute_traced(self):
+        tracer = self.tracer
+        registers = self.the_registers
+        tracer.begin(registers)
+        steps = tracer.steps
+        writes = tracer.writes
+        pcs = tracer.pcs
+        written = tracer.written
+        values = tracer.values
+        base = tracer.base
+        size = tracer.size
+        pos = tracer.pos
+        count = tracer.count
+        end = len(steps)
+        pc = registers[PC]
+        try:
+            while pc < end:
+                nxt = steps[pc]()
+                if count >= size:
+                    r = written[pos]
+                    if r >= 0:
+                        base[r] = values[pos]
+                pcs[pos] = pc
+                r = writes[pc]
+                written[pos] = r
+                values[pos] = registers[r] if r >= 0 else None
+                pos += 1
+                if pos == size:
+                    pos = 0
+                count += 1
+                pc = nxt
+        finally:
+            registers[PC] = pc
+            tracer.pos = pos
+            tracer.count = count
+            tracer.end(registers)
 
         return 'done'
 
+    # 上限に達するかブレークポイントに来たら, 次の命令を実行する前に止まり,
+    # Suspensionを返す. 機械の状態(レジスタとスタック)はそのまま残るので, proceedで続けられる.
+    # 時刻は1024命令ごとに確かめる. プロファイラとトレースはこのループでは使わない.
+    def execute_bounded(self, limit, timeout):
+        steps = self.single_steps()
+        end = len(steps)
+        registers = self.the_registers
+        breakpoints = self.the_breakpoints
+        clock = time.time
+        deadline = None if timeout is None else clock() + timeout
+        pc = registers[PC]
+        # ブレークポイントで止まったところから続けるときは, 最初の命令では止まらない
+        suspension = self.the_suspension
+        resumed = suspension is not None and suspension.reason == 'breakpoint' \
+            and suspension.pc == pc
+        self.the_suspension = None
+        executed = 0
+        try:
+            while pc < end:
+                if executed == limit:
+                    self.the_suspension = Suspension('limit', pc, executed)
+                    break
+                if pc in breakpoints and not (resumed and executed == 0):
+                    self.the_suspension = Suspension('breakpoint', pc, executed,
+                                                     breakpoints[pc])
+                    break
+                if deadline is not None and not executed & 1023 and clock() >= deadline:
+                    self.the_suspension = Suspension('deadline', pc, executed)
+                    break
+                pc = steps[pc]()
+                executed += 1
+        finally:
+            registers[PC] = pc
+
+        return self.the_suspension or 'done'
+
+    # 止まったところから実行を続ける
+    def proceed(self, limit=None, timeout=None):
+        return self.execute(limit, timeout)
+
+    def suspension(self):
+        return self.the_suspension
+
+    # labelからoffset命令先の命令の前で止まる(SICP 問題5.19のset-breakpoint)
+    def set_breakpoint(self, label, offset=0):
+        self.the_breakpoints[lookup_label(self.the_labels, label) + offset] = (label, offset)
+
+    def cancel_breakpoint(self, label, offset=0):
+        self.the_breakpoints.pop(lookup_label(self.the_labels, label) + offset, None)
+
+    def cancel_all_breakpoints(self):
+        self.the_breakpoints.clear()
+
+    # testとbranchをまとめない, 命令ごとのステップ. 解釈実行のバックエンドでは
+    # 実行手続きを包んだもの. トレースと上限つきの実行で使い, 最初に使うときに作る.
+    def single_steps(self):
+        if self.the_single_steps is None:
+            if self.the_steps is None:
+                self.the_single_steps = interpreted_steps(self.the_instruction_sequence,
+                                                          self.the_registers)
+            else:
+                self.the_single_steps = compile_steps(self.the_instruction_sequence,
+                                                      self.the_labels, self, False)
+        return self.the_single_steps
+
+    def enable_tracing(self, size=65536):
+        self.tracer = Tracer(self.single_steps(), map(instruction_text, self.the_instruction_sequence),
+                             self.the_labels, dict(self.register_numbers), size)
+        return self.tracer
+
+    def disable_tracing(self):
+        tracer = self.tracer
+        self.tracer = None
+        return tracer
+
+    def enable_profiling(self):
+        texts = map(instruction_text, self.the_instruction_sequence)
+        fused = ()
+        if self.the_steps is not None:
+            fused = fused_test_offsets(texts)
+        self.profiler = Profiler(texts, self.the_labels, fused)
+        return self.profiler
+
+    def disable_profiling(self):
+        profiler = self.profiler
+        self.profiler = None
+        return profiler
+
     def get_register(self, name):
-        return self.register_table[name]
+        return Register(self.the_registers, self.register_numbers[name])
+
+    def register_number(self, name):
+        return self.register_numbers[name]
+
+    def register_file(self):
+        return self.the_registers
+
+    # 定数を入れたスロットをレジスタファイルの後ろに足し, その番号を返す.
+    # クロージャコンパイルでは被演算子をすべてスロットの番号で表す.
+    # 同じ定数(同一のオブジェクト)には同じスロットを使うので, コンパイルし直しても
+    # レジスタファイルは増えない. 値はスロットが持つので, idが使い回されることはない.
+    def constant_slot(self, value):
+        slot = self.constant_slots.get(id(value))
+        if slot is None:
+            slot = self.constant_slots[id(value)] = len(self.the_registers)
+            self.the_registers.append(value)
+        return slot
 
     def get_stack(self):
         return self.stack
@@ -102,61 +759,349 @@ class Machine(object):
     def operations(self):
         return self.the_ops
 
+    def instruction_sequence(self):
+        return self.the_instruction_sequence
+
     def install_instruction_sequence(self, seq):
         self.the_instruction_sequence = seq
+        self.the_single_steps = None
+
+    def labels(self):
+        return self.the_labels
+
+    def install_labels(self, labels):
+        self.the_labels = labels
+
+    # stepsが命令ごとのステップでない(基本ブロックをまとめた)場合はper_instructionを偽にする.
+    # 命令ごとのステップはプロファイルを取るときに初めて作る.
+    def install_steps(self, steps, per_instruction=True):
+        self.the_steps = steps
+        self.the_instruction_steps = steps if per_instruction else None
+        self.the_single_steps = None
+
+    def instruction_steps(self):
+        if self.the_instruction_steps is None:
+            self.the_instruction_steps = compile_steps(self.the_instruction_sequence,
+                                                       self.the_labels, self)
+        return self.the_instruction_steps
 
     def allocate_register(self, name):
-        if self.register_table.has_key(name):
+        if self.register_numbers.has_key(name):
             raise AllocateRegisterError()
 
-        self.register_table[name] = Register()
+        self.register_numbers[name] = len(self.the_registers)
+        self.the_registers.append(None)
 
     def install_operations(self, ops):
         self.the_ops.update(ops)
 
-    def start(self):
-        set_contents(self.pc, self.the_instruction_sequence)
-        self.execute()
-
+    def start(self, limit=None, timeout=None):
+        self.the_registers[PC] = 0
+        self.the_suspension = None
+        return self.execute(limit, timeout)
+
+# 上限つきの実行が止まった理由('limit', 'deadline', 'breakpoint'), 次に実行する命令のpc,
+# 止まるまでに実行した命令の数, ブレークポイントなら(ラベル, オフセット)
+class Suspension(object):
+    __slots__ = ('reason', 'pc', 'executed', 'breakpoint')
+
+    def __init__(self, reason, pc, executed, breakpoint=None):
+        self.reason = reason
+        self.pc = pc
+        self.executed = executed
+        self.breakpoint = breakpoint
+
+    def __repr__(self):
+        return 'Suspension(%r, pc=%d, executed=%d)' % (self.reason, self.pc, self.executed)
+
+# 命令列は平坦なリストになり, ラベルは命令列中のオフセット(整数)に解決される.
+# pcレジスタやcontinueなどに入るコードアドレスはこのオフセットである.
+# controller_textは文字列か, 読み込み済みのリスト(コンパイラが生成したものなど),
+# またはアセンブル済みのプログラム(AssembledProgram)
 def assemble( controller_text, machine):
-    def receive(insts, labels):
-        update_insts(insts, labels, machine)
-        return insts
-
+    if isinstance(controller_text, AssembledProgram):
+        return install_program(controller_text, machine)
+    elif not isinstance(controller_text, basestring):
+        return assemble_program(controller_text, machine)
     sexps = read(controller_text)
-    return extract_labels(sexps[0], receive)
+    return assemble_program(sexps[0], machine)
+
+# 読み込み済みのコントローラ(命令文とラベルのリスト)をアセンブルする
+def assemble_program(text, machine):
+    insts, labels = extract_labels(text)
+    check_labels(insts, labels)
+    update_insts(insts, labels, machine)
+    machine.install_labels(labels)
+    return insts
+
+# アセンブル済みのプログラム: 命令文のリストとラベル表(ラベル名からオフセット).
+# 機械や演算によらないので, バイナリ形式のイメージとして保存しておけば,
+# 次からはコントローラの読み込みとラベルの解決を省いて機械に載せられる.
+class AssembledProgram(object):
+    __slots__ = ('texts', 'labels')
+
+    def __init__(self, texts, labels):
+        self.texts = texts
+        self.labels = labels
+
+    def __repr__(self):
+        return 'AssembledProgram(%d instructions, %d labels)' % (len(self.texts), len(self.labels))
+
+program_image_tag = Symbol(u'assembled-program')
+
+def assemble_controller(controller_text):
+    if isinstance(controller_text, basestring):
+        controller_text = read(controller_text)[0]
+    insts, labels = extract_labels(controller_text)
+    check_labels(insts, labels)
+    return AssembledProgram(map(instruction_text, insts), labels)
+
+def install_program(program, machine):
+    insts = map(make_instruction, program.texts)
+    labels = dict(program.labels)
+    update_insts(insts, labels, machine)
+    machine.install_labels(labels)
+    return insts
+
+def write_program_image(program, path):
+    f = open(path, 'wb')
+    try:
+        dump_program_image(program, f)
+    finally:
+        f.close()
 
-def extract_labels(text, receive):
-    if text == []:
-        return receive([], {})
-    
-    def cont(insts, labels):
-        next_inst = text[0]
+def dump_program_image(program, stream):
+    BinaryDumper().write([program_image_tag, program.texts, program.labels], stream)
+
+def read_program_image(path):
+    try:
+        image = load_binary_file(path)
+    except ParseError, e:
+        raise BadProgramImageError(path, str(e))
+    if not (isinstance(image, list) and len(image) == 3 and image[0] is program_image_tag
+            and isinstance(image[1], list) and isinstance(image[2], dict)):
+        raise BadProgramImageError(path)
+    return AssembledProgram(image[1], image[2])
+
+# スナップショット
+#
+# 機械の状態(名前のあるレジスタ, スタックの中身, pc)をpickleで保存し, 同じコントローラを
+# 載せた別の機械(別のプロセスでもよい)に復元する. pcはその位置かそれより前にある
+# 一番近いラベルと, そこからのオフセットで表す. continueなどのレジスタや翻訳した手続きに
+# 入っているコードアドレスは命令列中のオフセットなので, 命令文から求めたハッシュが
+# 一致しない機械には復元しない.
+# 演算の表にある手続き('op:'名前)とexternalsで名前をつけたオブジェクト(基本手続きなど)は
+# 名前だけを保存し, 復元する側の同じ名前のオブジェクトにつなぐ(persistent id).
+# rootsには機械の外で持っている状態(評価器の大域環境など)を与える. 復元するとそれを返す.
+# レジスタ, スタック, rootsはひとつのpickleに入れるので, 共有している環境は共有したまま戻る.
+snapshot_format = ('machine-snapshot', 1)
+
+def write_snapshot(machine, path, roots=None, externals=None):
+    f = open(path, 'wb')
+    try:
+        dump_snapshot(machine, f, roots, externals)
+    finally:
+        f.close()
+
+def dump_snapshot(machine, stream, roots=None, externals=None):
+    import cPickle
+    registers = machine.register_file()
+    state = {'format': snapshot_format,
+             'controller': controller_digest(machine),
+             'pc': pc_label(machine.labels(), registers[PC]),
+             'registers': dict((name, registers[index])
+                               for name, index in machine.register_numbers.items()
+                               if index != PC),
+             'stack': machine.get_stack().contents(),
+             'roots': roots or {}}
+    names = dict((id(obj), name)
+                 for name, obj in persistent_objects(machine, externals).items())
+    pickler = cPickle.Pickler(stream, 2)
+    pickler.persistent_id = lambda obj: names.get(id(obj))
+    pickler.dump(state)
+
+def read_snapshot(path, machine, externals=None):
+    f = open(path, 'rb')
+    try:
+        return load_snapshot(f, machine, externals)
+    finally:
+        f.close()
+
+def load_snapshot(stream, machine, externals=None):
+    import cPickle
+    objects = persistent_objects(machine, externals)
+
+    def persistent_load(name):
+        try:
+            return objects[name]
+        except KeyError:
+            raise BadSnapshotError('unknown external object', name)
+
+    unpickler = cPickle.Unpickler(stream)
+    unpickler.persistent_load = persistent_load
+    try:
+        state = unpickler.load()
+    except BadSnapshotError:
+        raise
+    except Exception, e:
+        raise BadSnapshotError(str(e))
+    if not (isinstance(state, dict) and state.get('format') == snapshot_format):
+        raise BadSnapshotError('not a machine snapshot')
+    if state['controller'] != controller_digest(machine):
+        raise BadSnapshotError('the controller does not match the snapshot')
+
+    label, offset = state['pc']
+    registers = machine.register_file()
+    for name, value in state['registers'].items():
+        if name not in machine.register_numbers:
+            raise BadSnapshotError('unknown register', name)
+        registers[machine.register_number(name)] = value
+    machine.get_stack().install_contents(state['stack'])
+    registers[PC] = offset if label is None else lookup_label(machine.labels(), label) + offset
+    machine.the_suspension = None
+    return state['roots']
+
+def persistent_objects(machine, externals):
+    objects = dict(('op:' + name, op) for name, op in machine.operations().items())
+    objects.update(externals or {})
+    return objects
+
+# 命令文の定数はバイナリ形式で書けないものをreprで置き換えてから(PortableValues)ハッシュする
+def controller_digest(machine):
+    import hashlib
+    texts = map(instruction_text, machine.instruction_sequence())
+    return hashlib.sha1(dump_binary(PortableValues().text(texts))).hexdigest()
+
+# pcの位置かそれより前で一番近いラベルと, そこからのオフセット. ラベルがなければ(None, pc)
+def pc_label(labels, pc):
+    best = None
+    for name, offset in labels.items():
+        if offset <= pc and (best is None or (-offset, name) < (-best[1], best[0])):
+            best = (name, offset)
+    if best is None:
+        return None, pc
+    return best[0], pc - best[1]
+
+# アセンブル済みのプログラムをディレクトリに保存しておくキャッシュ.
+# ファイル名はコントローラの文字列と演算の名前のハッシュなので, どちらかが変われば
+# 別のファイルになり, 古いイメージは使われない. イメージは一時ファイルに書いてから
+# 名前を変えるので, ディレクトリを共有する他のプロセスが書きかけのものを読むことはない.
+# 読めないイメージはアセンブルし直して上書きし, 書けないときはキャッシュせずに続ける.
+# 一度読んだプログラムは内容が変わらないので, 同じプロセスではメモリ上のものを使う.
+program_cache_version = 1
+
+class ProgramCache(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.programs = {}
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, controller_text, op_names):
+        import hashlib
+        digest = hashlib.sha1('program-cache %d\0' % program_cache_version)
+        if isinstance(controller_text, unicode):
+            controller_text = controller_text.encode('utf-8')
+        digest.update(controller_text)
+        for name in sorted(op_names):
+            digest.update('\0' + name.encode('utf-8'))
+        return os.path.join(self.directory, digest.hexdigest() + '.sxb')
+
+    def program(self, controller_text, op_names):
+        path = self.path(controller_text, op_names)
+        program = self.programs.get(path)
+        if program is not None:
+            return program
+
+        try:
+            program = read_program_image(path)
+            self.hits += 1
+        except (IOError, BadProgramImageError):
+            self.misses += 1
+            program = assemble_controller(controller_text)
+            self.store(program, path)
+        self.programs[path] = program
+        return program
+
+    def store(self, program, path):
+        import tempfile
+        try:
+            try:
+                os.makedirs(self.directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            fd, temp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+            try:
+                f = os.fdopen(fd, 'wb')
+                try:
+                    dump_program_image(program, f)
+                finally:
+                    f.close()
+                os.rename(temp, path)
+            except:
+                os.remove(temp)
+                raise
+        except (IOError, OSError):
+            pass
+
+def default_program_cache():
+    directory = os.environ.get('MACHINE_PROGRAM_CACHE')
+    if directory:
+        return ProgramCache(directory)
+    return None
+
+# コントローラを先頭から一度だけ走査し, 命令列とラベル表を作る
+def extract_labels(text):
+    insts = []
+    labels = {}
+    for next_inst in text:
         if type(next_inst) is Ident:
-            labels.update(make_label_entry(next_inst, insts))
-            return receive(insts, labels)
+            if labels.has_key(next_inst):
+                raise DuplicateLabelError(next_inst)
+            labels.update(make_label_entry(next_inst, len(insts)))
         else:
-            return receive([make_instruction(next_inst)] + insts, labels)
+            insts.append(make_instruction(next_inst))
 
-    return extract_labels(text[1:], cont)
+    return insts, labels
 
-def make_label_entry(label_name, insts):
-    return {label_name: insts}
+def make_label_entry(label_name, offset):
+    return {label_name: offset}
 
 def lookup_label(labels, label_name):
-    return labels[label_name]
+    try:
+        return labels[label_name]
+    except KeyError:
+        raise UnknownLabelError(label_name)
+
+# 命令から参照されているラベルがすべて定義されているか確認する
+def check_labels(insts, labels):
+    missing = []
+    for inst in insts:
+        for name in referenced_labels(instruction_text(inst)):
+            if not labels.has_key(name) and name not in missing:
+                missing.append(name)
+
+    if missing:
+        raise UnknownLabelError(*missing)
+
+def referenced_labels(inst):
+    names = [label_exp_label(exp) for exp in inst[1:] if is_label_exp(exp)]
+    if inst[0] == 'dispatch':
+        names.extend(label_name for key, label_name in dispatch_table(inst))
+    return names
 
 # ここで渡されるinstsは[[ 命令文, []], ...]という形をしているはず
 def update_insts(insts, labels, machine):
-    pc = machine.get_register('pc')
-    flag = machine.get_register('flag')
+    regs = machine.register_file()
     stack = machine.get_stack()
     ops = machine.operations()
 
     def update_proc(inst):
         set_instruction_execition_proc(inst, 
                                        make_execution_procedure(instruction_text(inst), 
-                                                                labels, machine, pc, flag, stack, ops))
+                                                                labels, machine, regs, stack, ops))
         return inst
 
     map( lambda inst: update_proc(inst), insts)
@@ -173,37 +1118,40 @@ def instruction_execution_proc(inst):
 def set_instruction_execition_proc(inst, proc):
     inst[1] = proc
 
-def make_execution_procedure(inst, labels, machine, pc, flag, stack, ops):
+def make_execution_procedure(inst, labels, machine, regs, stack, ops):
     ins = inst[0]
     if ins == 'assign':
-        return make_assign(inst, machine, labels, ops, pc)
+        return make_assign(inst, machine, labels, ops, regs)
 
     elif ins == 'test':
-        return make_test(inst, machine, labels, ops, flag, pc)
+        return make_test(inst, machine, labels, ops, regs)
 
     elif ins == 'branch':
-        return make_branch(inst, machine, labels, flag, pc)
+        return make_branch(inst, machine, labels, regs)
 
     elif ins == 'goto':
-        return make_goto(inst, machine, labels, pc)
+        return make_goto(inst, machine, labels, regs)
 
     elif ins == 'save':
-        return make_save(inst, machine, stack, pc)
+        return make_save(inst, machine, stack, regs)
 
     elif ins == 'restore':
-        return make_restore(inst, machine, stack, pc)
+        return make_restore(inst, machine, stack, regs)
 
     elif ins == 'perform':
-        return make_perform(inst, machine, labels, ops, pc)
+        return make_perform(inst, machine, labels, ops, regs)
+
+    elif ins == 'dispatch':
+        return make_dispatch(inst, machine, labels, ops, regs)
     else:
         print "InvalidInst: ",  inst
         raise InvalidInstError
 
-def make_assign(inst, machine, labels, ops, pc):
+def make_assign(inst, machine, labels, ops, regs):
     def assign_reg_name(inst): return inst[1]
     def assign_value_exp(inst): return inst[2:]
 
-    target = machine.get_register(assign_reg_name(inst))
+    target = machine.register_number(assign_reg_name(inst))
     value_exp = assign_value_exp(inst)
 
     if is_operation_exp(value_exp):
@@ -212,13 +1160,13 @@ def make_assign(inst, machine, labels, ops, pc):
         value_proc = make_primitive_exp(value_exp[0], machine, labels)
 
     def assign_proc():
-        set_contents(target, value_proc())
-        advance_pc(pc)
+        regs[target] = value_proc()
+        regs[PC] += 1
 
     return assign_proc
 
-def advance_pc(pc):
-    set_contents(pc, get_contents(pc)[1:])
+def advance_pc(regs):
+    regs[PC] += 1
 
 def is_operation_exp(exp):
     return is_tagged_list(exp[0], 'op')
@@ -229,22 +1177,22 @@ def operation_exp_op(exp):
 def operation_exp_operands(exp):
     return exp[1:]
 
-def make_save(inst, machine, stack, pc):
+def make_save(inst, machine, stack, regs):
 
-    reg = machine.get_register(stack_inst_reg_name(inst))
+    reg = machine.register_number(stack_inst_reg_name(inst))
 
     def save_proc():
-        stack.push(get_contents(reg))
-        advance_pc(pc)
+        stack.push(regs[reg])
+        regs[PC] += 1
 
     return save_proc
 
-def make_restore(inst, machine, stack, pc):
-    reg = machine.get_register(stack_inst_reg_name(inst))
+def make_restore(inst, machine, stack, regs):
+    reg = machine.register_number(stack_inst_reg_name(inst))
 
     def restore_proc():
-        set_contents(reg, stack.pop())
-        advance_pc(pc)
+        regs[reg] = stack.pop()
+        regs[PC] += 1
 
     return restore_proc
 
@@ -271,18 +1219,18 @@ def lookup_prim(symbol, operations):
         raise UnknownOperationError()
 
 def set_register_contents(machine, regname, content):
-    set_contents(machine.get_register(regname), content)
+    machine.register_file()[machine.register_number(regname)] = content
 
 def get_register_contents(machine, regname):
-    return get_contents(machine.get_register(regname))
+    return machine.register_file()[machine.register_number(regname)]
 
-def make_test(inst, machine, labels, operations, flag, pc):
+def make_test(inst, machine, labels, operations, regs):
     condition = test_condition(inst)
     if is_operation_exp(condition):
         condition_proc = make_operation_exp(condition, machine, labels, operations)
         def test_proc():
-            set_contents(flag, condition_proc())
-            advance_pc(pc)
+            regs[FLAG] = condition_proc()
+            regs[PC] += 1
         return test_proc
     else:
         raise BadInstructionError()
@@ -296,12 +1244,13 @@ def make_primitive_exp(exp, machine, labels):
         return lambda : c
 
     elif is_label_exp(exp):
-        insts = lookup_label(labels, label_exp_label(exp))
-        return lambda : insts
+        offset = lookup_label(labels, label_exp_label(exp))
+        return lambda : offset
 
     elif is_register_exp(exp):
-        r = machine.get_register(register_exp_reg(exp))
-        return lambda : get_contents(r)
+        r = machine.register_number(register_exp_reg(exp))
+        regs = machine.register_file()
+        return lambda : regs[r]
     else:
         raise UnknownExpressionError()
 
@@ -332,38 +1281,42 @@ def is_tagged_list(exp, tag):
 
     return False
 
-def make_branch(inst, machine, labels, flag, pc):
+def make_branch(inst, machine, labels, regs):
     def branch_dest(branch_inst):
         return branch_inst[1]
 
     dest = branch_dest(inst)
     if is_label_exp(dest):
-        insts = lookup_label(labels, label_exp_label(dest))
+        offset = lookup_label(labels, label_exp_label(dest))
         def branch_proc():
-            if get_contents(flag):
-                set_contents(pc, insts)
+            if regs[FLAG]:
+                regs[PC] = offset
             else:
-                advance_pc(pc)
+                regs[PC] += 1
 
         return branch_proc
     else:
         raise BadInstructionError()
 
-def make_goto(inst, machine, labels, pc):
+def make_goto(inst, machine, labels, regs):
     def goto_dest(goto_inst):
         return goto_inst[1]
 
     dest = goto_dest(inst)
     if is_label_exp(dest):
-        insts = lookup_label(labels, label_exp_label(dest))
-        return lambda : set_contents(pc, insts)
+        offset = lookup_label(labels, label_exp_label(dest))
+        def goto_proc():
+            regs[PC] = offset
+        return goto_proc
     elif is_register_exp(dest):
-        reg = machine.get_register(register_exp_reg(dest))
-        return lambda : set_contents(pc, get_contents(reg))
+        reg = machine.register_number(register_exp_reg(dest))
+        def goto_proc():
+            regs[PC] = regs[reg]
+        return goto_proc
 
     raise BadInstructionError()
 
-def make_perform(inst, machine, labels, operations ,pc):
+def make_perform(inst, machine, labels, operations, regs):
     def perform_action(inst):
         return inst[1:]
 
@@ -373,7 +1326,263 @@ def make_perform(inst, machine, labels, operations ,pc):
 
         def perform_proc():
             action_proc()
-            advance_pc(pc)
+            regs[PC] += 1
 
         return perform_proc
 
+# (dispatch (op 演算) 被演算子... ((キー ラベル名) ...) (label 既定のラベル))
+# 演算の結果をキーとして表を引き, 対応するラベルへ一度に飛ぶ.
+# 表にないキーのときは既定のラベルへ飛ぶ.
+def make_dispatch(inst, machine, labels, operations, regs):
+    key_exp = dispatch_key_exp(inst)
+    if not is_operation_exp(key_exp) or not is_label_exp(dispatch_default(inst)):
+        raise BadInstructionError()
+
+    key_proc = make_operation_exp(key_exp, machine, labels, operations)
+    table = make_dispatch_table(inst, labels)
+    default = lookup_label(labels, label_exp_label(dispatch_default(inst)))
+
+    def dispatch_proc():
+        regs[PC] = table.get(key_proc(), default)
+
+    return dispatch_proc
+
+def dispatch_key_exp(inst):
+    return inst[1:-2]
+
+def dispatch_table(inst):
+    return inst[-2]
+
+def dispatch_default(inst):
+    return inst[-1]
+
+def make_dispatch_table(inst, labels):
+    return dict((key, lookup_label(labels, label_name))
+                for key, label_name in dispatch_table(inst))
+
+
+
+# クロージャコンパイル
+#
+# 命令ごとに, 次に実行する命令のオフセットを返す引数なしの手続き(ステップ)を作る.
+# オペランドはすべてレジスタファイルのスロットの番号で表す. レジスタはその番号,
+# 定数とラベルは値を入れたスロット(constant_slot)の番号とする. 演算の呼び出しは
+# 引数の数ごとに特殊化し, 中間のlambdaやリストを作らない.
+# testの直後にbranchが続く場合は, 両者をひとつのステップにまとめる.
+
+# fuseが偽ならtestとbranchをまとめない(トレースでは命令ごとに事象を記録するため)
+def compile_steps(insts, labels, machine, fuse=True):
+    steps = []
+    texts = map(instruction_text, insts)
+    for i, text in enumerate(texts):
+        if fuse and i + 1 < len(texts):
+            following = texts[i + 1]
+        else:
+            following = None
+        steps.append(make_step(text, following, i, labels, machine))
+
+    return steps
+
+def fuses_with_branch(following):
+    return following is not None and following[0] == 'branch' and is_label_exp(following[1])
+
+# testとbranchをひとつにまとめるステップのオフセット
+def fused_test_offsets(texts):
+    return [i for i in xrange(len(texts) - 1)
+            if texts[i][0] == 'test' and fuses_with_branch(texts[i + 1])]
+
+def make_step(inst, following, offset, labels, machine):
+    ins = inst[0]
+    nxt = offset + 1
+    regs = machine.register_file()
+    if ins == 'assign':
+        target = machine.register_number(inst[1])
+        value_exp = inst[2:]
+        if is_operation_exp(value_exp):
+            op, cells = make_operation_cells(value_exp, machine, labels)
+            return make_assign_step(regs, target, op, cells, nxt)
+        cell = make_cell(value_exp[0], machine, labels)
+        def assign_step():
+            regs[target] = regs[cell]
+            return nxt
+        return assign_step
+
+    elif ins == 'test':
+        condition = test_condition(inst)
+        if not is_operation_exp(condition):
+            raise BadInstructionError()
+        op, cells = make_operation_cells(condition, machine, labels)
+        if fuses_with_branch(following):
+            dest = lookup_label(labels, label_exp_label(following[1]))
+            return make_test_branch_step(regs, op, cells, dest, offset + 2)
+        return make_assign_step(regs, FLAG, op, cells, nxt)
+
+    elif ins == 'branch':
+        if not is_label_exp(inst[1]):
+            raise BadInstructionError()
+        dest = lookup_label(labels, label_exp_label(inst[1]))
+        def branch_step():
+            if regs[FLAG]:
+                return dest
+            return nxt
+        return branch_step
+
+    elif ins == 'goto':
+        if is_label_exp(inst[1]):
+            dest = lookup_label(labels, label_exp_label(inst[1]))
+            return lambda : dest
+        elif is_register_exp(inst[1]):
+            reg = machine.register_number(register_exp_reg(inst[1]))
+            return lambda : regs[reg]
+        raise BadInstructionError()
+
+    elif ins == 'save':
+        reg = machine.register_number(stack_inst_reg_name(inst))
+        push = machine.get_stack().push
+        def save_step():
+            push(regs[reg])
+            return nxt
+        return save_step
+
+    elif ins == 'restore':
+        reg = machine.register_number(stack_inst_reg_name(inst))
+        pop = machine.get_stack().pop
+        def restore_step():
+            regs[reg] = pop()
+            return nxt
+        return restore_step
+
+    elif ins == 'perform':
+        action = inst[1:]
+        if not is_operation_exp(action):
+            raise BadInstructionError()
+        op, cells = make_operation_cells(action, machine, labels)
+        return make_perform_step(regs, op, cells, nxt)
+
+    elif ins == 'dispatch':
+        key_exp = dispatch_key_exp(inst)
+        if not is_operation_exp(key_exp) or not is_label_exp(dispatch_default(inst)):
+            raise BadInstructionError()
+        op, cells = make_operation_cells(key_exp, machine, labels)
+        table = make_dispatch_table(inst, labels)
+        default = lookup_label(labels, label_exp_label(dispatch_default(inst)))
+        return make_dispatch_step(regs, op, cells, table.get, default)
+
+    else:
+        print "InvalidInst: ",  inst
+        raise InvalidInstError
+
+def make_cell(exp, machine, labels):
+    if is_register_exp(exp):
+        return machine.register_number(register_exp_reg(exp))
+    elif is_constant_exp(exp):
+        return machine.constant_slot(constant_exp_value(exp))
+    elif is_label_exp(exp):
+        return machine.constant_slot(lookup_label(labels, label_exp_label(exp)))
+    raise UnknownExpressionError()
+
+def make_operation_cells(exp, machine, labels):
+    op = lookup_prim(operation_exp_op(exp), machine.operations())
+    cells = [make_cell(e, machine, labels) for e in operation_exp_operands(exp)]
+    return op, cells
+
+def make_assign_step(regs, target, op, cells, nxt):
+    n = len(cells)
+    if n == 0:
+        def step():
+            regs[target] = op()
+            return nxt
+    elif n == 1:
+        a, = cells
+        def step():
+            regs[target] = op(regs[a])
+            return nxt
+    elif n == 2:
+        a, b = cells
+        def step():
+            regs[target] = op(regs[a], regs[b])
+            return nxt
+    elif n == 3:
+        a, b, c = cells
+        def step():
+            regs[target] = op(regs[a], regs[b], regs[c])
+            return nxt
+    else:
+        def step():
+            regs[target] = op(*[regs[cell] for cell in cells])
+            return nxt
+    return step
+
+def make_test_branch_step(regs, op, cells, dest, nxt):
+    n = len(cells)
+    if n == 0:
+        def step():
+            regs[FLAG] = v = op()
+            if v: return dest
+            return nxt
+    elif n == 1:
+        a, = cells
+        def step():
+            regs[FLAG] = v = op(regs[a])
+            if v: return dest
+            return nxt
+    elif n == 2:
+        a, b = cells
+        def step():
+            regs[FLAG] = v = op(regs[a], regs[b])
+            if v: return dest
+            return nxt
+    elif n == 3:
+        a, b, c = cells
+        def step():
+            regs[FLAG] = v = op(regs[a], regs[b], regs[c])
+            if v: return dest
+            return nxt
+    else:
+        def step():
+            regs[FLAG] = v = op(*[regs[cell] for cell in cells])
+            if v: return dest
+            return nxt
+    return step
+
+def make_perform_step(regs, op, cells, nxt):
+    n = len(cells)
+    if n == 0:
+        def step():
+            op()
+            return nxt
+    elif n == 1:
+        a, = cells
+        def step():
+            op(regs[a])
+            return nxt
+    elif n == 2:
+        a, b = cells
+        def step():
+            op(regs[a], regs[b])
+            return nxt
+    elif n == 3:
+        a, b, c = cells
+        def step():
+            op(regs[a], regs[b], regs[c])
+            return nxt
+    else:
+        def step():
+            op(*[regs[cell] for cell in cells])
+            return nxt
+    return step
+
+def make_dispatch_step(regs, op, cells, lookup, default):
+    n = len(cells)
+    if n == 1:
+        a, = cells
+        def step():
+            return lookup(op(regs[a]), default)
+    elif n == 2:
+        a, b = cells
+        def step():
+            return lookup(op(regs[a], regs[b]), default)
+    else:
+        def step():
+            return lookup(op(*[regs[cell] for cell in cells]), default)
+    return step
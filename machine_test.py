@@ -2,14 +2,14 @@
 # -*- coding: utf-8 -*-
 
 from machine import *
-import unittest
+import unittest, tempfile, os, shutil, subprocess, sys
 
-def fib_machine():
+def fib_machine(backend='interpret', stack=None):
     mac = make_machine(['continue', 'n', 'val'],
                        {
-            '-': lambda args: args[0] - args[1],
-            '+': lambda args: args[0] + args[1],
-            '<': lambda args: args[0] < args[1],
+            '-': lambda a, b: a - b,
+            '+': lambda a, b: a + b,
+            '<': lambda a, b: a < b,
             },
                        """
                            (
@@ -43,20 +43,13 @@ def fib_machine():
                                (assign val (reg n))
                                (goto (reg continue))
                             fib-done)
-                           """
+                           """,
+                       backend,
+                       stack=stack
                        )
     return mac
 
-def gcd_machine():
-
-    def op_equal(args):
-        print "op_equal: ", args
-        return  args[0] == args[1]
-
-    mac = make_machine(['a', 'b', 't'],
-                           {'rem': lambda args: args[0] % args[1],
-                            '=' : op_equal},
-                           """
+gcd_controller = """
                            (test-b
                                (test (op =) (reg b) (const 0))
                                (branch (label gcd-done))
@@ -65,6 +58,17 @@ def gcd_machine():
                               (assign b (reg t))
                                (goto (label test-b))
                             gcd-done)"""
+
+def gcd_machine(backend='interpret', controller=gcd_controller):
+
+    def op_equal(a, b):
+        return a == b
+
+    mac = make_machine(['a', 'b', 't'],
+                           {'rem': lambda a, b: a % b,
+                            '=' : op_equal},
+                           controller,
+                           backend
                            )
 
     return mac
@@ -92,6 +96,554 @@ class TestMachine(unittest.TestCase):
         
         mac.start()
         self.assertEqual(get_register_contents(mac, 'a'), 7)
-        
+
+    def testlabel_value(self):
+        mac = make_machine(['continue', 'val'],
+                           {},
+                           """
+                           (
+                               (assign continue (label here))
+                               (goto (label jump))
+                            here
+                               (assign val (const 2))
+                               (goto (label done))
+                            jump
+                               (assign val (const 1))
+                               (goto (reg continue))
+                            done)"""
+                           )
+        mac.start()
+        self.assertEqual(get_register_contents(mac, 'continue'), 2)
+        self.assertEqual(get_register_contents(mac, 'val'), 2)
+        self.assertEqual(get_register_contents(mac, 'pc'), 6)
+
+    def testfib_closure(self):
+        mac = fib_machine('closure')
+        for n, val in [(5, 5), (6, 8), (15, 610)]:
+            set_register_contents(mac, 'n', n)
+            mac.start()
+            self.assertEqual(get_register_contents(mac, 'val'), val)
+            self.assertEqual(get_register_contents(mac, 'pc'),
+                             len(mac.instruction_sequence()))
+
+    def testgcd_closure(self):
+        mac = gcd_machine('closure')
+        set_register_contents(mac, 'a', 35)
+        set_register_contents(mac, 'b', 49)
+        mac.start()
+        self.assertEqual(get_register_contents(mac, 'a'), 7)
+
+    def testfib_block(self):
+        interpreted = fib_machine()
+        mac = fib_machine('block')
+        for n in range(12):
+            for m in (interpreted, mac):
+                set_register_contents(m, 'n', n)
+                m.start()
+            for name in ('val', 'n', 'continue', 'flag', 'pc'):
+                self.assertEqual(get_register_contents(mac, name),
+                                 get_register_contents(interpreted, name))
+            self.assertEqual(mac.get_stack().stack, interpreted.get_stack().stack)
+
+    def testgcd_block(self):
+        mac = gcd_machine('block')
+        set_register_contents(mac, 'a', 35)
+        set_register_contents(mac, 'b', 49)
+        mac.start()
+        self.assertEqual(get_register_contents(mac, 'a'), 7)
+
+    def testblock_error_writes_back(self):
+        def fail(a):
+            raise ValueError(a)
+
+        mac = make_machine(['a', 'b'], {'fail': fail},
+                           """(
+                                (assign a (const 1))
+                                (assign b (op fail) (reg a)))""",
+                           'block')
+        self.assertRaises(ValueError, mac.start)
+        self.assertEqual(get_register_contents(mac, 'a'), 1)
+
+    def testclosure_branch_target(self):
+        # testとbranchをまとめても, branchへ直接飛んでくる経路は残る
+        mac = make_machine(['a', 'continue'],
+                           {'=': lambda a, b: a == b},
+                           """
+                           (
+                               (assign a (const 0))
+                               (test (op =) (reg a) (const 1))
+                               (goto (label check))
+                            check
+                               (branch (label done))
+                               (assign a (const 1))
+                            done)""",
+                           'closure')
+        mac.start()
+        self.assertEqual(get_register_contents(mac, 'a'), 1)
+        self.assertEqual(get_register_contents(mac, 'flag'), False)
+
+    def testdispatch(self):
+        controller = """
+                           (
+                               (dispatch (op kind) (reg a)
+                                         ((small on-small)
+                                          (large on-large))
+                                         (label on-other))
+                            on-small
+                               (assign b (const small))
+                               (goto (label done))
+                            on-large
+                               (assign b (const large))
+                               (goto (label done))
+                            on-other
+                               (assign b (const other))
+                            done)"""
+        def kind(a):
+            if a < 10: return 'small'
+            if a < 100: return 'large'
+            return 'huge'
+
+        for backend in ('interpret', 'closure', 'block'):
+            mac = make_machine(['a', 'b'], {'kind': kind}, controller, backend)
+            for a, b in [(1, 'small'), (50, 'large'), (500, 'other')]:
+                set_register_contents(mac, 'a', a)
+                mac.start()
+                self.assertEqual(get_register_contents(mac, 'b'), b)
+
+    def testdispatch_unknown_label(self):
+        try:
+            make_machine(['a'], {'kind': lambda a: a},
+                         """((dispatch (op kind) (reg a) ((x to-x)) (label done)) done)""")
+        except UnknownLabelError, e:
+            self.assertEqual(e.args, ('to-x',))
+        else:
+            self.fail()
+
+    def testunknown_backend(self):
+        self.assertRaises(UnknownBackendError, make_machine, ['a'], {},
+                          """((assign a (const 1)))""", 'nothing')
+
+    def testduplicate_label(self):
+        self.assertRaises(DuplicateLabelError, make_machine, ['a'], {},
+                          """(start (assign a (const 1)) start)""")
+
+    def testunknown_label(self):
+        try:
+            make_machine(['a'], {},
+                         """(start
+                                (goto (label nowhere))
+                                (assign a (label elsewhere))
+                                (goto (label start)))""")
+        except UnknownLabelError, e:
+            self.assertEqual(e.args, ('nowhere', 'elsewhere'))
+        else:
+            self.fail()
+
+    def testlarge_controller(self):
+        # 再帰で命令列を作っていた頃は再帰の上限に引っかかっていた
+        n = 20000
+        text = [Ident(u'start')]
+        for i in xrange(n):
+            text.append(Ident(u'l%d' % i))
+            text.append([Ident(u'assign'), Ident(u'a'), [Ident(u'const'), i]])
+        text.append([Ident(u'goto'), [Ident(u'label'), Ident(u'done')]])
+        text.append(Ident(u'done'))
+
+        mac = Machine()
+        mac.allocate_register('a')
+        insts = assemble_program(text, mac)
+        mac.install_instruction_sequence(insts)
+        self.assertEqual(len(insts), n + 1)
+        mac.start()
+        self.assertEqual(get_register_contents(mac, 'a'), n - 1)
+
+    def testprogram_image(self):
+        program = assemble_controller(gcd_controller)
+        self.assertEqual(program.labels, {'test-b': 0, 'gcd-done': 6})
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            write_program_image(program, path)
+            loaded = read_program_image(path)
+            self.assertEqual(loaded.texts, program.texts)
+            for backend in ('interpret', 'closure', 'block'):
+                mac = gcd_machine(backend, loaded)
+                set_register_contents(mac, 'a', 35)
+                set_register_contents(mac, 'b', 49)
+                mac.start()
+                self.assertEqual(get_register_contents(mac, 'a'), 7)
+
+            f = open(path, 'wb')
+            f.write(dump_binary([1, 2, 3]))
+            f.close()
+            self.assertRaises(BadProgramImageError, read_program_image, path)
+            f = open(path, 'wb')
+            f.write('(test-b)')
+            f.close()
+            self.assertRaises(BadProgramImageError, read_program_image, path)
+        finally:
+            os.remove(path)
+
+    def testprogram_cache(self):
+        ops = {'rem': lambda a, b: a % b, '=': lambda a, b: a == b}
+        directory = tempfile.mkdtemp()
+        try:
+            cache = ProgramCache(os.path.join(directory, 'cache'))
+            def run(ops):
+                mac = make_machine(['a', 'b', 't'], ops, gcd_controller, 'closure', cache)
+                set_register_contents(mac, 'a', 35)
+                set_register_contents(mac, 'b', 49)
+                mac.start()
+                self.assertEqual(get_register_contents(mac, 'a'), 7)
+
+            run(ops)
+            run(ops)
+            self.assertEqual((cache.hits, cache.misses), (0, 1))
+            cache = ProgramCache(cache.directory)
+            run(ops)
+            self.assertEqual((cache.hits, cache.misses), (1, 0))
+            # 演算の名前が変われば別のイメージになる
+            run(dict(ops, extra=None))
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            names = os.listdir(cache.directory)
+            self.assertEqual(len(names), 2)
+            self.assertTrue(all(name.endswith('.sxb') for name in names))
+
+            # 壊れたイメージは作り直す
+            path = cache.path(gcd_controller, ops.keys())
+            f = open(path, 'wb')
+            f.write('SXB')
+            f.close()
+            cache = ProgramCache(cache.directory)
+            run(ops)
+            self.assertEqual((cache.hits, cache.misses), (0, 1))
+            cache = ProgramCache(cache.directory)
+            run(ops)
+            self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+            # 書けないディレクトリでもアセンブルして動く
+            cache = ProgramCache(path)
+            run(ops)
+            self.assertEqual(cache.misses, 1)
+        finally:
+            shutil.rmtree(directory)
+
+    # fib(5)では, n >= 2の呼び出し7回がそれぞれ4回pushし, 深さは2 * (n - 1)まで
+    def teststack_statistics(self):
+        for backend in ('interpret', 'closure', 'block'):
+            stack = InstrumentedStack()
+            mac = fib_machine(backend, stack)
+            set_register_contents(mac, 'n', 5)
+            mac.start()
+            self.assertEqual(get_register_contents(mac, 'val'), 5)
+            self.assertEqual(stack.statistics(), {'total-pushes': 28, 'maximum-depth': 8})
+            self.assertEqual(stack.depth(), 0)
+            stack.initialize()
+            self.assertEqual(stack.statistics(), {'total-pushes': 0, 'maximum-depth': 0})
+
+    def testarray_stack(self):
+        for backend in ('interpret', 'closure', 'block'):
+            mac = fib_machine(backend, ArrayStack('l'))
+            for n, value in [(10, 55), (15, 610)]:
+                set_register_contents(mac, 'n', n)
+                mac.start()
+                self.assertEqual(get_register_contents(mac, 'val'), value)
+
+        stack = ArrayStack('d')
+        for i in range(5):
+            stack.push(i + .5)
+        self.assertEqual(stack.pop(), 4.5)
+        self.assertEqual(stack.depth(), 4)
+        stack.initialize()
+        self.assertEqual(stack.depth(), 0)
+        self.assertRaises(IndexError, stack.pop)
+
+    def teststack_initialize(self):
+        stack = Stack()
+        push = stack.push
+        push(1)
+        stack.initialize()
+        push(2)
+        self.assertEqual(stack.pop(), 2)
+        self.assertRaises(IndexError, stack.pop)
+
+    # レジスタはレジスタファイルの添字で, 定数のスロットはその後ろに足される
+    def testregister_file(self):
+        for backend in ('interpret', 'closure', 'block'):
+            mac = fib_machine(backend)
+            regs = mac.register_file()
+            self.assertEqual(mac.register_number('pc'), 0)
+            self.assertEqual(mac.register_number('flag'), 1)
+            val = mac.get_register('val')
+            set_register_contents(mac, 'n', 10)
+            mac.start()
+            self.assertEqual(val.get(), 55)
+            self.assertEqual(regs[mac.register_number('val')], 55)
+            val.set(3)
+            self.assertEqual(get_register_contents(mac, 'val'), 3)
+            self.assertRaises(KeyError, mac.register_number, 'nothing')
+            self.assertRaises(AllocateRegisterError, mac.allocate_register, 'val')
+
+            # コンパイルし直しても定数のスロットは増えない
+            compile_steps(mac.instruction_sequence(), mac.labels(), mac)
+            size = len(regs)
+            compile_steps(mac.instruction_sequence(), mac.labels(), mac)
+            mac.enable_tracing(10)
+            mac.enable_profiling()
+            self.assertEqual(len(regs), size)
+
+    # fib(5)は15回呼ばれ, そのうちn < 2の8回がimmediate-answerに行く
+    def testprofiler(self):
+        import json, pstats
+        directory = tempfile.mkdtemp()
+        try:
+            for backend in ('interpret', 'closure', 'block'):
+                mac = fib_machine(backend)
+                profiler = mac.enable_profiling()
+                set_register_contents(mac, 'n', 5)
+                mac.start()
+                self.assertEqual(get_register_contents(mac, 'val'), 5)
+                self.assertEqual(profiler.instructions(), 166)
+                blocks = dict((block['label'], block) for block in profiler.label_statistics())
+                self.assertEqual(dict((label, block['entries']) for label, block in blocks.items()),
+                                 {None: 1, 'fib-loop': 15, 'afterfib-n-1': 7,
+                                  'afterfib-n-2': 7, 'immediate-answer': 8})
+                self.assertEqual(blocks['fib-loop']['instructions'], 15 * 2 + 7 * 5)
+                counts = profiler.instruction_statistics()
+                self.assertEqual(counts[1], {'offset': 1, 'label': 'fib-loop',
+                                             'instruction': '(test (op <) (reg n) (const 2))',
+                                             'count': 15, 'time': counts[1]['time']})
+
+                path = os.path.join(directory, 'fib.json')
+                f = open(path, 'w')
+                profiler.write_json(f)
+                f.close()
+                self.assertEqual(json.load(open(path))['instructions'], 166)
+                path = os.path.join(directory, 'fib.prof')
+                profiler.dump_stats(path)
+                stats = pstats.Stats(path)
+                self.assertEqual(stats.stats[('<controller>', 1, 'fib-loop')][:2], (15, 15))
+
+                self.assertTrue(mac.disable_profiling() is profiler)
+                mac.start()
+                self.assertEqual(profiler.instructions(), 166)
+        finally:
+            shutil.rmtree(directory)
+
+    # gcd(206, 40)ではremが4回, =が5回呼ばれる
+    def testoperation_profiler(self):
+        for backend in ('interpret', 'closure', 'block'):
+            for sample, sampled in [(1, 5), (2, 2)]:
+                profiler = OperationProfiler(sample)
+                mac = make_machine(['a', 'b', 't'],
+                                   profiler.wrap({'rem': lambda a, b: a % b,
+                                                  '=': lambda a, b: a == b}),
+                                   gcd_controller, backend)
+                set_register_contents(mac, 'a', 206)
+                set_register_contents(mac, 'b', 40)
+                mac.start()
+                self.assertEqual(get_register_contents(mac, 'a'), 2)
+                stats = dict((stat['operation'], stat) for stat in profiler.statistics())
+                self.assertEqual(stats['rem']['calls'], 4)
+                self.assertEqual(stats['=']['calls'], 5)
+                self.assertEqual(stats['=']['sampled-calls'], sampled)
+
+        profiler = OperationProfiler()
+        length = profiler.wrap({'length': len})['length']
+        self.assertEqual(length([1, 2, 3]), 3)
+        self.assertEqual(length(()), 0)
+        stat = profiler.statistics()[0]
+        self.assertEqual((stat['calls'], stat['mean-argument-size'],
+                          stat['maximum-argument-size']), (2, 1.5, 3))
+        profiler.reset()
+        self.assertEqual(profiler.statistics(), [])
+        self.assertRaises(ValueError, OperationProfiler, 0)
+
+    # 評価器の引数リストは対をたどり, カーソルは残りの要素を数える
+    def testargument_size(self):
+        from evaluator import Cursor, empty_arglist, adjoin_arg
+        arglist = empty_arglist()
+        for arg in xrange(5):
+            arglist = adjoin_arg(arg, arglist)
+        self.assertEqual(argument_size([arglist]), 5)
+        self.assertEqual(argument_size([adjoin_arg(1, empty_arglist())]), 1)
+        self.assertEqual(argument_size([Cursor(range(10), 3), (1, 2, 3), {1: 2}, 7]), 11)
+
+    # fib(5)は166ステップ. 50個の環状バッファには最後の50ステップが残る
+    def testtrace(self):
+        from replay import read_trace
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'fib.trace')
+            mac = fib_machine('interpret')
+            tracer = mac.enable_tracing(1000)
+            set_register_contents(mac, 'n', 5)
+            mac.start()
+            write_trace(tracer, path)
+            full = read_trace(path)
+            self.assertEqual((full.first, len(full)), (0, 166))
+            self.assertEqual(full.state_at(-1), {'pc': 0, 'flag': None, 'continue': None,
+                                                 'n': 5, 'val': None})
+            self.assertEqual(full.event(1), (1, 'fib-loop', ['test', ['op', '<'], ['reg', 'n'],
+                                                             ['const', 2]], 'flag', False))
+
+            # 実行の合間の書き換えはpcが-1の事象になる
+            set_register_contents(mac, 'n', 3)
+            mac.start()
+            write_trace(tracer, path)
+            second = read_trace(path)
+            self.assertEqual(len(second), 166 + 1 + 51)
+            self.assertEqual(second.event(166), (-1, None, None, 'n', 3))
+            self.assertEqual(second.state_at(166)['n'], 3)
+
+            for backend in ('interpret', 'closure', 'block'):
+                mac = fib_machine(backend)
+                tracer = mac.enable_tracing(50)
+                set_register_contents(mac, 'n', 5)
+                mac.start()
+                write_trace(tracer, path)
+                trace = read_trace(path)
+                self.assertEqual((trace.first, len(trace)), (116, 50))
+                for step in (115, 130, 165):
+                    self.assertEqual(trace.state_at(step), full.state_at(step))
+                self.assertEqual(trace.state_at(165)['val'], 5)
+                self.assertEqual(trace.state_at(165)['pc'], None)
+                self.assertRaises(IndexError, trace.state_at, 114)
+
+                set_register_contents(mac, 'n', 3)
+                mac.start()
+                write_trace(mac.disable_tracing(), path)
+                trace = read_trace(path)
+                self.assertEqual(trace.first + len(trace), 166 + 1 + 51)
+                for step in (trace.first - 1, 200, 217):
+                    self.assertEqual(trace.state_at(step), second.state_at(step))
+        finally:
+            shutil.rmtree(directory)
+
+    def testlimit(self):
+        for backend in ('interpret', 'closure', 'block'):
+            mac = fib_machine(backend)
+            set_register_contents(mac, 'n', 5)
+            suspension = mac.start(limit=100)
+            self.assertEqual((suspension.reason, suspension.executed), ('limit', 100))
+            self.assertTrue(mac.suspension() is suspension)
+            self.assertEqual(suspension.pc, get_register_contents(mac, 'pc'))
+            suspension = mac.proceed(limit=60)
+            self.assertEqual(suspension.executed, 60)
+            self.assertEqual(mac.proceed(limit=6), 'done')
+            self.assertEqual(get_register_contents(mac, 'val'), 5)
+            self.assertEqual(mac.suspension(), None)
+
+            set_register_contents(mac, 'n', 10)
+            self.assertEqual(mac.start(limit=100000), 'done')
+            self.assertEqual(get_register_contents(mac, 'val'), 55)
+
+    # gcd(206, 40)ではtest-bに5回来る
+    def testbreakpoint(self):
+        for backend in ('interpret', 'closure', 'block'):
+            mac = gcd_machine(backend)
+            mac.set_breakpoint('test-b')
+            mac.set_breakpoint('test-b', 2)
+            set_register_contents(mac, 'a', 206)
+            set_register_contents(mac, 'b', 40)
+            suspension = mac.start()
+            self.assertEqual((suspension.reason, suspension.breakpoint, suspension.executed),
+                             ('breakpoint', ('test-b', 0), 0))
+            stops = []
+            while suspension != 'done':
+                stops.append((suspension.breakpoint[1], get_register_contents(mac, 'b')))
+                suspension = mac.proceed()
+            self.assertEqual(stops, [(0, 40), (2, 40), (0, 6), (2, 6), (0, 4), (2, 4),
+                                     (0, 2), (2, 2), (0, 0)])
+            self.assertEqual(get_register_contents(mac, 'a'), 2)
+
+            mac.cancel_breakpoint('test-b', 2)
+            set_register_contents(mac, 'a', 206)
+            set_register_contents(mac, 'b', 40)
+            self.assertEqual(mac.start().breakpoint, ('test-b', 0))
+            mac.cancel_all_breakpoints()
+            self.assertEqual(mac.proceed(), 'done')
+            self.assertRaises(UnknownLabelError, mac.set_breakpoint, 'nowhere')
+
+    def testtimeout(self):
+        for backend in ('interpret', 'closure', 'block'):
+            mac = make_machine(['a'], {'+': lambda a, b: a + b},
+                               """(
+                                   (assign a (const 0))
+                                loop
+                                   (assign a (op +) (reg a) (const 1))
+                                   (goto (label loop)))""",
+                               backend)
+            suspension = mac.start(timeout=0.05)
+            self.assertEqual(suspension.reason, 'deadline')
+            count = get_register_contents(mac, 'a')
+            self.assertTrue(count > 0)
+            self.assertEqual(mac.proceed(limit=4).reason, 'limit')
+            self.assertEqual(get_register_contents(mac, 'a'), count + 2)
+
+    # 途中で止めた機械を保存し, 別のバックエンド, 別のスタックの機械で続ける
+    def testsnapshot(self):
+        import StringIO
+        for backend, other in [('interpret', 'block'), ('closure', 'interpret'),
+                               ('block', 'closure')]:
+            mac = fib_machine(backend)
+            set_register_contents(mac, 'n', 10)
+            mac.start(limit=300)
+            stream = StringIO.StringIO()
+            dump_snapshot(mac, stream)
+
+            restored = fib_machine(other, ArrayStack('l'))
+            self.assertEqual(load_snapshot(StringIO.StringIO(stream.getvalue()), restored), {})
+            for name in ('n', 'val', 'continue', 'flag', 'pc'):
+                self.assertEqual(get_register_contents(restored, name),
+                                 get_register_contents(mac, name))
+            self.assertEqual(restored.get_stack().contents(), mac.get_stack().contents())
+            self.assertEqual(restored.proceed(), 'done')
+            self.assertEqual(get_register_contents(restored, 'val'), 55)
+
+            self.assertRaises(BadSnapshotError, load_snapshot,
+                              StringIO.StringIO(stream.getvalue()), gcd_machine(backend))
+            self.assertRaises(BadSnapshotError, load_snapshot,
+                              StringIO.StringIO(stream.getvalue()[:40]), fib_machine(backend))
+
+        self.assertEqual(pc_label({'a': 0, 'b': 3, 'c': 3}, 5), ('b', 2))
+        self.assertEqual(pc_label({'a': 2}, 1), (None, 1))
+
+# importにかかる時間と, importで読み込まれるモジュール. 新しいプロセスで測る
+import_check = """
+import sys, time
+start = time.time()
+import %s
+elapsed = time.time() - start
+import simplesexp
+print elapsed
+print ' '.join(name for name in ('tempfile', 'hashlib', 'unicodedata', 'mmap', 'codegen')
+               if name in sys.modules)
+print len(simplesexp.token_res)
+"""
+
+class TestImport(unittest.TestCase):
+    budget = 0.1
+
+    def run_import(self, module):
+        directory = os.path.dirname(os.path.abspath(__file__))
+        out = subprocess.check_output([sys.executable, '-c', import_check % module],
+                                      cwd=directory)
+        elapsed, modules, regexes = out.split('\n')[:3]
+        return float(elapsed), modules.split(), int(regexes)
+
+    def testimport_machine(self):
+        elapsed, modules, regexes = self.run_import('machine')
+        self.assertTrue(elapsed < self.budget, elapsed)
+        self.assertEqual(modules, [])
+        self.assertEqual(regexes, 0)
+
+    def testimport_evaluator(self):
+        elapsed, modules, regexes = self.run_import(
+            'evaluator; assert evaluator.the_global_environment is None')
+        self.assertTrue(elapsed < self.budget, elapsed)
+        self.assertEqual(modules, [])
+        self.assertEqual(regexes, 0)
+
 if __name__ == '__main__':
     unittest.main()
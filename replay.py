@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# トレースの再生
+#
+# write_traceで書き出したトレースを読み, 残っている事象を順にたどって
+# 任意のステップの後のレジスタの状態を復元する. ステップは実行全体での通し番号
+# (0から数える)で, トレースに残っている範囲(first .. first + len(events) - 1)を指定する.
+# stepにfirst - 1を与えると, 残っている最初の事象の前の状態(基準の状態)になる.
+#
+# 使い方: python replay.py トレース [ステップ]
+# ステップを省略すると事象を1行ずつ表示し, 与えるとその後のレジスタの状態を表示する.
+
+from machine import *
+import sys
+
+class Trace(object):
+
+    def __init__(self, registers, texts, labels, first, base, pcs, written, values, last):
+        self.names = dict((index, name) for name, index in registers.items())
+        self.texts = texts
+        self.labels = labels
+        self.first = first
+        self.base = base
+        self.pcs = pcs
+        self.written = written
+        self.values = values
+        self.last = last
+        self.block_labels = label_blocks(texts, labels)
+
+    def __len__(self):
+        return len(self.pcs)
+
+    def steps(self):
+        return xrange(self.first, self.first + len(self))
+
+    # ステップの事象: (pc, ラベル, 命令文, 書いたレジスタ名, 値)
+    # 機械の外からの書き換えはpcが-1で, ラベルと命令文はNone
+    def event(self, step):
+        i = self.position(step)
+        pc = self.pcs[i]
+        if pc >= 0:
+            label, text = self.block_labels[pc], self.texts[pc]
+        else:
+            label, text = None, None
+        r = self.written[i]
+        if r < 0:
+            return pc, label, text, None, None
+        return pc, label, text, self.names[r], self.values[i]
+
+    # stepの後のレジスタの状態(レジスタ名 -> 値). 'pc'は次に実行する命令のオフセット
+    def state_at(self, step):
+        if step == self.first - 1:
+            end = 0
+        else:
+            end = self.position(step) + 1
+        state = dict(self.base)
+        for i in xrange(end):
+            if self.written[i] >= 0:
+                state[self.names[self.written[i]]] = self.values[i]
+        state['pc'] = self.next_pc(end)
+        return state
+
+    def next_pc(self, i):
+        for pc in self.pcs[i:]:
+            if pc >= 0:
+                return pc
+        return None
+
+    def position(self, step):
+        if not self.first <= step < self.first + len(self):
+            raise IndexError('step %d is not in the trace (%d .. %d)'
+                             % (step, self.first, self.first + len(self) - 1))
+        return step - self.first
+
+def read_trace(path):
+    try:
+        image = load_binary_file(path)
+    except ParseError, e:
+        raise BadTraceError(path, str(e))
+    if not (isinstance(image, list) and len(image) == 10 and image[0] is trace_tag
+            and len(image[6]) == len(image[7]) == len(image[8])):
+        raise BadTraceError(path)
+    return Trace(*image[1:])
+
+def print_events(trace):
+    for step in trace.steps():
+        pc, label, text, name, value = trace.event(step)
+        line = '%8d %5d %-24s %s' % (step, pc, label or '', dump([text]) if text else '')
+        if name is not None:
+            line += '  ; %s = %s' % (name, dump_value(value))
+        print line
+
+def print_state(trace, step):
+    state = trace.state_at(step)
+    for name in sorted(state):
+        print '%-12s %s' % (name, dump_value(state[name]))
+
+def dump_value(value):
+    try:
+        return dump([value])
+    except Exception:
+        return repr(value)
+
+if __name__ == '__main__':
+    trace = read_trace(sys.argv[1])
+    if sys.argv[2:]:
+        print_state(trace, int(sys.argv[2]))
+    else:
+        print_events(trace)
@@ -11,22 +11,36 @@
 __author__  = u"Yusuke Inuzuka"
 __version__ = u"0.1"
 __date__    = u"2008-09-18"
-__all__ = ["ParseError", "Ident","Symbol", "Pair", "Reader", "Dumper", "read", "dump", "default_binding"]
-import re, sys
-from unicodedata import east_asian_width
- 
-try:
-  from re import Scanner
-except ImportError:
-  from sre import Scanner
+__all__ = ["ParseError", "Ident","Symbol", "Pair", "Reader", "Dumper", "read", "dump", "default_binding",
+           "BinaryDumper", "BinaryLoader", "dump_binary", "load_binary", "load_binary_file"]
+import os, re, sys, codecs, struct
+from array import array
  
 class ParseError(StandardError): pass
  
-class Ident(unicode):
+# 識別子と記号は綴りごとに1つのオブジェクトにまとめる(intern). 同じ綴りのものは
+# isで比べられ, 何度現れても記憶を共有する. 表はクラスごとに持ち, 取り除かない.
+class Interned(unicode):
+  __slots__ = ()
+  def __new__(cls, value=u""):
+    try:
+      return cls.table[value]
+    except KeyError:
+      obj = unicode.__new__(cls, value)
+      cls.table[obj] = obj
+      return obj
+  def __reduce__(self):
+    return (self.__class__, (unicode(self),))
+
+class Ident(Interned):
+  __slots__ = ()
+  table = {}
   def __repr__(self):
     return "Ident(%s)"%unicode.__repr__(self)
 
-class Symbol(unicode):
+class Symbol(Interned):
+  __slots__ = ()
+  table = {}
   def __repr__(self):
     return "Symbol(%s)"%unicode.__repr__(self)
 
@@ -34,13 +48,6 @@ class Pair(list):
   def __repr__(self):
     return "Pair(%s)"%list.__repr__(self)
 
-class Token(object):
-  def __init__(self, value, pos):
-    self.value = value
-    self.pos   = pos
-  def __repr__(self):
-    return repr(self.value)
-
 class Binding(object):
   def __init__(self, dct):
     self.dct = dict(((k, k.__class__), v) for k,v in dct.iteritems())
@@ -49,182 +56,687 @@ class Binding(object):
 
 default_binding = {"#t":True, "true":True, "#f":False, "false":False, "nil":None, "dict":Ident(u'alist->hash-table')}
 
+QUOTE = Ident(u"quote")
+DOT = Ident(u".")
+ALIST = Ident(u"alist->hash-table")
+
+# 字句の正規表現. 数や記号で始まらない識別子を先に調べるほかは以前のScannerと同じ順に並べ,
+# 何番目の組に当たったかで種類を見る.
+# 整数は16進, 8進とlong(接尾辞l)をINTとしてparse_intで読み, それ以外の10進数をDECとする.
+(WORD, OPEN_PAREN, CLOSE_PAREN, COMMENT, STRING, OPEN_BRACKET, CLOSE_BRACKET,
+ FLOAT, INT, DEC, SYMBOL, QUOTE_MARK, DOT_MARK, IDENT, UNTERM_STRING) = range(1, 16)
+
+CLOSING = {CLOSE_PAREN:OPEN_PAREN, CLOSE_BRACKET:OPEN_BRACKET}
+
+token_pattern = r"""\s*(?:
+  ([^\(\[\)\]\s"\d\.\-';%(first)s][^\(\[\)\]\s"]*)
+ |(\()|(\))
+ |(;[^\n]*\n?)
+ |("(?:[^"\\]|\\.)*")
+ |(\[)|(\])
+ |((?:(?:\d+|\d*\.\d+|\d+\.)e[\+\-]?\d+)|\d*\.\d+|\d+\.)
+ |(\-?(?:0x[\da-f]+|0[0-7]+)l?|\-?(?:[1-9]\d*|0)l)
+ |(\-?(?:[1-9]\d*|0))
+ |(%(marker)s[^\(\[\)\]\s"]+)
+ |(')
+ |(\.)(?![^\(\[\)\]\s"])
+ |([^\(\[\)\]\s"]+)
+ |(")
+)"""
+
+token_res = {}
+
+def token_re(symbol_marker):
+  if symbol_marker not in token_res:
+    pattern = token_pattern % {"first": re.escape(symbol_marker[:1]),
+                               "marker": re.escape(symbol_marker)}
+    token_res[symbol_marker] = re.compile(pattern, re.S | re.I | re.X)
+  return token_res[symbol_marker]
+
+def parse_int(s):
+  if s[-1] in "lL":
+    convert, s = long, s[:-1]
+  else:
+    convert = int
+  digits = s.lstrip("-")
+  if digits[:2] in ("0x", "0X"):
+    return convert(s, 16)
+  elif len(digits) > 1 and digits[0] == "0":
+    return convert(s, 8)
+  return convert(s)
+
+def unescape(s):
+  if isinstance(s, unicode):
+    if "\\" not in s:
+      return s
+    s = s.encode("raw_unicode_escape")
+  return s.decode("unicode_escape")
+
+# 要素がすべてintかすべてfloatのリストはarrayにする(compactモード)
+def compact_list(items):
+  if not items:
+    return items
+  t = type(items[0])
+  if t is int:
+    typecode = "l"
+  elif t is float:
+    typecode = "d"
+  else:
+    return items
+  for x in items:
+    if type(x) is not t:
+      return items
+  return array(typecode, items)
+
+missing = object()
+
 class Reader(object):
-  PAREN = {"]":"[", ")":"("}
-  def __init__(self, binding=None, symbol_marker="'", use_dict=True):
+  # compactを真にすると, 数だけのリストをarray.arrayで作る
+  def __init__(self, binding=None, symbol_marker="'", use_dict=True, compact=False):
     self.binding = binding or default_binding
     self.symbol_marker = symbol_marker
     self.use_dict = use_dict
+    self.compact = compact
+    self.encoding = None
+
+  # 字句の正規表現は最初に読み込むときにコンパイルする
+  @property
+  def token_re(self):
+    return token_re(self.symbol_marker)
 
   def read(self, value):
+    self.start()
+    self.scan(value, True)
+    if self.stack:
+      self.raise_error("missing closing parenthesis.")
+    result = self.convert(self.result)
+    self.start()
+    return result
+
+  # ファイルをmmapして, 文字列に読み込まずにそのまま字句を切り出す.
+  # 識別子と記号は読み込み中に同じ綴りのものを1つのオブジェクトにまとめる.
+  def read_file(self, path, encoding="utf-8"):
+    import mmap
+    f = open(path, "rb")
+    try:
+      if not os.fstat(f.fileno()).st_size:
+        return []
+      source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+      f.close()
+    self.encoding = encoding
+    try:
+      return self.read(source)
+    finally:
+      self.encoding = None
+      source.close()
+
+  # streamから読めたトップレベルの要素を1つずつ返す. streamはreadlineを持つファイルや
+  # ソケット(makefile)か, 文字列の断片を返すイテレータ. 読み込んだ文字列は行の区切りまで
+  # 解析して捨てるので, 使う記憶は読みかけの要素の大きさで決まる.
+  # encodingを与えるとバイト列を復号してから読む.
+  def iter_read(self, stream, encoding=None, size=65536):
+    if hasattr(stream, "readline"):
+      chunks = iter(lambda: stream.readline(size), "")
+    else:
+      chunks = iter(stream)
+    decoder = encoding and codecs.getincrementaldecoder(encoding)()
+    self.start()
+    result = self.result
+    buf = u"" if encoding else ""
+    for chunk in chunks:
+      if decoder:
+        chunk = decoder.decode(chunk)
+      buf += chunk
+      cut = buf.rfind("\n") + 1
+      if not cut:
+        continue
+      buf = self.consume(buf, self.scan(buf[:cut], False))
+      if not self.stack:
+        self.pairs.clear()
+        self.dotted.clear()
+      for v in result:
+        yield v
+      del result[:]
+
+    if decoder:
+      buf += decoder.decode("", True)
+    self.scan(buf, True)
+    if self.stack:
+      self.raise_error("missing closing parenthesis.")
+    for v in result:
+      yield v
+    self.start()
+
+  def start(self):
+    self.source = ""
+    self.pos = 0
+    self.line_offset = 0      # sourceより前に読んで捨てた行数と, sourceの先頭の桁
+    self.column_offset = 0
     self.result = []
-    self.paren_stack = []
+    self.stack = []           # (開き括弧の種類, 要素のリスト). QUOTE_MARKはquoteの後の1要素を待っている
+    self.pairs = {}
+    self.dotted = {}          # "."を要素に持つリスト(idが使い回されないよう本体も持つ)
+    self.atoms = {}           # 字句の綴りから識別子・記号・束縛された値への表
+
+  # bufのstopまでを解析済みとして捨て, 行と桁の位置を進める
+  def consume(self, buf, stop):
+    newline = buf.rfind("\n", 0, stop)
+    if newline >= 0:
+      self.line_offset += buf.count("\n", 0, stop)
+      self.column_offset = stop - newline - 1
+    else:
+      self.column_offset += stop
+    return buf[stop:]
+
+  # 字句を1つずつ読み, リストは閉じ括弧のところで仕上げる.
+  # 数は接頭辞を読むだけなので, "123abc"は以前と同じく123とabcになる.
+  # finalでなければ閉じていない文字列の手前で止まり, その位置を返す.
+  def scan(self, value, final):
     self.source = value
     self.pos = 0
-    self.quoted = False
-    self.scanner = Scanner([
-      (r"\s+", self("skip")),
-      (r";[^\n]*\n", self("skip")),
-      (r""""(((?<=\\)")|[^"])*((?<!\\)")""", self("str")),
-      (r"(\(|\[)", self("open")),
-      (r"(\)|\])", self("close")),
-      (r"(([\d]+|(((\d+)?\.[\d]+)|([\d]+\.)))e[\+\-]?[\d]+)|(((\d+)?\.[\d]+)|([\d]+\.))", self("number")),
-      (r"\-?((0x[\da-f]+)|(0[0-7]+)|([1-9][\d]*)|0)[l]?", self("number")),
-      (r"""%s([^\(\[\)\]\s"]+)"""%self.symbol_marker, self("symbol")),
-      (r"'", self("quote")),
-      (r"""([^\(\[\)\]\s"]+)""", self("ident")),
-      (r"""".*""", self("unterm_str")),
-      (r".*", self("unknown_token"))
-    ], re.M|re.S|re.I)
-    self.scanner.scan(self.source)
-    if self.paren_stack:
-      self.raise_error("missing closing parenthesis.")
-    return self.parse(self.result)
+    dotted = self.dotted
+    atoms = self.atoms
+    use_dict = self.use_dict
+    compact = self.compact
+    encoding = self.encoding
+    result = self.result
+    stack = self.stack
+    kind, items = stack[-1] if stack else (None, result)
 
-  def append(self, v):
-    if self.quoted:
-      quote_lst = self.paren_stack.pop()[1]
-      quote_lst.append(Token(v, self.pos))
-      self.quoted = False
-    else:
-      self.last().append(Token(v, self.pos))
- 
-  def __call__(self, name):
-    def _(scanner, s):
-      self.pos += len(s)
-      return getattr(self, name)(s)
-    return _
- 
-  def unknown_token(self,s): self.raise_error("unknown token: %s"%s)
-  def skip(self, _): pass
-  def quote(self, _):
-    new_lst = []
-    self.last().append(new_lst)
-    self.paren_stack.append(['quote', new_lst])
-    self.append(Ident('quote'))
-    self.quoted = True
-  def open(self, s):
-      new_lst = []
-      if self.quoted:
-        quote_lst = self.paren_stack.pop()[1]
-        quote_lst.append(new_lst)
-        self.quoted = False
+    match = self.token_re.scanner(value).match
+    m = match()
+    while m is not None:
+      token = m.lastindex
+      if token == WORD or token == IDENT:
+        s = m.group(token)
+        v = atoms.get(s, missing)
+        if v is missing:
+          v = atoms[s] = self.atom(s)
+      elif token == OPEN_PAREN or token == OPEN_BRACKET:
+        kind, items = token, []
+        stack.append((kind, items))
+        m = match()
+        continue
+      elif token == CLOSE_PAREN or token == CLOSE_BRACKET:
+        self.pos = m.end()
+        if not stack:
+          self.raise_error("missing opening parenthesis.")
+        open_paren, v = stack.pop()
+        if open_paren != CLOSING[token]:
+          self.raise_error("missing closing parenthesis.")
+        if id(v) in dotted or (use_dict and v and v[0] == ALIST):
+          v = self.convert(v)
+        if compact and type(v) is list:
+          compacted = compact_list(v)
+          if compacted is not v and id(v) in self.pairs:
+            self.pairs[id(compacted)] = (compacted,) + self.pairs.pop(id(v))[1:]
+          v = compacted
+        kind, items = stack[-1] if stack else (None, result)
+      elif token == DEC:
+        v = int(m.group(DEC))
+      elif token == INT:
+        v = parse_int(m.group(INT))
+      elif token == FLOAT:
+        v = float(m.group(FLOAT))
+      elif token == STRING:
+        s = m.group(STRING)[1:-1]
+        if encoding:
+          s = self.text(s)
+        try:
+          v = unescape(s)
+        except UnicodeDecodeError, e:
+          self.pos = m.start(STRING)
+          self.raise_error("invalid escape sequence in string literal: %s." % e.reason)
+      elif token == SYMBOL:
+        s = m.group(SYMBOL)
+        v = atoms.get(s, missing)
+        if v is missing:
+          v = atoms[s] = Symbol(self.text(s[len(self.symbol_marker):]))
+      elif token == QUOTE_MARK:
+        kind, items = token, [QUOTE]
+        stack.append((kind, items))
+        m = match()
+        continue
+      elif token == DOT_MARK:
+        v = self.binding.get(m.group(DOT_MARK), DOT)
+        dotted[id(items)] = items
+      elif token == COMMENT:
+        m = match()
+        continue
+      elif not final:
+        return m.start(UNTERM_STRING)
       else:
-        self.last().append(new_lst)
-      self.paren_stack.append([s, new_lst])
-  def close(self, s):
-      if not self.paren_stack:
-        self.raise_error("missing opening parenthesis.")
-      if self.PAREN[s] != self.paren_stack.pop()[0]:
-        self.raise_error("missing closing parenthesis.")
-  def str(self, s): self.append(eval('u""'+s+'""'))
-  def unterm_str(self, s): self.raise_error("unterminated string literal.")
-  def number(self, s): self.append(eval(s))
-  def symbol(self, s): self.append(Symbol(s[1:]))
-  def ident(self, s): 
+        self.pos = len(value)
+        self.raise_error("unterminated string literal.")
+
+      if kind == QUOTE_MARK:
+        self.pos = m.end()
+        v = self.complete_quote(stack, v)
+        kind, items = stack[-1] if stack else (None, result)
+      items.append(v)
+      m = match()
+
+    self.pos = len(value)
+    return len(value)
+
+  def atom(self, s):
     if s in self.binding:
-      self.append(self.binding[s])
-    else:
-      self.append(Ident(s))
+      return self.binding[s]
+    return Ident(self.text(s))
 
-  def last(self):
-    if self.paren_stack:
-      return self.paren_stack[-1][1]
-    else:
-      return self.result
- 
-  def parse(self, rs):
-    def is_ident(value, expected):
-      return getattr(value,"value", None) == Ident(expected)
-    def is_pair(rs):
-      return getattr(rs, "__len__", lambda :0)()==3 and is_ident(rs[1], u".")
-
-    if isinstance(rs, list):
-      if not len(rs):
-        return []
-      elif self.use_dict and is_ident(rs[0], u"alist->hash-table"):
-        if len(rs) != 2:
-          self.raise_error("alist->hash-table: expected 1 arguments, got %d."%(len(rs)-1), rs[0].pos)
-        if not all(is_pair(a) for a in rs[1]):
-          self.raise_error("alist->hash-table: aruguments must be alist", rs[0].pos)
-        return dict((self.parse(i[0]), self.parse(i[2])) for i in rs[1])
-      elif len(rs)!=3 and any(is_ident(t, u".") for t in rs):
-        self.raise_error('illegal use of "."', rs[0].pos)
-      elif is_pair(rs):
-        parsed = self.parse(rs[2])
-        if not isinstance(rs[2], list):
-          return Pair([rs[0].value, parsed])
-        if isinstance(parsed, Pair):
-          return Pair([rs[0].value, parsed])
-        elif isinstance(parsed, list):
-          return [rs[0].value]+parsed
-        else:
-          return [rs[0].value, parsed]
-      else:
-        return map(self.parse, rs)
+  # read_fileではバイト列の字句を復号する
+  def text(self, s):
+    if self.encoding and not isinstance(s, unicode):
+      return s.decode(self.encoding)
+    return s
+
+  # quoteの後の要素が読めたら, quoteの式を仕上げて返す. quoteは入れ子になりうる.
+  def complete_quote(self, stack, v):
+    while stack and stack[-1][0] == QUOTE_MARK:
+      lst = stack.pop()[1]
+      lst.append(v)
+      v = self.convert(lst)
+    return v
+
+  # ドット対とalist->hash-tableを変換する. ドット対の要素はalistで使うので覚えておく.
+  def convert(self, rs):
+    n = len(rs)
+    if not n:
+      return rs
+    elif self.use_dict and rs[0] == ALIST:
+      if n != 2:
+        self.raise_error("alist->hash-table: expected 1 arguments, got %d."%(n-1))
+      dct = {}
+      for a in rs[1] if isinstance(rs[1], list) else [None]:
+        entry = self.pairs.get(id(a))
+        if entry is None or entry[0] is not a:
+          self.raise_error("alist->hash-table: aruguments must be alist")
+        dct[entry[1]] = entry[2]
+      return dct
+    elif id(rs) not in self.dotted:
+      return rs
+    elif n != 3:
+      self.raise_error('illegal use of "."')
+    elif rs[1] is not DOT:
+      return rs
+
+    car, cdr = rs[0], rs[2]
+    if isinstance(cdr, array):
+      cdr = cdr.tolist()
+    if isinstance(cdr, Pair) or not isinstance(cdr, (list, dict)):
+      v = Pair([car, cdr])
+    elif isinstance(cdr, list):
+      v = [car] + cdr
     else:
-      return rs.value
- 
+      v = [car, cdr]
+    if self.use_dict:
+      self.pairs[id(v)] = (v, car, cdr)
+    return v
+
   def raise_error(self, msg="parse error", pos=None, range=3):
     pos = pos or self.pos
+    if not isinstance(self.source, basestring):
+      head = self.text(self.source[:pos])
+      self.source, pos = head + self.text(self.source[pos:]), len(head)
     lines = self.source.split("\n")
     curline = self.source[:pos].count("\n")
     linepos = pos - len("\n".join(lines[:curline]))
+    if curline == 0:
+      linepos += self.column_offset
     buf = ["\n"]
     for i in xrange(max(0, curline-range), curline+1):
-      buf.append("% 5d: %s"%(i+1, lines[i]))
+      buf.append("% 5d: %s"%(i+1+self.line_offset, lines[i]))
+    from unicodedata import east_asian_width
     width = 7 + sum(east_asian_width(c) == 'W' and 2 or 1 for c in unicode(lines[i]))
     buf.append("%s~"%(" "*width))
-    buf.append("line %d, %d: %s"%(curline+1,linepos, msg))
-    raise ParseError(("\n".join(buf)).encode(sys.stderr.encoding))
+    buf.append("line %d, %d: %s"%(curline+1+self.line_offset,linepos, msg))
+    raise ParseError(("\n".join(buf)).encode(sys.stderr.encoding or "utf-8"))
 
+# 書き出しは再帰せず, 書きかけのリストの反復子を明示的なスタックに積んでいく.
+# 深くネストしたリスト(長いPairの連鎖など)でも再帰の上限に当たらない.
+# 書き出した断片はbuffer_size個たまるごとにwriteへ渡す.
+# 最上位のリストは括弧を付けず, 要素を1行に1つずつ書く(readの結果と対応する).
 class Dumper(object):
+  buffer_size = 4096
+
   def __init__(self, binding=None ,symbol_marker="'"):
     binding = binding or default_binding
     self.binding = Binding(dict(zip(binding.values(), binding)))
     self.symbol_marker = symbol_marker
+    self.idents = dict((k, v) for (k, cls), v in self.binding.dct.iteritems() if cls is Ident)
 
   def dump(self, obj):
-    result = self.to_sexp(obj, [])
-    if isinstance(result, list) and len(result) and result[0]=="(":
-      result = result[1:-1]
-    return u" ".join(result)
-
-  def to_sexp(self, obj, result):
-    ap = result.append
-    tos = lambda v: self.to_sexp(v, result)
-    if isinstance(obj, Pair):
-      ap("(")
-      tos(obj[0])
-      ap(" . ")
-      tos(obj[1])
-      ap(")")
-    elif isinstance(obj, (tuple, list)):
-      ap("(")
-      map(tos, obj)
-      ap(")")
+    chunks = []
+    self.emit(obj, chunks.append)
+    return u"".join(chunks)
+
+  def write(self, obj, stream, encoding=None):
+    if encoding:
+      write = lambda chunk: stream.write(chunk.encode(encoding))
     else:
-      if isinstance(obj, dict):
-        ap("( alist->hash-table ")
-        tos([(k, Ident(u"."), v) for k,v in obj.items()])
-        ap(" ) ")
-      elif obj in self.binding:
-        ap(unicode(Ident(self.binding[obj])))
-      elif isinstance(obj, Symbol):
-        ap(u"'%s"%unicode(obj))
-      elif isinstance(obj, (Ident,int, float, long)):
-        ap(unicode(obj))
+      write = stream.write
+    self.emit(obj, write)
+
+  def emit(self, obj, write):
+    buf = []
+    ap = buf.append
+    idents = self.idents
+    marker = self.symbol_marker
+    if isinstance(obj, (tuple, list, array)) and not isinstance(obj, Pair):
+      it = iter(obj)
+    else:
+      it = iter((obj,))
+    stack = []
+    sep = u"\n"
+    first = True
+    while True:
+      for x in it:
+        if first:
+          first = False
+        else:
+          ap(sep)
+        cls = x.__class__
+        if cls is Ident:
+          ap(idents.get(x, x))
+        elif cls is int or cls is long:
+          ap(unicode(x))
+        elif cls is unicode or cls is str:
+          ap(self.string(x))
+        elif cls is float:
+          ap(repr(x))
+        elif cls is Symbol:
+          ap(marker + x)
+        elif isinstance(x, (tuple, list, array, dict)):
+          if isinstance(x, Pair):
+            x = (x[0], DOT, x[1])
+          elif isinstance(x, dict):
+            x = (ALIST, [(k, DOT, v) for k, v in x.iteritems()])
+          ap(u"(")
+          stack.append(it)
+          it = iter(x)
+          sep = u" "
+          first = True
+          break
+        else:
+          ap(self.atom(x))
+        if len(buf) >= self.buffer_size:
+          write(u"".join(buf))
+          del buf[:]
       else:
-        s = unicode(repr(obj)).decode("unicode_escape")
-        m = re.match(r"""^[u|r]?["|'](.*)["|']$""", s, re.M|re.S)
-        if m:
-          s = m.group(1)
-        ap("\"%s\""%s.replace('"','\\"').replace("\\'","'"))
-    return result
+        if not stack:
+          break
+        ap(u")")
+        it = stack.pop()
+        first = False
+        if not stack:
+          sep = u"\n"
+    if buf:
+      write(u"".join(buf))
+
+  def atom(self, obj):
+    if obj in self.binding:
+      return unicode(self.binding[obj])
+    elif isinstance(obj, Symbol):
+      return self.symbol_marker + obj
+    elif isinstance(obj, (Ident, int, long)):
+      return unicode(obj)
+    elif isinstance(obj, float):
+      return repr(obj)
+    elif isinstance(obj, basestring):
+      return self.string(obj)
+    return self.string(unicode(repr(obj)))
+
+  # 文字列の中の\と"だけを逃がす. 改行などはそのまま書いても読める
+  def string(self, s):
+    if isinstance(s, str):
+      s = s.decode("utf-8")
+    return u'"%s"' % s.replace(u"\\", u"\\\\").replace(u'"', u'\\"')
+
+# バイナリ形式
+#
+# 先頭の4バイトはBINARY_MAGIC. 続いて値を1つ書く. 値は1バイトのタグで始まる.
+#   0x80-0xff       小さい整数(タグ - 0xa0, -32から95まで)
+#   INT z           整数. zはzigzag符号化した可変長整数(7ビットずつ, 下位から)
+#   FLOAT           IEEE 754倍精度(リトルエンディアン8バイト)
+#   STRING n        UTF-8でnバイトの文字列
+#   NEW_IDENT n     初出の識別子. 綴りを表に加える. 以後はIDENT(表の添字)で参照する
+#   NEW_SYMBOL n    初出の記号. SYMBOLで参照する. 識別子と同じ表を使う
+#   LIST n          n個の要素
+#   PAIR            carとcdr
+#   DICT n          n組のキーと値
+#   ARRAY c n       型コードcの配列. リトルエンディアンでnバイト
+#   REF i           前に書いたi番目の入れ物(リスト, Pair, 辞書, 配列)と同じもの
+#   TRUE FALSE NONE
+# 入れ物は現れた順に番号を振るので, 共有している部分構造や循環も書ける.
+# 書き出しも読み込みもDumperと同じく明示的なスタックを使い, 深さの制限はない.
+BINARY_MAGIC = "SXB\x01"
+(BIN_INT, BIN_FLOAT, BIN_STRING, BIN_NEW_IDENT, BIN_IDENT, BIN_NEW_SYMBOL, BIN_SYMBOL,
+ BIN_LIST, BIN_PAIR, BIN_DICT, BIN_ARRAY, BIN_REF, BIN_TRUE, BIN_FALSE, BIN_NONE) = range(1, 16)
+BIN_SMALL_INT = 0x80
+BIN_SMALL_BIAS = 0xa0
+tag_chars = [chr(i) for i in range(256)]
+
+def pack_varint(n):
+  if n < 0x80:
+    return chr(n)
+  out = []
+  while n >= 0x80:
+    out.append(chr(n & 0x7f | 0x80))
+    n >>= 7
+  out.append(chr(n))
+  return "".join(out)
+
+def unpack_varint(data, pos):
+  result = shift = 0
+  while True:
+    b = ord(data[pos])
+    pos += 1
+    result |= (b & 0x7f) << shift
+    if b < 0x80:
+      return result, pos
+    shift += 7
+
+class BinaryDumper(object):
+  buffer_size = 4096
+
+  def dump(self, obj):
+    chunks = []
+    self.emit(obj, chunks.append)
+    return "".join(chunks)
+
+  def write(self, obj, stream):
+    self.emit(obj, stream.write)
+
+  def emit(self, obj, write):
+    buf = [BINARY_MAGIC]
+    ap = buf.append
+    tags = tag_chars
+    idents = {}
+    symbols = {}
+    memo = {}
+    kept = []                   # idが使い回されないよう, 書いた入れ物を持っておく
+    stack = [iter((obj,))]
+    while stack:
+      for x in stack[-1]:
+        cls = x.__class__
+        if cls is Ident or cls is Symbol:
+          table = idents if cls is Ident else symbols
+          i = table.get(x)
+          if i is not None:
+            ap(tags[BIN_IDENT if cls is Ident else BIN_SYMBOL] + pack_varint(i))
+          else:
+            table[x] = len(idents) + len(symbols)
+            text = x.encode("utf-8")
+            ap(tags[BIN_NEW_IDENT if cls is Ident else BIN_NEW_SYMBOL] + pack_varint(len(text)) + text)
+        elif cls is int or cls is long:
+          if -32 <= x < 96:
+            ap(tags[x + BIN_SMALL_BIAS])
+          else:
+            ap(tags[BIN_INT] + pack_varint(x << 1 if x >= 0 else (-x << 1) - 1))
+        elif cls is unicode or cls is str:
+          if cls is unicode:
+            x = x.encode("utf-8")
+          ap(tags[BIN_STRING] + pack_varint(len(x)) + x)
+        elif cls is float:
+          ap(tags[BIN_FLOAT] + struct.pack("<d", x))
+        elif x is True:
+          ap(tags[BIN_TRUE])
+        elif x is False:
+          ap(tags[BIN_FALSE])
+        elif x is None:
+          ap(tags[BIN_NONE])
+        elif isinstance(x, (tuple, list, dict, array)):
+          i = memo.get(id(x))
+          if i is not None:
+            ap(tags[BIN_REF] + pack_varint(i))
+            continue
+          memo[id(x)] = len(kept)
+          kept.append(x)
+          if isinstance(x, Pair):
+            ap(tags[BIN_PAIR])
+            stack.append(iter(x[:2]))
+          elif isinstance(x, dict):
+            ap(tags[BIN_DICT] + pack_varint(len(x)))
+            stack.append(y for item in x.iteritems() for y in item)
+          elif isinstance(x, array):
+            if sys.byteorder != "little":
+              x = array(x.typecode, x)
+              x.byteswap()
+            data = x.tostring()
+            ap(tags[BIN_ARRAY] + x.typecode + pack_varint(len(data)) + data)
+            continue
+          else:
+            ap(tags[BIN_LIST] + pack_varint(len(x)))
+            stack.append(iter(x))
+          break
+        else:
+          raise TypeError("cannot dump %r in binary form" % (x,))
+        if len(buf) >= self.buffer_size:
+          write("".join(buf))
+          del buf[:]
+      else:
+        stack.pop()
+    write("".join(buf))
+
+class BinaryLoader(object):
+
+  def load(self, data):
+    if data[:4] != BINARY_MAGIC:
+      raise ParseError("not a binary s-expression")
+    value, pos = self.load_value(data, 4)
+    if pos > len(data):
+      raise ParseError("truncated binary s-expression")
+    elif pos < len(data):
+      raise ParseError("extra data after the binary s-expression")
+    return value
+
+  def load_file(self, path):
+    f = open(path, "rb")
+    try:
+      return self.load(f.read())
+    finally:
+      f.close()
+
+  # 入れ物を読みはじめたら[要素のリスト, 残りの要素数, 入れ物]をスタックに積み,
+  # 値が1つできるたびに一番上の要素のリストへ足す. 埋まった入れ物はそれ自体が値になる.
+  # 辞書はキーと値を交互にリストへためておき, 埋まったところで辞書に入れる.
+  def load_value(self, data, pos):
+    symbols = []
+    memo = []
+    stack = []
+    try:
+      while True:
+        tag = ord(data[pos])
+        pos += 1
+        if tag >= BIN_SMALL_INT:
+          value = tag - BIN_SMALL_BIAS
+        elif tag == BIN_IDENT or tag == BIN_SYMBOL:
+          i = ord(data[pos])
+          if i < 0x80:
+            pos += 1
+          else:
+            i, pos = unpack_varint(data, pos)
+          value = symbols[i]
+        elif tag == BIN_LIST or tag == BIN_PAIR or tag == BIN_DICT:
+          if tag == BIN_PAIR:
+            value, n = Pair(), 2
+          else:
+            n = ord(data[pos])
+            if n < 0x80:
+              pos += 1
+            else:
+              n, pos = unpack_varint(data, pos)
+            if tag == BIN_LIST:
+              value = []
+            else:
+              value, n = {}, n * 2
+          memo.append(value)
+          if n:
+            stack.append([[] if tag == BIN_DICT else value, n, value])
+            continue
+        elif tag == BIN_STRING:
+          n = ord(data[pos])
+          if n < 0x80:
+            pos += 1
+          else:
+            n, pos = unpack_varint(data, pos)
+          value = data[pos:pos + n].decode("utf-8")
+          pos += n
+        elif tag == BIN_NEW_IDENT or tag == BIN_NEW_SYMBOL:
+          n, pos = unpack_varint(data, pos)
+          text = data[pos:pos + n].decode("utf-8")
+          pos += n
+          value = Ident(text) if tag == BIN_NEW_IDENT else Symbol(text)
+          symbols.append(value)
+        elif tag == BIN_INT:
+          z, pos = unpack_varint(data, pos)
+          value = -((z + 1) >> 1) if z & 1 else z >> 1
+        elif tag == BIN_FLOAT:
+          value = struct.unpack("<d", data[pos:pos + 8])[0]
+          pos += 8
+        elif tag == BIN_REF:
+          i, pos = unpack_varint(data, pos)
+          value = memo[i]
+        elif tag == BIN_ARRAY:
+          typecode = data[pos]
+          n, pos = unpack_varint(data, pos + 1)
+          value = array(typecode, data[pos:pos + n])
+          if sys.byteorder != "little":
+            value.byteswap()
+          pos += n
+          memo.append(value)
+        elif tag == BIN_TRUE:
+          value = True
+        elif tag == BIN_FALSE:
+          value = False
+        elif tag == BIN_NONE:
+          value = None
+        else:
+          raise ParseError("unknown tag %d at %d" % (tag, pos - 1))
+
+        while stack:
+          frame = stack[-1]
+          frame[0].append(value)
+          frame[1] -= 1
+          if frame[1]:
+            break
+          stack.pop()
+          value = frame[2]
+          if value.__class__ is dict:
+            items = frame[0]
+            value.update(zip(items[::2], items[1::2]))
+        else:
+          return value, pos
+    except (IndexError, ValueError, struct.error):
+      raise ParseError("truncated or corrupt binary s-expression")
 
 dumper = Dumper()
 read = Reader().read
 dump = dumper.dump
+dump_binary = BinaryDumper().dump
+load_binary = BinaryLoader().load
+load_binary_file = BinaryLoader().load_file
 
 #{{{ test
 def test():
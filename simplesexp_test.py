@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+from simplesexp import *
+import simplesexp
+import unittest, StringIO, tempfile, os, pickle, copy
+from array import array
+
+class TestReader(unittest.TestCase):
+
+    def test_simplesexp_test(self):
+        simplesexp.test()
+
+    def test_numbers(self):
+        self.assertEqual(read(u"(0 -12 010 0x1f 1L 09 3.14 .5 10. 1e3)"),
+                         [[0, -12, 8, 31, 1L, 0, 9, 3.14, .5, 10., 1e3]])
+        self.assertTrue(isinstance(read(u"1L")[0], long))
+
+    # 数の接頭辞だけを読み, 残りは次の字句になる
+    def test_number_prefix(self):
+        self.assertEqual(read(u"(123abc 1+ -x 1;comment\n 2)"),
+                         [[123, Ident(u'abc'), 1, Ident(u'+'), Ident(u'-x'), 1, 2]])
+
+    def test_strings(self):
+        self.assertEqual(read(u'("a\\"b" "\\n" "あ\\tい" "")'),
+                         [[u'a"b', u'\n', u'あ\tい', u'']])
+        self.assertEqual(read('"abc"'), [u'abc'])
+        self.assertTrue(isinstance(read('"abc"')[0], unicode))
+
+    def test_quote(self):
+        self.assertEqual(read(u"'a ' (b) ''c"),
+                         [Symbol(u'a'), [Ident(u'quote'), [Ident(u'b')]],
+                          Symbol(u"'c")])
+        self.assertEqual(read(u"' ' x"),
+                         [[Ident(u'quote'), [Ident(u'quote'), Ident(u'x')]]])
+
+    def test_dotted(self):
+        self.assertEqual(read(u"(a . b) (a . (b c)) (a . ()) (a b .)"),
+                         [Pair([Ident(u'a'), Ident(u'b')]), [Ident(u'a'), Ident(u'b'), Ident(u'c')],
+                          [Ident(u'a')], [Ident(u'a'), Ident(u'b'), Ident(u'.')]])
+        self.assertEqual(read(u"(.5 . .x)"), [Pair([.5, Ident(u'.x')])])
+
+    def test_comment_at_end(self):
+        self.assertEqual(read(u"(a) ;comment"), [[Ident(u'a')]])
+
+    # 同じ綴りの識別子と記号は読み込みをまたいで同じオブジェクトになる
+    def test_interning(self):
+        first = read(u"(abc 'abc)")[0]
+        second = Reader().read("abc 'abc")
+        self.assertTrue(first[0] is second[0] is Ident(u'abc'))
+        self.assertTrue(first[1] is second[1] is Symbol(u'abc'))
+        self.assertFalse(first[0] is first[1])
+        for proto in (0, 1, 2):
+            self.assertTrue(pickle.loads(pickle.dumps(first, proto))[0] is first[0])
+        self.assertTrue(copy.deepcopy(first)[1] is first[1])
+
+    def test_errors(self):
+        self.assertRaises(ParseError, read, u"(a b")
+        self.assertRaises(ParseError, read, u"(a b]")
+        self.assertRaises(ParseError, read, u"a)")
+        self.assertRaises(ParseError, read, u"'")
+        self.assertRaises(ParseError, read, u'"abc')
+
+class TestIterRead(unittest.TestCase):
+
+    source = u"""(define (f x)
+  "multi
+line" ; comment
+  (g 'x (h . y)))
+12 abc
+(a . b) "あ"
+"""
+
+    def test_same_as_read(self):
+        stream = StringIO.StringIO(self.source.encode('utf-8'))
+        self.assertEqual(list(Reader().iter_read(stream, 'utf-8')), read(self.source))
+
+    # 行の途中や複数バイト文字の途中で切れた断片でも同じように読める
+    def test_chunks(self):
+        data = self.source.encode('utf-8')
+        for size in (1, 3, 7):
+            stream = StringIO.StringIO(data)
+            self.assertEqual(list(Reader().iter_read(stream, 'utf-8', size)), read(self.source))
+        self.assertEqual(list(Reader().iter_read(list(self.source))), read(self.source))
+
+    # 要素が読めた時点で, 残りの入力を待たずに返す
+    def test_incremental(self):
+        lines = iter([u"(a\n", u" b)\n", u"c\n", u"d\n"])
+        data = Reader().iter_read(lines)
+        self.assertEqual(next(data), [Ident(u'a'), Ident(u'b')])
+        self.assertEqual(next(lines), u"c\n")
+        self.assertEqual(list(data), [Ident(u'd')])
+        self.assertRaises(ParseError, list, Reader().iter_read([u"(a\n", u"(b)"]))
+
+    def test_error_position(self):
+        stream = StringIO.StringIO("(a\n b)\n (c\n (d))) (e)\n")
+        try:
+            list(Reader().iter_read(stream))
+        except ParseError, e:
+            self.assertTrue("line 4, 6: missing opening" in e.message)
+        else:
+            self.fail()
+
+    def test_bad_escape(self):
+        for source in ('(a\n "\\x4")', u'(a\n "\\u12")'):
+            try:
+                read(source)
+            except ParseError, e:
+                self.assertTrue("line 2, 2: invalid escape sequence" in e.message, e.message)
+            else:
+                self.fail()
+
+class TestReadFile(unittest.TestCase):
+
+    source = u"""; データ
+(quote ((1 2 3) (1.5 2.5) (a b a "あ" 'c 'c) (0 . (1 2)) (1 2.0) (#t 1)))
+(あ い あ)
+"""
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.scm')
+        os.write(fd, self.source.encode('utf-8'))
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_read_file(self):
+        self.assertEqual(Reader().read_file(self.path), read(self.source))
+
+    def test_compact(self):
+        data = Reader(compact=True).read_file(self.path)
+        quoted = data[0][1]
+        self.assertEqual(quoted[0], array('l', [1, 2, 3]))
+        self.assertEqual(quoted[1], array('d', [1.5, 2.5]))
+        self.assertEqual(quoted[3], array('l', [0, 1, 2]))
+        self.assertEqual(quoted[4], [1, 2.0])
+        self.assertEqual(quoted[5], [True, 1])
+        self.assertEqual(read(dump(data)), read(self.source))
+
+    def test_interned(self):
+        data = Reader().read_file(self.path)
+        symbols = data[0][1][2]
+        self.assertTrue(symbols[0] is symbols[2])
+        self.assertTrue(symbols[4] is symbols[5])
+        self.assertTrue(data[1][0] is data[1][2])
+
+    def test_empty(self):
+        open(self.path, 'w').close()
+        self.assertEqual(Reader().read_file(self.path), [])
+
+class TestDumper(unittest.TestCase):
+
+    def test_round_trip(self):
+        data = [[1, [], -2, 1.1, 1e100, u'a\\b"c\nd', u'あ', Symbol(u's'), True, None],
+                Pair([1, Pair([2, 3])]), {u'k': [1, 2]}, Ident(u'alist->hash-table')]
+        self.assertEqual(read(dump(data)), data)
+        self.assertEqual(dump(data[1]), u'(1 . (2 . 3))')
+        self.assertEqual(dump(5), u'5')
+        self.assertEqual(dump([]), u'')
+
+    # compactモードでもドット対と辞書はそのまま読める. arrayにするのは普通のリストだけ
+    def test_compact_round_trip(self):
+        data = [Pair([1, 2]), Pair([1.5, Pair([2.5, 3.5])]), {1: 2, 3: Pair([4, 5]), 6: [7, 8]},
+                [Pair([0, 1]), {u'k': 1.5}]]
+        reader = Reader(compact=True)
+        self.assertEqual(reader.read(dump(data)), data)
+        self.assertEqual(reader.read(u'(dict ((1 . 2))) (0 . (1 2)) (1 2)'),
+                         [{1: 2}, array('l', [0, 1, 2]), array('l', [1, 2])])
+
+    # 再帰の上限よりずっと深いリスト
+    def test_deep(self):
+        data = []
+        for i in xrange(10000):
+            data = [i, data]
+        text = dump([data])
+        self.assertEqual(dump(read(text)), text)
+        chain = None
+        for i in xrange(10000):
+            chain = Pair([i, chain])
+        self.assertEqual(dump(chain).count(u'.'), 10000)
+
+    def test_write(self):
+        data = [[i, u'い%d' % i, Symbol(u'x')] for i in xrange(1000)]
+        dumper = Dumper()
+        dumper.buffer_size = 7
+        stream = StringIO.StringIO()
+        dumper.write(data, stream, 'utf-8')
+        self.assertEqual(stream.getvalue().decode('utf-8'), dump(data))
+        stream.seek(0)
+        self.assertEqual(list(Reader().iter_read(stream, 'utf-8')), data)
+
+class TestBinary(unittest.TestCase):
+
+    def test_round_trip(self):
+        data = [[0, -32, 95, -33, 96, 2 ** 70, -2 ** 70, 1.1, u'a\\b"c', u'あ', u'',
+                 True, False, None, [], Symbol(u's'), Ident(u's'), Ident(u's')],
+                Pair([1, Pair([2, 3])]), {u'k': [1, 2], Ident(u'x'): {}},
+                array('l', [1, -2, 3]), array('d', [.5])]
+        loaded = load_binary(dump_binary(data))
+        self.assertEqual(loaded, data)
+        self.assertTrue(isinstance(loaded[1][1], Pair))
+        self.assertTrue(loaded[0][15] is Symbol(u's'))
+        self.assertTrue(loaded[0][16] is loaded[0][17] is Ident(u's'))
+
+    def test_symbol_table(self):
+        data = [Ident(u'long-identifier')] * 100
+        self.assertEqual(len(dump_binary(data)), 4 + 2 + 17 + 99 * 2)
+
+    def test_shared(self):
+        shared = [1, 2]
+        loaded = load_binary(dump_binary([shared, {u'k': shared}, shared]))
+        self.assertTrue(loaded[0] is loaded[1][u'k'] is loaded[2])
+        cycle = [1]
+        cycle.append(cycle)
+        loaded = load_binary(dump_binary(cycle))
+        self.assertTrue(loaded[1] is loaded)
+
+    def test_deep(self):
+        chain = None
+        for i in xrange(10000):
+            chain = Pair([i, chain])
+        loaded = load_binary(dump_binary(chain))
+        self.assertEqual(dump(loaded), dump(chain))
+
+    def test_write(self):
+        data = [[i, u'い%d' % i, Symbol(u'x')] for i in xrange(1000)]
+        dumper = BinaryDumper()
+        dumper.buffer_size = 7
+        stream = StringIO.StringIO()
+        dumper.write(data, stream)
+        self.assertEqual(stream.getvalue(), dump_binary(data))
+
+    def test_errors(self):
+        data = dump_binary([[1, u'abc', 2.5], Symbol(u'x')])
+        self.assertRaises(ParseError, load_binary, '(1 2)')
+        for end in xrange(4, len(data)):
+            self.assertRaises(ParseError, load_binary, data[:end])
+        self.assertRaises(ParseError, load_binary, data + '\x00')
+        self.assertRaises(TypeError, dump_binary, [object()])
+
+if __name__ == '__main__':
+    unittest.main()